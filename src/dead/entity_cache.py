@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import logging
+import time
+
+
+class EntityCache():
+    """
+    Entity Cache
+
+    Bounded in-memory cache of entity metrics for Necromancer, keyed by
+    (entity, type) and holding {(source, metric): value}
+
+    Entries are evicted least recently used first once the cache is full, and
+    expire after a TTL so writes from other Necromancers are picked up
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        """
+        Create an Entity Cache
+
+        Inputs:
+            max_size: int of entities to hold, 0 disables the cache
+            ttl: float of seconds an entity stays cached
+        """
+        self._max_size = max(0, max_size)
+        self._ttl = ttl
+        self._entries = OrderedDict() # type: OrderedDict[tuple[str, str], tuple[float, dict]]
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        logging.debug(f'Created entity cache for {max_size} entities with TTL {ttl}s')
+
+    def get(self, key: tuple[str, str]) -> dict:
+        """
+        Get cached metrics for an entity
+
+        Inputs:
+            key: tuple[str, str] of (entity, type)
+
+        Returns:
+            dict: {(source, metric): value} or None if not cached
+        """
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self._misses += 1
+            return None
+
+        # Expired
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+
+        return entry[1]
+
+    def put(self, key: tuple[str, str], metrics: dict) -> None:
+        """
+        Cache the metrics of an entity
+
+        Inputs:
+            key: tuple[str, str] of (entity, type)
+            metrics: dict of {(source, metric): value}
+        """
+        if not self._max_size:
+            return
+
+        self._entries[key] = (time.monotonic() + self._ttl, metrics)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def set_metric(self, key: tuple[str, str], source: str, metric: str, value: str) -> None:
+        """
+        Write a metric through to a cached entity, uncached entities are left alone
+
+        Inputs:
+            key: tuple[str, str] of (entity, type)
+            source: str of the update source
+            metric: str name of the metric
+            value: str value of the metric
+        """
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            entry[1][(source, metric)] = value
+
+    def invalidate(self, key: tuple[str, str]) -> None:
+        """
+        Drop an entity from the cache
+
+        Inputs:
+            key: tuple[str, str] of (entity, type)
+        """
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Cache counters
+
+        Returns:
+            dict: {size, max_size, hits, misses, evictions, hit_ratio}
+        """
+        lookups = self._hits + self._misses
+
+        return {
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "hit_ratio": self._hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,164 @@
+from typing import Any, Awaitable, Callable
+import asyncio
+import logging
+
+
+class IngestQueue():
+    """
+    Ingest Queue
+
+    Bounded write-behind queue for Necromancer. Updates are accepted into the
+    queue and a background flusher writes them in batches once a size or time
+    threshold is reached
+
+    Producers wait on the queue only when it is full, never on Mongo
+
+    Queued updates were already accepted, so a batch that fails to flush is
+    retried with a bounded backoff before anything is dropped. The flusher
+    waits while it retries, so the queue fills and pushes back on producers
+    instead of accepting more than it can write
+    """
+
+    def __init__(self, flush: Callable[[list], Awaitable[list]], max_size: int, batch_size: int, interval: float, retries: int = 0, backoff: float = 1, max_backoff: float = 30) -> None:
+        """
+        Create an Ingest Queue
+
+        Inputs:
+            flush: Callable awaited with each batch of queued updates, returning the ones to retry
+            max_size: int of updates the queue holds before applying backpressure
+            batch_size: int of updates to flush at once
+            interval: float of seconds to wait for a batch to fill before flushing
+            retries: int of times a failed flush is retried
+            backoff: float of seconds before the first retry, doubled for each one after
+            max_backoff: float of most seconds between retries
+        """
+        self._flush = flush
+        self._queue = asyncio.Queue(max_size)
+        self._batch_size = max(1, batch_size)
+        self._interval = interval
+        self._retries = max(0, retries)
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+        self._task = None # type: asyncio.Task
+        self._closing = False
+
+    def start(self) -> None:
+        """
+        Start the background flusher
+        """
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+        logging.info(f'Started ingest queue flusher')
+
+    async def stop(self) -> None:
+        """
+        Stop accepting updates, flush everything queued and stop the flusher
+        """
+        self._closing = True
+
+        if self._task is None:
+            return
+
+        logging.info(f'Draining {self.depth()} queued updates')
+
+        await self._queue.join()
+
+        self._task.cancel()
+        self._task = None
+
+        logging.info(f'Stopped ingest queue flusher')
+
+    def depth(self) -> int:
+        """
+        Get the number of queued updates
+
+        Returns:
+            int: queued updates
+        """
+        return self._queue.qsize()
+
+    async def put(self, update: Any, timeout: float = None) -> bool:
+        """
+        Queue an update, waiting for room while the queue is full
+
+        Inputs:
+            update: to queue
+            timeout: float of seconds to wait for room, None waits forever
+
+        Returns:
+            bool: whether the update was queued
+        """
+        if self._closing:
+            return False
+
+        try:
+            await asyncio.wait_for(self._queue.put(update), timeout)
+
+        except asyncio.TimeoutError:
+            logging.warning(f'Ingest queue is full')
+            return False
+
+        return True
+
+    async def _run(self) -> None:
+        """
+        Flusher loop, takes batches off the queue and flushes them
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._interval
+
+            # Fill the batch until it is full or the interval is up
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+
+                except asyncio.QueueEmpty:
+                    pass
+
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._closing:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush_batch(batch)
+
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _flush_batch(self, batch: list) -> None:
+        """
+        Flush a batch, retrying what failed until it is written or the retries run out
+
+        Inputs:
+            batch: list of queued updates
+        """
+        pending = batch
+
+        for attempt in range(self._retries + 1):
+            if attempt:
+                delay = min(self._backoff * 2 ** (attempt - 1), self._max_backoff)
+                logging.warning(f'Retrying {len(pending)} queued updates in {delay:.1f}s, attempt {attempt} of {self._retries}')
+
+                await asyncio.sleep(delay)
+
+            try:
+                pending = await self._flush(pending) or list()
+
+            except Exception as e:
+                logging.exception(f'Failed to flush {len(pending)} queued updates')
+
+            if not pending:
+                return
+
+        logging.error(f'Dropped {len(pending)} accepted updates that could not be flushed after {self._retries} retries')
@@ -2,20 +2,134 @@
 # TODO: host dispatching
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from typing import Any
-from pydantic import BaseModel
-from datetime import datetime
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from bson import ObjectId
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from pydantic import BaseModel, Field
+from datetime import datetime, timedelta
 from os import getenv
-import pymongo
+from pymongo import ASCENDING, AsyncMongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from entity_cache import EntityCache
+from ingest import IngestQueue
+from telemetry import MONGO_LATENCY, REQUEST_LATENCY, UPDATES
+from time import perf_counter
+import telemetry
+import argparse
+import asyncio
 import json
 import logging 
+import orjson
 
 MONGO_URL = getenv("MONGO_URL")
 MONGO_DB = getenv("MONGO_DB")
-MONGO_CLIENT = pymongo.MongoClient(MONGO_URL)[MONGO_DB]
+MONGO_MAX_POOL_SIZE = int(getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(getenv("MONGO_MIN_POOL_SIZE", 0))
 
-app = FastAPI()
+# Asyncio-native client so Mongo waits don't block the event loop
+MONGO_CLIENT = AsyncMongoClient(MONGO_URL, maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE)[MONGO_DB]
+
+# Optional retention for the updates collection, unset keeps updates forever
+UPDATES_RETENTION_DAYS = getenv("UPDATES_RETENTION_DAYS")
+
+# Metric changes are kept in one updates document per entity per window
+UPDATES_BUCKET_SECONDS = int(getenv("UPDATES_BUCKET_SECONDS", 86400))
+UPDATES_EPOCH = datetime(1970, 1, 1)
+
+# Write-through cache of entity metrics so unchanged updates skip Mongo reads
+ENTITY_CACHE_SIZE = int(getenv("ENTITY_CACHE_SIZE", 10000))
+ENTITY_CACHE_TTL = float(getenv("ENTITY_CACHE_TTL", 300))
+ENTITY_CACHE = EntityCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+# Paging of /entities
+ENTITIES_MAX_LIMIT = int(getenv("ENTITIES_MAX_LIMIT", 10000))
+ENTITIES_BATCH_SIZE = int(getenv("ENTITIES_BATCH_SIZE", 1000))
+
+# Write-behind ingestion, a queue size of 0 writes to Mongo within the request
+INGEST_QUEUE_SIZE = int(getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_BATCH_SIZE = int(getenv("INGEST_BATCH_SIZE", 1000))
+INGEST_FLUSH_INTERVAL = float(getenv("INGEST_FLUSH_INTERVAL", 1))
+INGEST_PUT_TIMEOUT = float(getenv("INGEST_PUT_TIMEOUT", 5))
+
+# Accepted updates that fail to flush are retried, backing off from INGEST_RETRY_BACKOFF seconds
+INGEST_RETRIES = int(getenv("INGEST_RETRIES", 6))
+INGEST_RETRY_BACKOFF = float(getenv("INGEST_RETRY_BACKOFF", 1))
+INGEST_QUEUE = IngestQueue(lambda s: flush_queued_updates(s), INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_RETRIES, INGEST_RETRY_BACKOFF) if INGEST_QUEUE_SIZE > 0 else None
+
+# Error of updates for an entity Necromancer doesn't know, retrying won't help
+ENTITY_MISSING = "Could not locate entity in Mongo"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup and shutdown of Necromancer
+    """
+    await ensure_mongo_indexes()
+
+    if INGEST_QUEUE:
+        INGEST_QUEUE.start()
+
+    yield
+
+    # Flush whatever is still queued
+    if INGEST_QUEUE:
+        await INGEST_QUEUE.stop()
+
+def _bson_default(obj: Any) -> str:
+    """
+    Encode the BSON types orjson does not know about
+
+    Inputs:
+        obj: value orjson could not encode
+
+    Returns:
+        str: encoded value
+
+    Raises:
+        TypeError: if the type is not supported
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+
+    raise TypeError(f'Type {type(obj).__name__} is not JSON serializable')
+
+class BSONResponse(JSONResponse):
+    """
+    JSON response encoded in one pass by orjson, with native datetime and ObjectId support
+
+    Return it directly from handlers so FastAPI skips its own encoding
+    """
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_bson_default, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(lifespan=lifespan, default_response_class=BSONResponse)
+
+telemetry.register_gauges(INGEST_QUEUE, ENTITY_CACHE)
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    """
+    Record request latency per route
+    """
+    start = perf_counter()
+    response = await call_next(request)
+
+    route = request.scope.get("route")
+    REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", response.status_code).observe(perf_counter() - start)
+
+    return response
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus metrics
+    """
+    body, content_type = telemetry.render()
+
+    return Response(body, media_type=content_type)
 
 class UpdateModel(BaseModel):
     entity: str
@@ -23,7 +137,8 @@ class UpdateModel(BaseModel):
     source: str
     metric: str
     value: str
-    timestamp: datetime = datetime.now()
+    metadata: dict[str, str] | None = None
+    timestamp: datetime = Field(default_factory=datetime.now)
 
 @app.post("/entity")
 async def update_entity(update: UpdateModel):
@@ -31,23 +146,28 @@ async def update_entity(update: UpdateModel):
     Update an entity
 
     - Validates
-    - Posts to Mongo
+    - Queues for Mongo when write-behind is enabled, otherwise posts to Mongo
     """
-    logging.info(f'Update received on /entity')
+    logging.debug(f'Update received on /entity')
 
     if not validate_update(update): 
         logging.info(f'Update could not be validated')
-        return json.dumps({"error": "Update could not be validated"})
+        return BSONResponse({"error": "Update could not be validated"})
+
+    if INGEST_QUEUE:
+        if not await INGEST_QUEUE.put(update, INGEST_PUT_TIMEOUT):
+            return BSONResponse({"error": "Ingest queue is full"}, status_code=503, headers={"Retry-After": str(int(INGEST_FLUSH_INTERVAL) + 1)})
 
-    logging.info("Validated update")
-    logging.info("Posting update to Mongo")
+        return BSONResponse({"status": "accepted"}, status_code=202)
+
+    logging.debug("Posting update to Mongo")
 
     if not await post_mongo_entity(update): 
         logging.info("Failed to post to MongoDB")
-        return json.dumps({"error": "Update could not be posted to MongoDB"})
+        return BSONResponse({"error": "Update could not be posted to MongoDB"})
 
-    logging.info("MongoDB has been updated")
-    return json.dumps("success")
+    logging.debug("MongoDB has been updated")
+    return BSONResponse({"status": "success"})
 
 def validate_update(update: UpdateModel) -> bool: 
     """
@@ -60,13 +180,16 @@ def validate_update(update: UpdateModel) -> bool:
         bool: whether it passed validation
     """
     if update is None: 
+        UPDATES.labels("rejected").inc()
         return False 
     
     upd_dict = update.model_dump()
 
-    if len(upd_dict) != 6: 
+    if len(upd_dict) != 7: 
+        UPDATES.labels("rejected").inc()
         return False 
     
+    UPDATES.labels("validated").inc()
     return True 
 
 
@@ -82,155 +205,576 @@ async def post_mongo_entity(update: UpdateModel) -> bool:
     type = update_dict.get("type")
     source = update_dict.get("source")
     metric = update_dict.get("metric")
-    value = update_dict.get("metric")
-    timestamp = update_dict.get("timestamp")    
+    value = update_dict.get("value")
+    key = (entity, type)
 
-    # See if entity exists 
-    try: 
-        mongo_entity = MONGO_CLIENT["entities"].find_one({"entity": entity, "type": type}) # type: dict
+    # See if entity exists, from the cache when possible
+    try:
+        metrics = (await get_mongo_metrics([key])).get(key)
 
-        if not mongo_entity: 
+        if metrics is None:
             raise ValueError("Could not locate entity in Mongo")
 
-    except Exception as e: 
+    except Exception as e:
         logging.exception("Error finding entity")
-        return False 
-    
-    logging.debug(f'Found entity: {entity} in Mongo. Continuing')
+        return False
 
-    # Upload update to updates collection 
-    logging.debug(f'Uploading update to update table')
+    # Apply the metric to the entity unless it is already the same
+    try:
+        changed = False
+
+        if metrics.get((source, metric)) != value:
+            changed = await upsert_mongo_metric(entity, type, source, metric, value)
+
+        ENTITY_CACHE.set_metric(key, source, metric, value)
+
+    except Exception as e:
+        ENTITY_CACHE.invalidate(key)
+        logging.exception(f'Could not update metrics for entity: {entity}')
+        return False
+
+    logging.debug(f'Metric: {metric} on entity: {entity} changed: {changed}')
+
+    # Unchanged metrics have no history
+    if not changed:
+        return True
+
+    # Upload change to its updates bucket
+    logging.debug(f'Uploading change to update table')
     try: 
-        res = MONGO_CLIENT["updates"].insert_one(update_dict)
+        filter, update = _history_op(entity, type, [_history_change(update_dict)])
 
-        logging.debug(f'Successfully uploaded update')
+        with MONGO_LATENCY.labels("post_mongo_entity.history").time():
+            res = await MONGO_CLIENT["updates"].update_one(filter, update, upsert=True)
+
+        UPDATES.labels("changed").inc()
+
+        logging.debug(f'Successfully uploaded change')
 
     except Exception as e: 
         logging.exception(f'Could not post update for {entity}')
         return False 
-    
-    # Check to see if anything changed from entity entry/update it
-    logging.debug(f'Checking if entity: {entity} has changed since last update')
 
-    db_metrics = mongo_entity.get("metrics") # type: list
+    return True
 
-    # TODO: Revert this back to local processing and push if addition or set if change 
+def _bucket_start(timestamp: datetime) -> datetime:
+    """
+    Get the start of the updates bucket a timestamp falls in
 
-    # Doesn't exist
-    if metric not in [s.get("metric") for s in db_metrics]:
-        logging.debug(f'Metric: {metric} does not exist on entity: {entity}')
+    Inputs:
+        timestamp: datetime of the update
 
-        try:
-            res = MONGO_CLIENT["entities"].update_one({
-                '_id': mongo_entity.get("_id")
-            }, {
-                "$push": {
-                    "metrics": {
-                        "source": source, 
-                        "metric": metric, 
-                        "value": value
-                    }
-                }
-            })
-
-            if res.modified_count != 1: 
-                raise ValueError("Modified count is not greater than 1")
-
-            logging.debug(f'Added metric: {metric} to entity: {entity}')
+    Returns:
+        datetime: start of the bucket window
+    """
+    offset = (timestamp.replace(tzinfo=None) - UPDATES_EPOCH).total_seconds() % UPDATES_BUCKET_SECONDS
+
+    return timestamp.replace(tzinfo=None) - timedelta(seconds=offset)
+
+def _history_change(update_dict: dict) -> dict:
+    """
+    Entry stored in an updates bucket for one metric change
+
+    Inputs:
+        update_dict: dict of an UpdateModel
+
+    Returns:
+        dict: {source, metric, value, timestamp} and metadata when the update has any
+    """
+    change = {
+        "source": update_dict.get("source"),
+        "metric": update_dict.get("metric"),
+        "value": update_dict.get("value"),
+        "timestamp": update_dict.get("timestamp")
+    }
+
+    if update_dict.get("metadata"):
+        change["metadata"] = update_dict.get("metadata")
+
+    return change
+
+def _history_op(entity: str, type: str, changes: list[dict]) -> tuple[dict, dict]:
+    """
+    Build the upsert that appends metric changes to an entity's updates bucket
+
+    Inputs:
+        entity: str of the entity
+        type: str type of entity
+        changes: list[dict] from _history_change, all in the same bucket
+
+    Returns:
+        tuple[dict, dict]: filter and update to run with upsert=True
+    """
+    start = _bucket_start(changes[0].get("timestamp"))
+
+    return (
+        {"entity": entity, "type": type, "start": start},
+        {
+            "$push": {"changes": {"$each": changes, "$sort": {"timestamp": ASCENDING}}},
+            "$inc": {"count": len(changes)},
+            "$setOnInsert": {"end": start + timedelta(seconds=UPDATES_BUCKET_SECONDS)}
+        }
+    )
+
+async def get_mongo_metrics(keys: list[tuple[str, str]]) -> dict[tuple[str, str], dict]:
+    """
+    Get the metrics of entities, from the entity cache or MongoDB
 
+    Entities missing from the cache are read in one query and cached
+
+    Inputs:
+        keys: list[tuple[str, str]] of (entity, type)
+
+    Returns:
+        dict: {(entity, type): {(source, metric): value}} for entities that exist
+    """
+    found = dict()
+    misses = list()
+
+    for key in keys:
+        metrics = ENTITY_CACHE.get(key)
+
+        if metrics is None:
+            misses.append(key)
+            continue
+
+        found[key] = metrics
+
+    if not misses:
+        return found
+
+    query = {"$or": [{"entity": entity, "type": type} for entity, type in misses]}
+    projection = {"_id": False, "entity": True, "type": True, "metrics": True}
+
+    with MONGO_LATENCY.labels("get_mongo_metrics.find").time():
+        mongo_entities = await MONGO_CLIENT["entities"].find(query, projection=projection).to_list()
+
+    for mongo_entity in mongo_entities:
+        key = (mongo_entity.get("entity"), mongo_entity.get("type"))
+        found[key] = {(s.get("source"), s.get("metric")): s.get("value") for s in mongo_entity.get("metrics") or list()}
+
+        ENTITY_CACHE.put(key, found[key])
+
+    return found
+
+def _metric_ops(entity: str, type: str, source: str, metric: str, value: str) -> list[tuple[dict, dict, list]]:
+    """
+    Build the atomic operations that apply a metric value to an entity
+
+    The first sets the value in place if the metric exists and differs, the
+    second pushes the metric if it does not exist yet. At most one of them
+    modifies the entity, whichever order they run in
+
+    Inputs:
+        entity: str of the entity
+        type: str type of entity
+        source: str of the update source
+        metric: str name of the metric
+        value: str value of the metric
+
+    Returns:
+        list[tuple[dict, dict, list]]: (filter, update, array_filters) for the set and push operations
+    """
+    match = {"source": source, "metric": metric}
+
+    set_op = (
+        {"entity": entity, "type": type, "metrics": {"$elemMatch": match}},
+        {"$set": {"metrics.$[m].value": value}},
+        [{"m.source": source, "m.metric": metric, "m.value": {"$ne": value}}]
+    )
+
+    push_op = (
+        {"entity": entity, "type": type, "metrics": {"$not": {"$elemMatch": match}}},
+        {"$push": {"metrics": {"source": source, "metric": metric, "value": value}}},
+        None
+    )
+
+    return [set_op, push_op]
+
+async def upsert_mongo_metric(entity: str, type: str, source: str, metric: str, value: str) -> bool:
+    """
+    Atomically set or add one metric on an entity in MongoDB
+
+    Only the changed metric is written, and whether it changed comes from the
+    update result rather than reading the entity first
+
+    Inputs:
+        entity: str of the entity
+        type: str type of entity
+        source: str of the update source
+        metric: str name of the metric
+        value: str value of the metric
+
+    Returns:
+        bool: whether the metric changed
+
+    Raises:
+        ValueError: if the entity does not exist
+    """
+    set_op, push_op = _metric_ops(entity, type, source, metric, value)
+    entities = MONGO_CLIENT["entities"]
+
+    # Two attempts, the second only if another writer pushed the metric first
+    for _ in range(2):
+        with MONGO_LATENCY.labels("upsert_mongo_metric.set").time():
+            res = await entities.update_one(set_op[0], set_op[1], array_filters=set_op[2])
+
+        # Metric exists, modified only if the value differed
+        if res.matched_count:
+            return res.modified_count == 1
+
+        with MONGO_LATENCY.labels("upsert_mongo_metric.push").time():
+            res = await entities.update_one(push_op[0], push_op[1])
+
+        # Metric did not exist and was added
+        if res.modified_count:
             return True
 
-        except Exception as e: 
-            logging.warning(f'Could not add metric')
-            return False 
-        
-    # Check if current version is the same
-    flag = False
-    for db_metric in db_metrics: 
-        db_metric = db_metric # type: dict 
+    raise ValueError("Could not locate entity in Mongo")
 
-        # Wrong metric
-        if metric != db_metric.get("metric"): 
-            continue 
+@app.post("/entities/batch")
+async def update_entities(updates: list[UpdateModel]):
+    """
+    Update many entities at once
 
-        # Wrong source
-        if source != db_metric.get("source"): 
-            continue 
+    - Validates each update
+    - Queues for Mongo when write-behind is enabled, otherwise
+    - Groups updates by (entity, type)
+    - Posts to Mongo with one unordered bulk_write per collection
 
-        # Value is already the same
-        if value == db_metric.get("value"): 
-            continue 
+    Returns per-item results so partial failures are still reported
+    """
+    logging.debug(f'Batch of {len(updates)} updates received on /entities/batch')
 
-        # Value is not the same
-        flag = True 
-        db_metric["value"] = value
+    if INGEST_QUEUE:
+        return await queue_updates(updates)
 
-    # No change needed
-    if not flag: 
-        return True
-        
-    # Changed needed 
+    results = await post_mongo_entities(updates)
+    failed = len([s for s in results if s.get("status") != "success"])
+
+    logging.debug(f'Posted batch to MongoDB with {failed} failures')
+
+    return BSONResponse({
+        "received": len(updates),
+        "succeeded": len(updates) - failed,
+        "failed": failed,
+        "results": results
+    })
+
+async def queue_updates(updates: list[UpdateModel]) -> BSONResponse:
+    """
+    Validate a batch of updates and queue them for the flusher
+
+    Inputs:
+        updates: list[UpdateModel] to queue
+
+    Returns:
+        BSONResponse: 202 with per-item results, or 503 if nothing could be queued
+    """
+    results = list()
+    full = False
+
+    for i, update in enumerate(updates):
+        if not validate_update(update):
+            results.append({"index": i, "status": "error", "error": "Update could not be validated"})
+            continue
+
+        # Once the queue stays full the rest of the batch is refused
+        if full or not await INGEST_QUEUE.put(update, INGEST_PUT_TIMEOUT):
+            full = True
+            results.append({"index": i, "status": "error", "error": "Ingest queue is full"})
+            continue
+
+        results.append({"index": i, "status": "accepted"})
+
+    accepted = len([s for s in results if s.get("status") == "accepted"])
+
+    logging.debug(f'Queued {accepted} of {len(updates)} updates')
+
+    content = {
+        "received": len(updates),
+        "accepted": accepted,
+        "failed": len(updates) - accepted,
+        "results": results
+    }
+
+    if full and not accepted:
+        return BSONResponse(content, status_code=503, headers={"Retry-After": str(int(INGEST_FLUSH_INTERVAL) + 1)})
+
+    return BSONResponse(content, status_code=202)
+
+async def flush_queued_updates(updates: list[UpdateModel]) -> list[UpdateModel]:
+    """
+    Flush a batch of queued updates to MongoDB
+
+    Updates are coalesced per entity first, dropping any that repeat the
+    value queued before it for the same metric
+
+    Inputs:
+        updates: list[UpdateModel] taken off the ingest queue
+
+    Returns:
+        list[UpdateModel]: updates that failed and should be retried
+    """
+    coalesced = list()
+    previous = dict() # type: dict[tuple[str, str, str, str], str]
+
+    for update in updates:
+        key = (update.entity, update.type, update.source, update.metric)
+
+        if previous.get(key) == update.value:
+            continue
+
+        previous[key] = update.value
+        coalesced.append(update)
+
+    # Queued updates were validated when they were received
+    results = await post_mongo_entities(coalesced, validate=False)
+    failed = [s for s in results if s.get("status") != "success"]
+
+    if failed:
+        logging.warning(f'Failed to flush {len(failed)} of {len(coalesced)} queued updates: {failed[0].get("error")}')
+
+    logging.debug(f'Flushed {len(coalesced) - len(failed)} of {len(updates)} queued updates to MongoDB')
+
+    # Missing entities fail the same way every time
+    return [coalesced[s.get("index")] for s in failed if s.get("error") != ENTITY_MISSING]
+
+async def post_mongo_entities(updates: list[UpdateModel], validate: bool = True) -> list[dict]:
+    """
+    Post a batch of Entity Updates to MongoDB
+
+    Entities are looked up in the entity cache or one query, then entity
+    changes and their history are written with one unordered bulk_write per
+    collection. Only updates that change a metric are kept as history
+
+    Inputs:
+        updates: list[UpdateModel] to post
+        validate: bool whether to validate the updates first
+
+    Returns:
+        list[dict]: per-item results in input order ({index, status, error})
+    """
+    results = [{"index": i, "status": "pending"} for i in range(len(updates))]
+
+    def fail(indexes: list[int], error: str) -> None:
+        for i in indexes:
+            if results[i]["status"] == "pending":
+                results[i].update({"status": "error", "error": error})
+
+    # Validate and group by (entity, type), keeping input order
+    groups = dict() # type: dict[tuple[str, str], list[int]]
+    for i, update in enumerate(updates):
+        if validate and not validate_update(update):
+            fail([i], "Update could not be validated")
+            continue
+
+        groups.setdefault((update.entity, update.type), list()).append(i)
+
+    if not groups:
+        return results
+
+    # See if entities exist, in at most one round-trip
     try:
-        logging.info(f'Updating entity: {entity} for metric: {metric}')
+        mongo_entities = await get_mongo_metrics(list(groups))
 
-        res = MONGO_CLIENT["entities"].update_one({
-            '_id': mongo_entity.get("_id")
-        }, {
-            '$set': {
-                'metrics': db_metrics
-            }
-        })
+    except Exception as e:
+        logging.exception(f'Error finding entities for batch')
+        fail(range(len(updates)), "Could not query entities from MongoDB")
+        return results
 
-        if res.modified_count != 1: 
-            raise ValueError("Modification count not equal to 1")
+    # Build the operations, remembering which items each one covers
+    entity_ops, entity_items = list(), list()
+    buckets = dict() # type: dict[tuple[str, str, datetime], list[int]]
+    cache_writes = list()
 
-        return True 
-    
-    except Exception as e: 
-        logging.exception(f'Could not update metrics for entity: {entity}')
-        return False 
-    
-@app.get("/entities", response_model=list())
-async def get_entities(type: str = None):
-    logging.info(f'Received request on endpoint "/entities"')
+    for key, indexes in groups.items():
+        if key not in mongo_entities:
+            fail(indexes, ENTITY_MISSING)
+            continue
+
+        # Latest value per metric wins, earlier ones are only history
+        metrics = dict() # type: dict[tuple[str, str], list[int]]
+        for i in indexes:
+            metrics.setdefault((updates[i].source, updates[i].metric), list()).append(i)
+
+        for (source, metric), metric_indexes in metrics.items():
+            value = updates[metric_indexes[-1]].value
+            cache_writes.append((key, source, metric, value, metric_indexes))
+
+            # History is every update that differs from the one before it
+            previous = mongo_entities[key].get((source, metric))
+            for i in metric_indexes:
+                if updates[i].value == previous:
+                    continue
+
+                previous = updates[i].value
+                buckets.setdefault((*key, _bucket_start(updates[i].timestamp)), list()).append(i)
+
+            # Unchanged metrics need no write
+            if mongo_entities[key].get((source, metric)) == value:
+                continue
+
+            for filter, update, array_filters in _metric_ops(*key, source, metric, value):
+                entity_ops.append(UpdateOne(filter, update, array_filters=array_filters))
+                entity_items.append(metric_indexes)
+
+    # Entity changes, then the history of those that were written
+    await _bulk_write_items("entities", entity_ops, entity_items, fail)
+
+    update_ops, update_items = list(), list()
+    for (entity, type, start), bucket_indexes in buckets.items():
+        bucket_indexes = [i for i in bucket_indexes if results[i]["status"] == "pending"]
+
+        if not bucket_indexes:
+            continue
+
+        filter, update = _history_op(entity, type, [_history_change(updates[i].model_dump()) for i in bucket_indexes])
+        update_ops.append(UpdateOne(filter, update, upsert=True))
+        update_items.append(bucket_indexes)
+
+    await _bulk_write_items("updates", update_ops, update_items, fail)
+
+    UPDATES.labels("changed").inc(len([i for s in update_items for i in s if results[i]["status"] == "pending"]))
+
+    # Write through to the cache, dropping entities that partially failed
+    for key, source, metric, value, metric_indexes in cache_writes:
+        if all(results[i]["status"] == "pending" for i in metric_indexes):
+            ENTITY_CACHE.set_metric(key, source, metric, value)
+
+        else:
+            ENTITY_CACHE.invalidate(key)
+
+    # Everything not failed by now was written
+    for result in results:
+        if result["status"] == "pending":
+            result["status"] = "success"
+
+    return results
+
+async def _bulk_write_items(collection: str, ops: list, items: list[list[int]], fail: Callable[[list[int], str], None]) -> None:
+    """
+    Run an unordered bulk_write, failing the batch items of any operation that errored
+
+    Inputs:
+        collection: str name of the collection
+        ops: list of pymongo write operations
+        items: list[list[int]] of batch item indexes covered by each operation
+        fail: Callable to mark batch items as failed with an error
+    """
+    if not ops:
+        return
 
-    # Query
-    entities = None
     try:
-        entities = await get_mongo_entities(type)
+        with MONGO_LATENCY.labels(f'post_mongo_entities.{collection}').time():
+            await MONGO_CLIENT[collection].bulk_write(ops, ordered=False)
+
+    except BulkWriteError as e:
+        logging.warning(f'Partial failure writing batch to {collection}')
 
-        if entities is None or len(entities) == 0:
+        for error in e.details.get("writeErrors", list()):
+            fail(items[error.get("index")], error.get("errmsg", f'Could not write to {collection}'))
+
+    except Exception as e:
+        logging.exception(f'Could not write batch to {collection}')
+        fail([i for s in items for i in s], f'Could not write to {collection}')
+
+@app.get("/cache")
+async def get_cache():
+    """
+    Entity cache hit and miss counters
+    """
+    return BSONResponse(ENTITY_CACHE.stats())
+
+@app.get("/entities")
+async def get_entities(type: str = None, limit: int = Query(None, ge=1, le=ENTITIES_MAX_LIMIT), cursor: str = None, format: str = "json"):
+    """
+    Get entities
+
+    - type: only entities of this type (ie. host, website)
+    - limit: page size, the next page's cursor is returned in the X-Next-Cursor header
+    - cursor: opaque cursor from a previous page
+    - format: json list of entities, or ndjson to stream {entity, type} rows, a
+      final {error} row means the stream was cut off
+    """
+    logging.debug(f'Received request on endpoint "/entities"')
+
+    try:
+        after = _decode_cursor(cursor) if cursor else None
+
+    except Exception as e:
+        logging.warning(f'Invalid cursor received on /entities')
+        return BSONResponse({"error": "Invalid cursor"}, status_code=400)
+
+    type = _normalize_type(type)
+
+    # Stream rows straight from the Mongo cursor
+    if format == "ndjson":
+        logging.debug(f'Streaming {type} entities on /entities')
+
+        return StreamingResponse(_stream_entities(type, after, limit), media_type="application/x-ndjson")
+
+    # Query, one extra to know if there is a next page
+    entities = list()
+    headers = dict()
+    last = None # type: dict
+    try:
+        async for entity in iter_mongo_entities(type, after, limit + 1 if limit else None):
+            if limit and len(entities) == limit:
+                headers["X-Next-Cursor"] = _encode_cursor(last)
+                break
+
+            last = entity
+            entities.append(entity.get("entity"))
+
+        if not entities and after is None:
             raise ValueError("No entities found")
 
     except Exception as e:
         logging.exception(f'Failed to query entities from Mongo')
-        return {"error": "Failed to query entities from Mongo"}
+        return BSONResponse({"error": "Failed to query entities from Mongo"})
 
-    logging.debug(f'Received hosts from MongoDB')
+    logging.debug(f'Returned {len(entities)} {type} entities on /entities')
 
-    # Values need to be converted since BSON is dumb
-    logging.debug(f'Converting response to str forced')
-    entities = [str(s) for s in entities]
+    return BSONResponse(entities, headers=headers)
 
-    logging.info(f'Returned {type} entities on /entities')
+async def _stream_entities(type: str = None, after: tuple[str, str] = None, limit: int = None) -> AsyncIterator[bytes]:
+    """
+    Stream entities from MongoDB as NDJSON lines
 
-    return entities
+    Inputs:
+        type: str of entity type, None for all
+        after: tuple[str, str] of (entity, type) to resume after
+        limit: int of entities to stream, None for all
 
-async def get_mongo_entities(type: str = None) -> list[str]:
+    Returns:
+        AsyncIterator[bytes]: one JSON {entity, type} per line, ending with
+        an {"error": ...} line if Mongo failed part way
     """
-    Get Entities from MongoDB
-    
-    Inputs: 
-        type: str of entity type to get from Mongo
-        
-    Returns: 
-        list: of all hosts in MongoDB
+    try:
+        async for entity in iter_mongo_entities(type, after, limit):
+            yield orjson.dumps(entity, default=_bson_default) + b"\n"
+
+    # Headers are long gone, so say the stream is cut off in the body
+    except Exception as e:
+        logging.exception(f'Failed to stream entities from Mongo')
+        yield orjson.dumps({"error": "Failed to query entities from Mongo"}) + b"\n"
+
+def _normalize_type(type: str = None) -> str:
     """
-    logging.info(f'Getting mongo entities for type: {type}')
+    Normalize a requested entity type
+
+    Inputs:
+        type: str of entity type (ie. 'hosts', 'Website')
+
+    Returns:
+        str: host, website, the stripped type or None for all
+    """
+    if type is None:
+        return None
 
     # Small processing
-    type = type.strip().lower() 
-    type.replace('"', '')
+    type = type.strip().lower().replace('"', '')
 
     if "web" in type: 
         type = "website"
@@ -238,27 +782,293 @@ async def get_mongo_entities(type: str = None) -> list[str]:
     if "host" in type: 
         type = "host"
 
-    logging.debug(f'Querying Mongo')
+    return type or None
+
+def _encode_cursor(entity: dict) -> str:
+    """
+    Encode the last entity of a page into an opaque cursor
+
+    Inputs:
+        entity: dict of {entity, type}
+
+    Returns:
+        str: cursor
+    """
+    return urlsafe_b64encode(orjson.dumps([entity.get("entity"), entity.get("type")])).decode()
+
+def _decode_cursor(cursor: str) -> tuple[str, str]:
+    """
+    Decode an opaque cursor
+
+    Inputs:
+        cursor: str from _encode_cursor
 
-    # Type specified
+    Returns:
+        tuple[str, str]: (entity, type) to resume after
+
+    Raises:
+        ValueError: if the cursor is invalid
+    """
+    entity, type = orjson.loads(urlsafe_b64decode(cursor.encode()))
+
+    if not isinstance(entity, str) or not isinstance(type, str):
+        raise ValueError("Invalid cursor")
+
+    return entity, type
+
+async def iter_mongo_entities(type: str = None, after: tuple[str, str] = None, limit: int = None) -> AsyncIterator[dict]:
+    """
+    Iterate Entities from MongoDB in keyset order
+
+    Entities are ordered by (entity, type) so pages are served from the
+    entities indexes without skipping
+
+    Inputs:
+        type: str of entity type, None for all
+        after: tuple[str, str] of (entity, type) to resume after
+        limit: int of entities to return, None for all
+
+    Returns:
+        AsyncIterator[dict]: {entity, type} of each entity
+    """
+    logging.debug(f'Querying Mongo for {type} entities after {after}')
+
+    query = dict()
+
+    # Type specified, entity is unique within a type
     if type:
-        res = [host for host in MONGO_CLIENT["entities"].find({"type": type}, projection={'_id': False, 'entity': True})]
+        query["type"] = type
+        sort = [("entity", ASCENDING)]
+
+        if after:
+            query["entity"] = {"$gt": after[0]}
 
-    # No type, get al
+    # No type, get all
     else:
-        res = [host for host in MONGO_CLIENT["entities"].find(projection={'_id': False, 'entity': True})]
+        sort = [("entity", ASCENDING), ("type", ASCENDING)]
+
+        if after:
+            query["$or"] = [{"entity": {"$gt": after[0]}}, {"entity": after[0], "type": {"$gt": after[1]}}]
+
+    cursor = MONGO_CLIENT["entities"].find(query, projection={'_id': False, 'entity': True, 'type': True}, sort=sort, limit=limit or 0, batch_size=ENTITIES_BATCH_SIZE)
+
+    # Only time spent waiting on Mongo, not on whoever consumes the entities
+    elapsed = 0
+    start = perf_counter()
+
+    async for entity in cursor:
+        elapsed += perf_counter() - start
+        yield entity
+        start = perf_counter()
+
+    MONGO_LATENCY.labels("iter_mongo_entities.find").observe(elapsed + perf_counter() - start)
+
+async def ensure_mongo_indexes() -> None:
+    """
+    Create the indexes Necromancer queries rely on
+
+    Safe to run on every startup, existing indexes are left alone and the
+    updates retention is changed in place when UPDATES_RETENTION_DAYS changes
+    """
+    logging.info(f'Ensuring MongoDB indexes')
+
+    indexes = [
+        # One document per entity, used by every metric update
+        ("entities", [("entity", ASCENDING), ("type", ASCENDING)], {"name": "entity_type", "unique": True}),
+
+        # Listing entities by type, covers the entity projection
+        ("entities", [("type", ASCENDING), ("entity", ASCENDING)], {"name": "type_entity"}),
+
+        # One history bucket per entity per window, rows not yet compacted have no start
+        ("updates", [("entity", ASCENDING), ("type", ASCENDING), ("start", ASCENDING)], {"name": "entity_type_start", "unique": True, "partialFilterExpression": {"start": {"$exists": True}}}),
+    ]
+
+    for collection, keys, options in indexes:
+        try:
+            await MONGO_CLIENT[collection].create_index(keys, **options)
+
+        # Existing data can break a unique index, keep serving and say so
+        except OperationFailure as e:
+            logging.error(f'Could not create index {options.get("name")} on {collection}, queries on it may be slow and duplicates are not prevented until existing duplicates are removed: {e}')
+
+        except Exception as e:
+            logging.exception(f'Could not create index {options.get("name")} on {collection}')
+
+    # Retention on updates through a TTL index, buckets expire after their window ends
+    try:
+        existing = await MONGO_CLIENT["updates"].index_information()
+        ttl = existing.get("end_ttl")
+
+        if UPDATES_RETENTION_DAYS:
+            seconds = int(float(UPDATES_RETENTION_DAYS) * 86400)
+
+            if ttl is None:
+                await MONGO_CLIENT["updates"].create_index([("end", ASCENDING)], name="end_ttl", expireAfterSeconds=seconds)
+
+            elif ttl.get("expireAfterSeconds") != seconds:
+                await MONGO_CLIENT.command("collMod", "updates", index={"name": "end_ttl", "expireAfterSeconds": seconds})
+
+            logging.info(f'Updates are kept for {UPDATES_RETENTION_DAYS} days')
+
+        elif ttl is not None:
+            await MONGO_CLIENT["updates"].drop_index("end_ttl")
+
+            logging.info(f'Removed retention on updates')
+
+    except Exception as e:
+        logging.exception(f'Could not apply retention to updates')
+
+    logging.debug(f'MongoDB indexes are in place')
+
+def _plan_stages(plan: dict) -> list[str]:
+    """
+    Flatten a Mongo query plan into its stage names, outermost first
+
+    Inputs:
+        plan: dict of a winningPlan from explain
 
-    # Get just the value 
-    returnables = list() 
-    for dict in res: 
-        returnables.extend(dict.values())
+    Returns:
+        list[str]: stage names (ie. ['PROJECTION_COVERED', 'IXSCAN'])
+    """
+    stages = [plan.get("stage")]
+
+    for child in [plan.get("inputStage")] + plan.get("inputStages", list()):
+        if child:
+            stages.extend(_plan_stages(child))
+
+    return stages
+
+async def report_mongo_indexes() -> dict:
+    """
+    Report index usage and whether Necromancer's queries are covered
+
+    Returns:
+        dict: {
+            "indexes": {collection: [{name, key, ops, since}]},
+            "queries": {query: {stages, index, covered}}
+        }
+    """
+    report = {"indexes": dict(), "queries": dict()}
+
+    for collection in ["entities", "updates"]:
+        report["indexes"][collection] = [{
+            "name": s.get("name"),
+            "key": s.get("key"),
+            "ops": s.get("accesses", dict()).get("ops"),
+            "since": s.get("accesses", dict()).get("since")
+        } async for s in await MONGO_CLIENT[collection].aggregate([{"$indexStats": {}}])]
+
+    # Shapes of the queries made on the hot paths
+    queries = {
+        "entities by entity, type": MONGO_CLIENT["entities"].find({"entity": "", "type": ""}),
+        "entities by type": MONGO_CLIENT["entities"].find({"type": ""}, projection={'_id': False, 'entity': True, 'type': True}).sort("entity", ASCENDING),
+        "updates by entity, type": MONGO_CLIENT["updates"].find({"entity": "", "type": ""}).sort("start", ASCENDING)
+    }
+
+    for name, cursor in queries.items():
+        plan = (await cursor.explain()).get("queryPlanner", dict()).get("winningPlan", dict())
+        stages = _plan_stages(plan.get("queryPlan", plan))
+
+        report["queries"][name] = {
+            "stages": stages,
+            "index": "COLLSCAN" not in stages,
+            "covered": "COLLSCAN" not in stages and "FETCH" not in stages
+        }
+
+    return report
+
+async def compact_mongo_updates(batch_size: int = 1000) -> dict:
+    """
+    Convert per-update rows in the updates collection into history buckets
+
+    One-off job for updates written before history was bucketed. Rows are
+    read per metric in timestamp order, rows that repeat the previous value
+    are dropped and the rest are appended to their bucket. Converted rows are
+    deleted a batch at a time once their buckets are written
+
+    Inputs:
+        batch_size: int of rows to convert per bulk_write
+
+    Returns:
+        dict: {rows, changes, dropped}
+    """
+    logging.info(f'Compacting updates into buckets')
+
+    counts = {"rows": 0, "changes": 0, "dropped": 0}
+    updates = MONGO_CLIENT["updates"]
 
-    logging.debug(f'Found {len(returnables)} hosts in MongoDB')
+    # Old rows carry a metric, buckets do not
+    cursor = updates.find(
+        {"metric": {"$exists": True}},
+        sort=[("entity", ASCENDING), ("source", ASCENDING), ("metric", ASCENDING), ("timestamp", ASCENDING)],
+        batch_size=batch_size,
+        allow_disk_use=True
+    )
 
-    return returnables
+    current = None
+    previous = dict() # type: dict[tuple, str]
+    buckets = dict() # type: dict[tuple[str, str, datetime], list[dict]]
+    row_ids = list()
+
+    async def flush() -> None:
+        ops = [UpdateOne(*_history_op(entity, type, changes), upsert=True) for (entity, type, start), changes in buckets.items()]
+
+        if ops:
+            await updates.bulk_write(ops, ordered=False)
+
+        await updates.delete_many({"_id": {"$in": row_ids}})
+
+        buckets.clear()
+        row_ids.clear()
+
+    async for row in cursor:
+        counts["rows"] += 1
+        row_ids.append(row.get("_id"))
+
+        key = (row.get("entity"), row.get("type"), row.get("source"), row.get("metric"))
+
+        # Only the last values of the current metric are needed
+        if (key[0], key[2], key[3]) != current:
+            current = (key[0], key[2], key[3])
+            previous.clear()
+
+        # Same value as the row before it
+        if key in previous and previous[key] == row.get("value"):
+            counts["dropped"] += 1
+
+        else:
+            previous[key] = row.get("value")
+            buckets.setdefault((key[0], key[1], _bucket_start(row.get("timestamp"))), list()).append(_history_change(row))
+            counts["changes"] += 1
+
+        if len(row_ids) >= batch_size:
+            await flush()
+
+    await flush()
+
+    # Indexes of the per-update rows are no longer used
+    existing = await updates.index_information()
+    for name in ["entity_source_metric_timestamp", "timestamp_ttl"]:
+        if name in existing:
+            await updates.drop_index(name)
+
+    logging.info(f'Compacted {counts["rows"]} updates into {counts["changes"]} changes')
+
+    return counts
 
 if __name__ == "__main__":
     if MONGO_DB is None or MONGO_URL is None:
         raise ValueError("Could not locate Mongo ENV variables")
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    parser = argparse.ArgumentParser(description="Necromancer backend API")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "indexes", "compact"], help="serve the API (default), report index usage or compact updates into buckets")
+    args = parser.parse_args()
+
+    if args.command == "indexes":
+        print(json.dumps(asyncio.run(report_mongo_indexes()), indent=4, default=str))
+
+    elif args.command == "compact":
+        print(json.dumps(asyncio.run(compact_mongo_updates()), indent=4, default=str))
+
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
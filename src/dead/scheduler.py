@@ -0,0 +1,279 @@
+from collections import deque
+from souls.default import Producer
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import time
+
+# Worker processes start from a clean server process, never forked from soul
+# while its sweep threads may hold locks (logging, sqlite)
+_CONTEXT = multiprocessing.get_context("forkserver")
+
+
+def run_job(producer: type[Producer], type: str, entities: list[str], kwargs: dict) -> list[dict]:
+    """
+    Run one producer over its targets
+
+    Top level so it can be sent to a worker process, fresh cached results are
+    reused instead of running the producer again
+
+    Inputs:
+        producer: Producer subclass to run
+        type: str type of entity
+        entities: list[str] to run the producer over, one unless it batches
+        kwargs: dict of extra producer arguments
+
+    Returns:
+        list[dict]: updates in the form to post to Necro
+    """
+    return producer.produce(type, entities, **kwargs)
+
+
+def _run_in_process(conn: multiprocessing.connection.Connection, producer: type[Producer], type: str, entities: list[str], kwargs: dict) -> None:
+    """
+    Run a job in a worker process, sending back its updates or why it failed
+
+    The worker leads its own process group, so stopping it also stops the
+    subprocesses it started (ie. nmap)
+    """
+    os.setpgid(0, 0)
+
+    try:
+        conn.send((run_job(producer, type, entities, kwargs), None))
+
+    except Exception as e:
+        conn.send((None, str(e)))
+
+    finally:
+        conn.close()
+
+
+class Job():
+    """
+    Job
+
+    One producer run over a batch of targets, on a daemon thread or in its
+    own worker process. A thread that overruns is left behind without
+    holding up the sweep or soul's exit, a process is killed along with
+    everything it started
+    """
+
+    def __init__(self, producer: type[Producer], type: str, entities: list[str], kwargs: dict, pool: str) -> None:
+        """
+        Create a Job, nothing runs until start
+
+        Inputs:
+            producer: Producer subclass to run
+            type: str type of entity
+            entities: list[str] to run the producer over
+            kwargs: dict of extra producer arguments
+            pool: str of 'thread' or 'process'
+        """
+        self.producer = producer
+        self.label = entities[0] if len(entities) == 1 else f'{len(entities)} targets'
+        self.started = None # type: float
+
+        self._args = (producer, type, entities, kwargs)
+        self._pool = pool
+        self._process = None # type: multiprocessing.process.BaseProcess
+
+    def start(self, done: queue.Queue) -> None:
+        """
+        Start the job, its (job, updates, error) is put on done when it ends
+
+        Inputs:
+            done: queue.Queue shared by the sweep's jobs
+        """
+        self.started = time.monotonic()
+
+        if self._pool == "process":
+            receiver, sender = _CONTEXT.Pipe(duplex=False)
+
+            self._process = _CONTEXT.Process(target=_run_in_process, args=(sender, *self._args), daemon=True)
+            self._process.start()
+            sender.close()
+
+            target, args = self._wait_process, (receiver, done)
+
+        else:
+            target, args = self._run_thread, (done,)
+
+        threading.Thread(target=target, args=args, name=f'{self.producer.__name__} {self.label}', daemon=True).start()
+
+    def _run_thread(self, done: queue.Queue) -> None:
+        try:
+            done.put((self, run_job(*self._args), None))
+
+        except Exception as e:
+            done.put((self, None, str(e)))
+
+    def _wait_process(self, receiver: multiprocessing.connection.Connection, done: queue.Queue) -> None:
+        # Read before joining, a worker with a large result waits for it to be read
+        try:
+            updates, error = receiver.recv()
+
+        except EOFError:
+            updates, error = None, "worker process exited without a result"
+
+        finally:
+            receiver.close()
+
+        self._process.join()
+        done.put((self, updates, error))
+
+    def stop(self) -> None:
+        """
+        Stop the job, killing its process and everything it started. A thread
+        can't be stopped and is left to finish on its own
+        """
+        if self._process is None or not self._process.is_alive():
+            return
+
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+
+        # Stopped before it got its own group
+        except (ProcessLookupError, PermissionError):
+            self._process.kill()
+
+
+class Scheduler():
+    """
+    Producer Scheduler
+
+    Fans (producer, target) jobs out with a bounded number running per
+    producer, on threads for I/O producers and in worker processes for CPU
+    or subprocess heavy ones. Producers that batch get a single job over
+    every target instead
+
+    A sweep takes about as long as its slowest job rather than the sum of them
+    """
+
+    def __init__(self, poll_interval: float = 0.5) -> None:
+        """
+        Create a Scheduler
+
+        Inputs:
+            poll_interval: float of seconds between checks for timed out jobs
+        """
+        self._producers = dict() # type: dict[type[Producer], dict]
+        self._poll_interval = poll_interval
+        self._cancelled = threading.Event()
+
+    def add(self, producer: type[Producer], kwargs: dict = None, pool: str = None, concurrency: int = None, timeout: float = None) -> None:
+        """
+        Add a producer to run over every target
+
+        Defaults come from the producer class (pool, concurrency, timeout)
+
+        Inputs:
+            producer: Producer subclass to run
+            kwargs: dict of extra producer arguments
+            pool: str of 'thread' or 'process', producers that can hang should use processes
+            concurrency: int of jobs of this producer to run at once
+            timeout: float of seconds a single job may run
+        """
+        pool = pool or producer.pool
+
+        if pool not in ["thread", "process"]:
+            raise ValueError(f'Invalid pool {pool} for {producer.__name__}')
+
+        self._producers[producer] = {
+            "kwargs": kwargs or dict(),
+            "pool": pool,
+            "concurrency": max(1, concurrency or producer.concurrency),
+            "timeout": timeout or producer.timeout
+        }
+
+        logging.debug(f'Scheduled producer {producer.__name__} on a {pool} pool')
+
+    def cancel(self) -> None:
+        """
+        Cancel the running sweep, queued jobs are dropped and running ones stopped
+        """
+        logging.warning(f'Cancelling producer sweep')
+        self._cancelled.set()
+
+    def run(self, type: str, targets: list[str]) -> list[dict]:
+        """
+        Run every producer over every target
+
+        A job that times out gives up its slot to the next one, its process
+        is killed and its thread left behind
+
+        Inputs:
+            type: str type of the targets
+            targets: list[str] of entities
+
+        Returns:
+            list[dict]: updates from every job that finished in time
+        """
+        self._cancelled.clear()
+
+        queued = dict() # type: dict[type[Producer], deque[Job]]
+        for producer, settings in self._producers.items():
+            batches = [targets] if producer.batch else [[s] for s in targets]
+            queued[producer] = deque(Job(producer, type, s, settings["kwargs"], settings["pool"]) for s in batches)
+
+        logging.info(f'Running {sum(len(s) for s in queued.values())} jobs for {len(self._producers)} producers over {len(targets)} targets')
+
+        updates = list()
+        done = queue.Queue() # type: queue.Queue[tuple[Job, list[dict], str]]
+        running = dict() # type: dict[type[Producer], set[Job]]
+
+        try:
+            while not self._cancelled.is_set():
+                # Fill every producer's free slots
+                for producer, jobs in queued.items():
+                    slots = running.setdefault(producer, set())
+
+                    while jobs and len(slots) < self._producers[producer]["concurrency"]:
+                        job = jobs.popleft()
+                        job.start(done)
+                        slots.add(job)
+
+                if not any(running.values()):
+                    break
+
+                try:
+                    job, results, error = done.get(timeout=self._poll_interval)
+
+                    # Timed out jobs have already given up their slot
+                    if job in running[job.producer]:
+                        running[job.producer].discard(job)
+
+                        if error is None:
+                            updates.extend(results or list())
+                        else:
+                            logging.warning(f'{job.producer.__name__} failed for {job.label}: {error}')
+
+                    continue
+
+                except queue.Empty:
+                    pass
+
+                now = time.monotonic()
+                for producer, jobs in running.items():
+                    for job in list(jobs):
+                        if now - job.started > self._producers[producer]["timeout"]:
+                            logging.warning(f'{producer.__name__} timed out for {job.label}')
+
+                            job.stop()
+                            jobs.discard(job)
+
+        finally:
+            dropped = sum(len(s) for s in queued.values()) + sum(len(s) for s in running.values())
+
+            if dropped:
+                logging.warning(f'Dropped {dropped} jobs that did not finish')
+
+            for job in [s for jobs in running.values() for s in jobs]:
+                job.stop()
+
+        logging.info(f'Finished sweep with {len(updates)} updates')
+
+        return updates
@@ -1,15 +1,20 @@
 import logging 
 import requests 
 
-from souls.crowdsec_producer import Crowdsec
-from souls.nmap_producer import NMAP
-
-from souls.default import Producer
+from souls import registry
+from souls.result_cache import get_result_cache
+from scheduler import Scheduler
 
 # TODO: Change from local
 NECRO_API = "http://0.0.0.0:8000"
 
-def get_targets(type: str) -> list[dict]: 
+# Targets are fetched from Necromancer a page at a time
+NECRO_PAGE_SIZE = 1000
+
+# Updates are posted to Necromancer a batch at a time
+NECRO_BATCH_SIZE = 1000
+
+def get_targets(type: str) -> list[str]: 
     """
     Get targets from Necromancer API that are of type specified
 
@@ -17,19 +22,35 @@ def get_targets(type: str) -> list[dict]:
         type: str of entities (e.g. website) 
 
     Returns: 
-        list[dict] of target entities 
+        list[str] of target entities 
     """
     type = type.strip().lower()
 
     logging.info(f'Getting targets from Necromancer')
 
     try:
-        res = requests.get(f'{NECRO_API}/entities?type={type}')
+        targets = list()
+        params = {"type": type, "limit": NECRO_PAGE_SIZE}
+
+        # Follow the cursor until the last page
+        while True:
+            res = requests.get(f'{NECRO_API}/entities', params=params)
+
+            if res.status_code != 200: 
+                raise ValueError("Non 200 status code returned")
+
+            page = res.json()
+
+            if not isinstance(page, list):
+                raise ValueError(f'Necromancer returned an error: {page}')
 
-        if res.status_code != 200: 
-            raise ValueError("Non 200 status code returned")
+            targets.extend(page)
 
-        targets = res.json() 
+            cursor = res.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+            params["cursor"] = cursor
 
         if len(targets) < 1: 
             raise ValueError("Did not get any targets from Necromancer")
@@ -43,26 +64,142 @@ def get_targets(type: str) -> list[dict]:
         return None 
     
 
-def get_updates(): 
-    pass 
+def get_updates(type: str, targets: list[str]) -> list[dict]: 
+    """
+    Run every enabled producer over every target
+
+    Producers are only imported here, as their jobs are scheduled
+
+    Inputs:
+        type: str of entities (e.g. host)
+        targets: list[str] of entities
+
+    Returns:
+        list[dict] of updates to post to Necromancer
+    """
+    names = registry.enabled()
 
-def post_updates(): 
-    pass 
+    logging.info(f'Enabled {len(names)} producers: {names}')
+
+    scheduler = Scheduler()
+    for name in names:
+        try:
+            producer = registry.load(name)
+
+        except Exception as e:
+            logging.exception(f'Unable to load producer {name}')
+            continue
+
+        scheduler.add(producer, producer.settings())
+
+    # What the producers cost to import altogether, each is logged as it loads
+    stats = registry.stats()
+    seconds = sum(s["import_seconds"] for s in stats.values())
+    resident = sum(s["import_rss_bytes"] or 0 for s in stats.values())
+
+    logging.info(f'Imported {len(stats)} producers in {seconds * 1000:.1f}ms, adding {resident / 1024 / 1024:.1f}MiB resident')
+
+    try:
+        return scheduler.run(type, targets)
+
+    except KeyboardInterrupt:
+        scheduler.cancel()
+        raise
+
+def post_updates(updates: list[dict]) -> bool: 
+    """
+    Post updates to Necromancer in batches
+
+    Only the runs whose updates Necromancer accepted are marked as posted,
+    the rest are posted again by replay_updates
+
+    Inputs:
+        updates: list[dict] of updates
+
+    Returns:
+        bool: whether every update was accepted
+    """
+    logging.info(f'Posting {len(updates)} updates to Necromancer')
+
+    cache = get_result_cache()
+
+    # (entity, source) of the runs with updates Necromancer took and refused
+    accepted = set()
+    failed = set()
+
+    ok = True
+    for i in range(0, len(updates), NECRO_BATCH_SIZE):
+        batch = updates[i:i + NECRO_BATCH_SIZE]
+
+        try:
+            res = requests.post(f'{NECRO_API}/entities/batch', json=batch)
+
+            if res.status_code not in [200, 202]: 
+                raise ValueError(f'Received status code {res.status_code}')
+
+            results = res.json().get("results")
+
+            if not isinstance(results, list):
+                raise ValueError(f'Necromancer returned an error: {res.json()}')
+
+        except Exception as e: 
+            logging.exception(f'Unable to post updates to Necromancer')
+            ok = False
+            failed.update((s.get("entity"), s.get("source")) for s in batch)
+            continue
+
+        # Written straight away or queued for writing
+        succeeded = {s.get("index") for s in results if s.get("status") in ["success", "accepted"]}
+
+        if len(succeeded) < len(batch):
+            logging.warning(f'Necromancer refused {len(batch) - len(succeeded)} of {len(batch)} updates, they are kept to post again')
+            ok = False
+
+        for j, update in enumerate(batch):
+            (accepted if j in succeeded else failed).add((update.get("entity"), update.get("source")))
+
+    # A run is only posted once every one of its updates was, in whichever batch
+    if cache is not None:
+        cache.mark_posted([{"entity": s[0], "source": s[1]} for s in accepted - failed])
+
+    return ok
+
+def replay_updates() -> bool:
+    """
+    Post cached results that never reached Necromancer, ie. from a run that
+    crashed or failed to post
+
+    Returns:
+        bool: whether every batch was accepted
+    """
+    cache = get_result_cache()
+
+    if cache is None:
+        return True
+
+    updates = cache.unposted()
+
+    if not updates:
+        return True
+
+    logging.info(f'Replaying {len(updates)} unposted updates')
+
+    return post_updates(updates)
 
 def main(): 
     logging.info(f'Starting SOUL Producer')
 
+    replay_updates()
+
     logging.info(f'Getting targets') 
     targets = get_targets("hosts") 
 
-    # global producers
-    # producers = Producer.__subclasses__()
-    
-    # pretty_producers = [s.__module__.split(".")[1].capitalize() for s in producers]
+    if not targets:
+        return
 
-    # logging.info(f'Found {len(pretty_producers)} producers: {pretty_producers}')
+    updates = get_updates("host", targets)
 
-    pass 
+    post_updates(updates)
 
 if __name__ == "__main__": 
     main() 
@@ -0,0 +1,159 @@
+import ipaddress
+import logging
+import requests
+import threading
+import time
+
+
+class DecisionMirror():
+    """
+    Crowdsec Decision Mirror
+
+    Local copy of every LAPI decision, pulled once from /v1/decisions/stream
+    with startup=true and then kept up to date from its deltas
+
+    Ip and Range decisions are indexed per address family by prefix length,
+    so checking an entity is at most one set lookup per prefix length in use
+    """
+
+    def __init__(self, crowdsec_lapi_url: str, crowdsec_lapi_key: str, refresh_interval: float, timeout: float) -> None:
+        """
+        Create a Decision Mirror, nothing is pulled until refresh
+
+        Inputs:
+            crowdsec_lapi_url: str of Crowdsec LAPI to connect to
+            crowdsec_lapi_key: str of Crowdsec Key to use with LAPI
+            refresh_interval: float of seconds between delta pulls
+            timeout: float of seconds per LAPI request
+        """
+        self._url = crowdsec_lapi_url
+        self._refresh_interval = refresh_interval
+        self._timeout = timeout
+
+        self._session = requests.Session()
+        self._session.headers.update({"X-Api-Key": crowdsec_lapi_key})
+
+        # {version: {prefix length: {network as int: {decision ids}}}}
+        self._networks = {4: dict(), 6: dict()} # type: dict[int, dict[int, dict[int, set]]]
+        self._decisions = dict() # type: dict[int, tuple[int, int, int]]
+
+        self._lock = threading.Lock()
+        self._refreshed = None # type: float
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Pull decisions from LAPI, everything on the first call then only deltas
+
+        Calls within the refresh interval of the last pull do nothing
+
+        Inputs:
+            force: bool to pull even within the refresh interval
+
+        Raises:
+            requests.RequestException: if LAPI could not be reached
+        """
+        with self._lock:
+            if not force and self._refreshed is not None and time.monotonic() - self._refreshed < self._refresh_interval:
+                return
+
+            startup = self._refreshed is None
+
+            res = self._session.get(f'{self._url}v1/decisions/stream', params={"startup": "true" if startup else "false"}, timeout=self._timeout)
+            res.raise_for_status()
+
+            stream = res.json() or dict()
+            self._apply(stream.get("new") or list(), stream.get("deleted") or list())
+            self._refreshed = time.monotonic()
+
+        logging.debug(f'Refreshed Crowdsec decision mirror, {len(self._decisions)} decisions')
+
+    def _apply(self, new: list[dict], deleted: list[dict]) -> None:
+        """
+        Apply a decisions stream delta, caller holds the lock
+
+        Inputs:
+            new: list[dict] of decisions to add
+            deleted: list[dict] of decisions to remove
+        """
+        # A re-sent decision replaces the one with the same id
+        for decision in deleted + new:
+            entry = self._decisions.pop(decision.get("id"), None)
+
+            if entry is None:
+                continue
+
+            version, prefixlen, network = entry
+            ids = self._networks[version][prefixlen][network]
+            ids.discard(decision.get("id"))
+
+            if not ids:
+                del self._networks[version][prefixlen][network]
+
+            if not self._networks[version][prefixlen]:
+                del self._networks[version][prefixlen]
+
+        for decision in new:
+            # Country and AS scopes can't be checked against an address
+            if str(decision.get("scope")).lower() not in ["ip", "range"]:
+                continue
+
+            try:
+                network = ipaddress.ip_network(decision.get("value"), strict=False)
+
+            except ValueError:
+                logging.warning(f'Skipping Crowdsec decision with invalid value {decision.get("value")}')
+                continue
+
+            entry = (network.version, network.prefixlen, int(network.network_address))
+            self._decisions[decision.get("id")] = entry
+            self._networks[entry[0]].setdefault(entry[1], dict()).setdefault(entry[2], set()).add(decision.get("id"))
+
+    def lookup(self, entity: str) -> bool:
+        """
+        Check if an address is covered by a decision
+
+        Inputs:
+            entity: str of an IPv4 or IPv6 address
+
+        Returns:
+            bool: whether the address is banned
+        """
+        address = ipaddress.ip_address(entity)
+        bits = address.max_prefixlen
+        value = int(address)
+
+        with self._lock:
+            for prefixlen, networks in self._networks[address.version].items():
+                if (value >> (bits - prefixlen)) << (bits - prefixlen) in networks:
+                    return True
+
+        return False
+
+    def __len__(self) -> int:
+        return len(self._decisions)
+
+
+_MIRRORS = dict() # type: dict[tuple[str, str], DecisionMirror]
+_MIRRORS_LOCK = threading.Lock()
+
+
+def get_mirror(crowdsec_lapi_url: str, crowdsec_lapi_key: str, refresh_interval: float, timeout: float) -> DecisionMirror:
+    """
+    Get the process wide mirror of a LAPI, creating it on first use
+
+    Inputs:
+        crowdsec_lapi_url: str of Crowdsec LAPI to connect to
+        crowdsec_lapi_key: str of Crowdsec Key to use with LAPI
+        refresh_interval: float of seconds between delta pulls
+        timeout: float of seconds per LAPI request
+
+    Returns:
+        DecisionMirror: shared by every producer using this LAPI
+    """
+    with _MIRRORS_LOCK:
+        key = (crowdsec_lapi_url, crowdsec_lapi_key)
+
+        if key not in _MIRRORS:
+            _MIRRORS[key] = DecisionMirror(crowdsec_lapi_url, crowdsec_lapi_key, refresh_interval, timeout)
+
+        return _MIRRORS[key]
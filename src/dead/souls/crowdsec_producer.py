@@ -1,88 +1,277 @@
 from souls.default import Producer
+from souls.crowdsec_mirror import get_mirror
+from os import getenv
+import asyncio
+import httpx
+import random
 import requests
 import json
 import logging
 
+# Async lookups, one pooled keep-alive client shared across all targets
+CROWDSEC_CONCURRENCY = int(getenv("CROWDSEC_CONCURRENCY", 64))
+CROWDSEC_TIMEOUT = float(getenv("CROWDSEC_TIMEOUT", 10))
+CROWDSEC_RETRIES = int(getenv("CROWDSEC_RETRIES", 3))
+CROWDSEC_BACKOFF = float(getenv("CROWDSEC_BACKOFF", 0.25))
+
+# Check entities against a local mirror of LAPI decisions instead of one request each
+CROWDSEC_MIRROR = getenv("CROWDSEC_MIRROR", "true").lower() in ["1", "true", "yes"]
+CROWDSEC_MIRROR_INTERVAL = float(getenv("CROWDSEC_MIRROR_INTERVAL", 60))
+
+# Seconds a lookup is reused for after a restart, decisions expire quickly
+CROWDSEC_CACHE_TTL = float(getenv("CROWDSEC_CACHE_TTL", 300))
+
 
 class Crowdsec(Producer):
     """
-    Initialize a Crowdsec Producer 
+    Initialize a Crowdsec Producer
 
-    Takes in an entity and searches it's status on Crowdsec LAPI (free one)
+    Takes in an entity and searches it's status on Crowdsec LAPI (free one),
+    through a local mirror of LAPI decisions unless CROWDSEC_MIRROR is off
 
-    Returns the metric: 
+    Many entities are looked up concurrently over one shared client with
+    query_many
+
+    Returns the metric:
         - Status (whether banned or not)
     """
 
+    # Lookups are network bound, batched they all share one client or the mirror
+    pool = "thread"
+    concurrency = 16
+    timeout = 300
+    batch = True
+
+    source = "Crowdsec"
+    cache_ttl = CROWDSEC_CACHE_TTL
+
+    @classmethod
+    def settings(cls) -> dict:
+        """
+        Crowdsec LAPI from CROWDSEC_LAPI_URL and CROWDSEC_LAPI_KEY
+        """
+        return {
+            "crowdsec_lapi_url": getenv("CROWDSEC_LAPI_URL"),
+            "crowdsec_lapi_key": getenv("CROWDSEC_LAPI_KEY")
+        }
+
     def __init__(self, type: str, entity: str, crowdsec_lapi_url: str, crowdsec_lapi_key: str) -> None:
         """
-        Create a Crowdsec Producer 
+        Create a Crowdsec Producer, nothing is queried until run
 
-        Input: 
-            entity: str to scan 
+        Input:
+            entity: str to scan
             type: str type of entity
             crowdsec_lapi_url: str of Crowdsec LAPI to connect to
             crowdsec_lapi_key: str of Crowdsec Key to use with LAPI
-        """
 
-        # Target only ipv4
-        if not self.is_ip() or self.is_ipv6():
-            logging.exception(f'Crowdsec Producer only supports ipv4')
-            return None
+        Raises:
+            ValueError: if the entity isn't an ip or the LAPI settings are missing
+        """
+        super().__init__(entity, type, self.source)
 
-        super().__init__(entity, type, "Crowdsec")
+        # Target only ips, ipv4 or ipv6
+        if not self.is_ip():
+            raise ValueError(f'Crowdsec Producer only supports ips')
 
         if None in [crowdsec_lapi_key, crowdsec_lapi_url]:
-            logging.exception(f'Invalid Crowdsec LAPI Key/URL')
-            return None
+            raise ValueError(f'Invalid Crowdsec LAPI Key/URL')
 
         self._crowdsec_lapi_url = crowdsec_lapi_url
         self._crowdsec_lapi_key = crowdsec_lapi_key
 
-        logging.info(f'Initialized Crowdsec scanner for {entity}')
+        logging.debug(f'Initialized Crowdsec scanner for {entity}')
 
-        try:
-            res = self.query()
+    def run(self) -> list[dict]:
+        """
+        Query Crowdsec for the entity
 
-            # Add to inventory
-            self.add_update("Status", res)
+        Returns:
+            list[dict]: the Status update
+        """
+        self.add_update("Status", self.query())
 
-        except:
-            logging.exception(f'Unable to create update')
-            return None
+        logging.info(f'Finished Crowdsec producer for {self._entity}')
 
-        logging.info(f'Finished Crowdsec producer for {entity}')
+        return self.get_updates()
 
-    def query(self) -> str:
+    async def arun(self, client: httpx.AsyncClient = None) -> list[dict]:
         """
-        Query Crowdsec for entity 
+        Query Crowdsec for the entity without blocking
+
+        Inputs:
+            client: httpx.AsyncClient pointed at the LAPI, one is created if not given
+
+        Returns:
+            list[dict]: the Status update
         """
-        crowdsec_enrich = None
-        try:
-            crowdsec_enrich = requests.get(
-                f"{self._crowdsec_lapi_url}v1/decisions?ip={self._entity}", headers={"X-Api-Key": self._crowdsec_lapi_key}
-            )
+        if CROWDSEC_MIRROR:
+            mirror = self.mirror()
+            await asyncio.to_thread(mirror.refresh)
+
+            self.add_update("Status", "Banned" if mirror.lookup(self._entity) else "Not Banned")
 
-            logging.info(f'Scanned Crowdsec successfully for {self._entity}')
+        elif client is None:
+            async with httpx.AsyncClient(base_url=self._crowdsec_lapi_url, headers={"X-Api-Key": self._crowdsec_lapi_key}, timeout=CROWDSEC_TIMEOUT) as client:
+                self.add_update("Status", await self.aquery(client))
 
-            if crowdsec_enrich is None:
-                raise ValueError("Did not receive a response from Crowdsec")
+        else:
+            self.add_update("Status", await self.aquery(client))
 
-            if crowdsec_enrich.status_code != 200:
-                raise requests.ConnectionError(f'Received status code {
-                                               crowdsec_enrich.status_code}')
+        return self.get_updates()
 
-            if crowdsec_enrich.content == b"null":
-                raise ValueError("Received invalid content")
+    @classmethod
+    def run_many(cls, type: str, entities: list[str], crowdsec_lapi_url: str, crowdsec_lapi_key: str) -> list[dict]:
+        """
+        Look up every entity at once, see query_many
+
+        Returns:
+            list[dict]: Status updates of every entity that was looked up
+        """
+        producers = asyncio.run(cls.query_many(type, entities, crowdsec_lapi_url, crowdsec_lapi_key))
 
-        except:
-            logging.exception(f'Failed to query Crowdsec')
+        return [update for producer in producers for update in producer.get_updates() or list()]
+
+    @staticmethod
+    def _status(content: bytes) -> str:
+        """
+        Turn a LAPI decisions response into a status
 
-        # Basically just returns blank if entity is not in "inventory"
-        if len(json.loads(crowdsec_enrich.content)):
+        Inputs:
+            content: bytes of the /v1/decisions response
+
+        Returns:
+            str: Banned or Not Banned
+        """
+        # LAPI returns null if entity is not in "inventory"
+        if json.loads(content):
             return "Banned"
 
         return "Not Banned"
 
-    def test_query(self): 
-        pass 
+    def mirror(self):
+        """
+        Get the decision mirror of this producer's LAPI
+
+        Returns:
+            DecisionMirror: shared by every producer using the LAPI
+        """
+        return get_mirror(self._crowdsec_lapi_url, self._crowdsec_lapi_key, CROWDSEC_MIRROR_INTERVAL, CROWDSEC_TIMEOUT)
+
+    def query(self) -> str:
+        """
+        Query Crowdsec for entity
+
+        Raises:
+            requests.ConnectionError: if Crowdsec did not answer with a 200
+        """
+        if CROWDSEC_MIRROR:
+            mirror = self.mirror()
+            mirror.refresh()
+
+            return "Banned" if mirror.lookup(self._entity) else "Not Banned"
+
+        crowdsec_enrich = requests.get(
+            f"{self._crowdsec_lapi_url}v1/decisions", params={"ip": self._entity}, headers={"X-Api-Key": self._crowdsec_lapi_key}, timeout=CROWDSEC_TIMEOUT
+        )
+
+        if crowdsec_enrich.status_code != 200:
+            raise requests.ConnectionError(f'Received status code {crowdsec_enrich.status_code}')
+
+        logging.debug(f'Scanned Crowdsec successfully for {self._entity}')
+
+        return self._status(crowdsec_enrich.content)
+
+    def test_query(self):
+        pass
+
+    async def aquery(self, client: httpx.AsyncClient, retries: int = CROWDSEC_RETRIES) -> str:
+        """
+        Query Crowdsec for entity, retrying with jittered backoff
+
+        Inputs:
+            client: httpx.AsyncClient pointed at the LAPI
+            retries: int of extra attempts after the first fails
+
+        Returns:
+            str: Banned or Not Banned
+
+        Raises:
+            httpx.HTTPError: once every attempt failed
+        """
+        for attempt in range(retries + 1):
+            try:
+                res = await client.get("v1/decisions", params={"ip": self._entity})
+
+                # Worth retrying, LAPI is busy or restarting
+                if res.status_code == 429 or res.status_code >= 500:
+                    raise httpx.HTTPStatusError(f'Received status code {res.status_code}', request=res.request, response=res)
+
+                if res.status_code != 200:
+                    raise httpx.HTTPError(f'Received status code {res.status_code}')
+
+                return self._status(res.content)
+
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if attempt == retries:
+                    raise
+
+                # Full jitter so retries from many lookups spread out
+                await asyncio.sleep(random.uniform(0, CROWDSEC_BACKOFF * 2 ** attempt))
+
+    @classmethod
+    async def query_many(cls, type: str, entities: list[str], crowdsec_lapi_url: str, crowdsec_lapi_key: str, concurrency: int = CROWDSEC_CONCURRENCY, timeout: float = CROWDSEC_TIMEOUT, retries: int = CROWDSEC_RETRIES) -> list["Crowdsec"]:
+        """
+        Look up many entities concurrently over one keep-alive client
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to look up
+            crowdsec_lapi_url: str of Crowdsec LAPI to connect to
+            crowdsec_lapi_key: str of Crowdsec Key to use with LAPI
+            concurrency: int of lookups in flight at once
+            timeout: float of seconds per request
+            retries: int of extra attempts per lookup
+
+        Returns:
+            list[Crowdsec]: producers holding a Status update, failed lookups are left out
+        """
+        producers = list()
+        for entity in entities:
+            try:
+                producers.append(cls(type, entity, crowdsec_lapi_url, crowdsec_lapi_key))
+
+            except Exception as e:
+                logging.warning(f'Skipping {entity} for Crowdsec: {e}')
+
+        # One delta pull, then every lookup is in memory
+        if CROWDSEC_MIRROR and producers:
+            mirror = producers[0].mirror()
+            await asyncio.to_thread(mirror.refresh)
+
+            for producer in producers:
+                producer.add_update("Status", "Banned" if mirror.lookup(producer.get_entity()) else "Not Banned")
+
+            logging.info(f'Finished Crowdsec lookups for {len(producers)} of {len(entities)} entities from {len(mirror)} decisions')
+
+            return producers
+
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup(client: httpx.AsyncClient, producer: Crowdsec) -> bool:
+            async with semaphore:
+                try:
+                    producer.add_update("Status", await producer.aquery(client, retries))
+                    return True
+
+                except Exception as e:
+                    logging.warning(f'Failed to query Crowdsec for {producer.get_entity()}: {e}')
+                    return False
+
+        async with httpx.AsyncClient(base_url=crowdsec_lapi_url, headers={"X-Api-Key": crowdsec_lapi_key}, timeout=timeout, limits=limits) as client:
+            done = await asyncio.gather(*[lookup(client, s) for s in producers])
+
+        logging.info(f'Finished Crowdsec lookups for {sum(done)} of {len(entities)} entities')
+
+        return [s for s, ok in zip(producers, done) if ok]
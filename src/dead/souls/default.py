@@ -1,17 +1,142 @@
+from souls.result_cache import get_result_cache
+from functools import lru_cache
+from os import getenv
+import asyncio
+import ipaddress
 import logging
 import datetime
-import validators
+import re
+import socket
+import urllib.parse
+
+# Entities classified per process, sweeps see the same targets over and over
+ENTITY_MEMO_SIZE = int(getenv("ENTITY_MEMO_SIZE", 131072))
+
+# Validated metric and type names, there are only a few and they repeat on every update
+NAMES_MEMO_SIZE = 4096
+_NAMES = dict() # type: dict[str, str]
+
+# One DNS label, letters, digits and inner hyphens
+HOSTNAME_LABEL = re.compile(r"(?!-)[a-z0-9-]{1,63}(?<!-)")
+
+
+@lru_cache(maxsize=ENTITY_MEMO_SIZE)
+def classify_entity(entity: str) -> tuple[str, str]:
+    """
+    Classify an entity and put it in its canonical form, so every spelling
+    of a host is the same entity
+
+    Canonical forms are:
+        - ipv4: dotted quad (ie. '10.0.0.1')
+        - ipv6: compressed (ie. '2001:db8::1')
+        - website: lowercase IDNA hostname, taken from the host of a url
+
+    Inputs:
+        entity: str of an ip, hostname or url
+
+    Returns:
+        tuple[str, str]: kind (ipv4, ipv6 or website) and canonical entity
+
+    Raises:
+        ValueError: if the entity is none of them
+    """
+    entity = entity.strip()
+
+    if not entity or len(entity) > 1000 or not entity.isprintable():
+        raise ValueError("Invalid entity")
+
+    # Plain dotted quads are most targets, inet_pton only accepts them in canonical form
+    if entity[-1].isdigit():
+        try:
+            socket.inet_pton(socket.AF_INET, entity)
+            return "ipv4", entity
+
+        except OSError:
+            pass
+
+    try:
+        address = ipaddress.ip_address(entity.strip("[]"))
+        return f'ipv{address.version}', address.compressed
+
+    except ValueError:
+        pass
+
+    if "://" in entity:
+        host = urllib.parse.urlsplit(entity).hostname
+
+        if not host:
+            raise ValueError("Invalid entity")
+
+        try:
+            address = ipaddress.ip_address(host)
+            return f'ipv{address.version}', address.compressed
+
+        except ValueError:
+            pass
+
+    else:
+        # Bare hostname, maybe with a port or path
+        host = entity.split("/", 1)[0].rsplit(":", 1)[0] if entity.count(":") < 2 else entity
+
+    try:
+        host = host.rstrip(".").lower().encode("idna").decode("ascii")
+
+    except UnicodeError:
+        raise ValueError("Invalid entity")
+
+    labels = host.split(".")
+
+    if len(host) > 253 or len(labels) < 2 or labels[-1].isdigit() or not all(HOSTNAME_LABEL.fullmatch(s) for s in labels):
+        raise ValueError("Invalid entity")
+
+    return "website", host
+
+
+def _canonical(entity: str) -> str:
+    """
+    Canonical form of an entity, or the entity as is if it is invalid
+    """
+    try:
+        return classify_entity(entity)[1]
+
+    except ValueError:
+        return entity
+
+
+def redact(error: Exception, *secrets: str) -> str:
+    """
+    Describe an error for the logs without the secrets it may carry, ie. an
+    API key in the url of a failed request
+
+    Inputs:
+        error: Exception to describe
+        secrets: str of each secret to hide
+
+    Returns:
+        str: the error with every secret replaced
+    """
+    message = str(error)
+
+    for secret in secrets:
+        if not secret:
+            continue
+
+        # Keys are quoted in the url they were sent in
+        for form in {secret, urllib.parse.quote(secret, safe=""), urllib.parse.quote_plus(secret)}:
+            message = message.replace(form, "<redacted>")
+
+    return message
 
 
 class Validate():
-    def _validate_input(self, input: str) -> str:
+    def _validate_input(self, input: str, min_length: int = 2, capitalize: bool = True) -> str:
         """
         Validate an input: 
-            - More than 2 characters
+            - At least min_length characters (2 unless given)
             - Less than 1000 characters
             - All printable characters (no carriage return)
 
-        & Capitalizes the input
+        & Capitalizes the input unless told not to
 
         Input: 
             str: to validate or format
@@ -22,10 +147,13 @@ class Validate():
         Raises: 
             ValueError: if invalid 
         """
-        input = input.strip().capitalize()
+        input = input.strip()
 
-        if len(input) < 2:
-            raise ValueError("Input should be more than 2 characters")
+        if capitalize:
+            input = input.capitalize()
+
+        if len(input) < min_length:
+            raise ValueError(f'Input should be at least {min_length} characters')
 
         if len(input) > 1000:
             raise ValueError("Input should be under 1000 characters")
@@ -33,10 +161,22 @@ class Validate():
         if not input.isprintable():
             raise ValueError("Input contains invalid characters")
 
-        logging.debug(f'Validated input for {input}')
-
         return input
 
+    def _validate_name(self, name: str) -> str:
+        """
+        Validate a metric or type name like _validate_input, only once per name
+        """
+        valid = _NAMES.get(name)
+
+        if valid is None:
+            valid = self._validate_input(name)
+
+            if len(_NAMES) < NAMES_MEMO_SIZE:
+                _NAMES[name] = valid
+
+        return valid
+
     def _validate_entity(self, entity: str) -> str:
         """
         Validate Endpoint & Standardize
@@ -44,29 +184,20 @@ class Validate():
         Endpoint can either be: 
             - ipv4
             - ipv6
-            - website url
+            - website hostname or url
 
         Input: 
             entity: str to validate 
 
         Returns: 
-            str: validated entity
-        """
-        entity = self._validate_input(entity).lower()
-
-        # IPv4
-        if validators.ip_address.ipv4(entity):
-            return entity
-
-        # IPv6
-        if validators.ip_address.ipv6(entity):
-            return entity
+            str: validated entity in its canonical form, see classify_entity
 
-        # Website
-        if validators.url(entity):
-            return entity
+        Raises:
+            ValueError: if invalid
+        """
+        self._kind, entity = classify_entity(entity)
 
-        raise ValueError("Invalid entity")
+        return entity
 
     def _validate_source(self, source: str) -> str: 
         """
@@ -77,34 +208,38 @@ class Validate():
 
         source = source.strip() 
 
-        if len(source) > 4: 
+        if len(source) > 1: 
             return source
         
         raise ValueError("Invalid source")
 
 
-class Update(Validate):
+class Update():
     """
     Update Class 
 
     Used to transport an update from a soul (producer) to the database through Necromancer
 
-    Update is type ambigous, defining required values/functions
+    Update is type ambigous, defining required values/functions. Producers
+    validate metric and value before creating it, see Producer.add_updates
     """
 
-    def __init__(self, metric: str, value: str) -> None:
+    __slots__ = ["_metric", "_value", "_metadata", "_timestamp"]
+
+    def __init__(self, metric: str, value: str, metadata: dict[str, str] = None, timestamp: datetime.datetime = None) -> None:
         """
         Create Update 
 
         Inputs: 
             metric: str to be updated (ie. 'Ports Open')
             value: str of metric to update to (ie. '9006, 9005, 9003') 
+            metadata: dict[str, str] of how the value was produced (ie. {'tier': 'fast'})
+            timestamp: datetime the value was seen at, now if not given
         """
-        self._metric = self._validate_input(metric)
-        self._value = self._validate_input(value)
-        self._timestamp = datetime.datetime.now()
-
-        logging.info(f'Created update for {metric} with {value}')
+        self._metric = metric
+        self._value = value
+        self._metadata = metadata
+        self._timestamp = timestamp or datetime.datetime.now()
 
     def get_metric(self) -> str:
         """
@@ -113,7 +248,6 @@ class Update(Validate):
         Returns: 
             str: metric value
         """
-        logging.debug(f'Returned metric {self._metric}')
         return self._metric
 
     def get_value(self) -> str:
@@ -134,6 +268,15 @@ class Update(Validate):
         """
         return self._timestamp
 
+    def get_metadata(self) -> dict[str, str]:
+        """
+        Get the metadata
+
+        Returns: 
+            dict[str, str]: how the value was produced, or None
+        """
+        return self._metadata
+
     def get(self) -> dict:
         """
         Dictionary value of update information
@@ -141,11 +284,10 @@ class Update(Validate):
         Returns: 
             dict: update information
         """
-        logging.debug(f'Returned update information for {self.get_metric()}')
-
         return {
             "metric": self.get_metric(),
             "value": self.get_value(),
+            "metadata": self.get_metadata(),
             "timestamp": self.get_timestamp()
         }
 
@@ -160,15 +302,186 @@ class Update(Validate):
 
 
 class Producer(Validate):
+    """
+    Producer Class
+
+    Creating a producer only validates its entity and settings, raising
+    ValueError if they are invalid. The work happens in run, arun or the
+    batched run_many, which the scheduler drives through produce
+    """
+
+    # How the scheduler runs this producer: pool kind, jobs at once and seconds per job
+    pool = "thread"
+    concurrency = 4
+    timeout = 60
+
+    # Whether run_many takes every target in one job instead of one job per target
+    batch = False
+
+    # Source the producer posts as, and seconds its results are reused for (0 to always run)
+    source = None
+    cache_ttl = 0
+
+    # Whether update values are capitalized like every other input, off to keep case (ie. CVE ids)
+    capitalize_values = True
+
+    # Whether a result already posted stops the producer running again within cache_ttl,
+    # otherwise only results that never reached Necromancer are reused
+    reuse_posted = True
+
     def __init__(self, entity: str, type: str, source: str) -> None:
         self._entity = self._validate_entity(entity)
-        self._type = self._validate_input(type)
+        self._type = self._validate_name(type).lower()
         self._source = self._validate_source(source) 
 
-        # To store updates in later
-        self._update_list = list[Update]
+        # To store updates in later, one per metric
+        self._updates = dict() # type: dict[str, Update]
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        """
+        Reject a producer that implements neither run nor arun when it is defined
+
+        Raises:
+            TypeError: if neither is implemented
+        """
+        super().__init_subclass__(**kwargs)
+
+        if cls.run is Producer.run and cls.arun is Producer.arun:
+            raise TypeError(f'{cls.__name__} implements neither run nor arun')
+
+    @classmethod
+    def settings(cls) -> dict:
+        """
+        Extra arguments the producer needs, usually from the environment
+
+        Returns:
+            dict: keyword arguments to create the producer with
+        """
+        return dict()
+
+    @classmethod
+    def cache_params(cls, kwargs: dict) -> dict:
+        """
+        Scan parameters a cached result is only valid for
+
+        Inputs:
+            kwargs: dict of extra producer arguments
+
+        Returns:
+            dict: parameters to key cached results by
+        """
+        return kwargs
+
+    def run(self) -> list[dict]:
+        """
+        Do the producer's work over its entity, adding its updates
+
+        Producers implement run or arun, the other defaults to calling it
+
+        Returns:
+            list[dict]: updates in the form to post to Necro, or None
+
+        Raises:
+            Exception: whatever stopped the producer, nothing is posted for the entity
+        """
+        return asyncio.run(self.arun())
+
+    async def arun(self) -> list[dict]:
+        """
+        Async run, by default run in a worker thread
+        """
+        return await asyncio.to_thread(self.run)
+
+    @classmethod
+    def run_many(cls, type: str, entities: list[str], **kwargs) -> list[dict]:
+        """
+        Run the producer over many entities
+
+        Runs them one at a time, producers that can batch override this and
+        set batch so the scheduler hands them every target at once
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to run the producer over
+            kwargs: extra producer arguments
+
+        Returns:
+            list[dict]: updates of every entity that succeeded
+        """
+        updates = list()
 
-        logging.info(f'Created producer update for {entity} with {type}')
+        for entity in entities:
+            try:
+                updates.extend(cls(type, entity, **kwargs).run() or list())
+
+            except Exception as e:
+                logging.warning(f'{cls.__name__} failed for {entity}: {e}')
+
+        return updates
+
+    @classmethod
+    def produce(cls, type: str, entities: list[str], **kwargs) -> list[dict]:
+        """
+        Get the updates of the producer over entities, reusing cached results
+        younger than cache_ttl and only running over the rest
+
+        Producers run over canonical entities, once per spelling of a host,
+        but updates are posted and cached under the entity as Necromancer
+        stores it. A cached result that was already posted gives no updates,
+        or is run again when the producer doesn't reuse_posted
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to run the producer over
+            kwargs: extra producer arguments
+
+        Returns:
+            list[dict]: updates in the form to post to Necro
+        """
+        cache = get_result_cache() if cls.cache_ttl > 0 else None
+        source = cls.source or cls.__name__
+        params = cls.cache_params(kwargs)
+
+        updates = list()
+        pending = dict() # type: dict[str, list[str]]
+
+        entities = list(dict.fromkeys(entities))
+
+        # One connection for the whole batch, not one per entity
+        found = cache.get_many(entities, source, params, cls.cache_ttl) if cache is not None else dict()
+
+        for entity in entities:
+            cached = found.get(entity)
+
+            if cached is None or (cached[1] and not cls.reuse_posted):
+                pending.setdefault(_canonical(entity), list()).append(entity)
+                continue
+
+            logging.debug(f'Reusing cached {source} result for {entity}')
+
+            if not cached[1]:
+                updates.extend(cached[0])
+
+        if not pending:
+            return updates
+
+        by_entity = dict() # type: dict[str, list[dict]]
+        for update in cls.run_many(type, list(pending), **kwargs) or list():
+            by_entity.setdefault(update.get("entity"), list()).append(update)
+
+        results = dict() # type: dict[str, list[dict]]
+        for canonical, originals in pending.items():
+            if canonical not in by_entity:
+                continue
+
+            for entity in originals:
+                results[entity] = [{**s, "entity": entity} for s in by_entity[canonical]]
+                updates.extend(results[entity])
+
+        if cache is not None:
+            cache.put_many(source, params, results)
+
+        return updates
 
     def get_entity(self) -> str:
         """
@@ -186,7 +499,7 @@ class Producer(Validate):
         Returns: 
             bool: True if it is, false if it is not
         """
-        return validators.hostname(self._entity)
+        return self._kind == "website"
     
     def is_ip(self) -> bool: 
         """
@@ -195,7 +508,7 @@ class Producer(Validate):
         Returns: 
             bool: True if it is, false if it is not
         """
-        return not self.is_website()
+        return self._kind in ["ipv4", "ipv6"]
 
     def is_ipv6(self) -> bool: 
         """
@@ -204,7 +517,7 @@ class Producer(Validate):
         Returns: 
             bool: True if it is, false if it is not
         """
-        return validators.ip_address.ipv6(self._entity)
+        return self._kind == "ipv6"
     
     def get_type(self) -> str:
         """
@@ -227,30 +540,54 @@ class Producer(Validate):
     def get_timestamp(self) -> datetime:
         return datetime.datetime.now()
 
-    def add_update(self, metric: str, value: str) -> bool:
+    def add_update(self, metric: str, value: str, metadata: dict[str, str] = None) -> bool:
         """
         Add an update to a producer
 
         Inputs: 
             metric: str name of metric 
             value: str value of metric
+            metadata: dict[str, str] of how the value was produced
+
+        Returns:
+            bool: whether the update was added
+        """
+        return self.add_updates({metric: value}, metadata) == 1
+
+    def add_updates(self, metrics: dict[str, str], metadata: dict[str, str] = None) -> int:
+        """
+        Add many updates at once, all stamped with the same time
+
+        None values are skipped, and a metric added again replaces the
+        earlier value
+
+        Inputs:
+            metrics: dict[str, str] of metric name to value
+            metadata: dict[str, str] of how the values were produced
+
+        Returns:
+            int: number of updates added
         """
+        timestamp = datetime.datetime.now()
+        added = 0
 
-        # Let's make it easier to add
-        if value == None:
-            return False
+        for metric, value in metrics.items():
+            # Let's make it easier to add
+            if value is None:
+                continue
 
-        update = Update(metric, value)
+            try:
+                metric = self._validate_name(metric)
+                value = self._validate_input(str(value), min_length=1, capitalize=self.capitalize_values)
 
-        if update in self._update_list:
-            logging.warning(
-                f'A duplicated update was sent (how is this possible with timestamp)')
-            return False
+            except ValueError as e:
+                logging.warning(f'Skipping update {metric} for {self._entity}: {e}')
+                continue
 
-        logging.debug(f'Added update for {metric} on {self._entity}')
+            self._updates[metric] = Update(metric, value, metadata, timestamp)
+            added += 1
 
-        self._update_list.append(update)
-        return True
+        return added
 
     def get_updates(self) -> list[dict]:
         """
@@ -263,31 +600,38 @@ class Producer(Validate):
                 "source": str, 
                 "metric": str, 
                 "value": str, 
-                "timestamp": datetime
-        }]"""
-        updates = self._update_list
-        returnables = list() 
+                "metadata": dict[str, str] | None,
+                "timestamp": str (ISO 8601)
+            }] or None without updates
+        """
+        if not self._updates:
+            return None
 
         entity = self.get_entity() 
         type = self.get_type()
         source = self.get_source()
 
-        for update in updates: 
-            update = update # type: Update
-            
+        # Updates added together share a timestamp, format each one once
+        stamps = dict() # type: dict[datetime.datetime, str]
+        returnables = list()
+
+        for update in self._updates.values():
+            timestamp = stamps.get(update._timestamp)
+
+            if timestamp is None:
+                timestamp = stamps[update._timestamp] = update._timestamp.isoformat()
+
             returnables.append({
-                "entity": entity, 
-                "type": type, 
-                "source": source, 
-                "metric": update.get_metric(),
-                "value": update.get_value(),
-                "timestamp": update.get_timestamp()
+                "entity": entity,
+                "type": type,
+                "source": source,
+                "metric": update._metric,
+                "value": update._value,
+                "metadata": update._metadata,
+                "timestamp": timestamp
             })
 
-        if len(returnables) < 1:
-            return None 
-        
-        return self._update_list
+        return returnables
 
     def get(self) -> dict:
         return {
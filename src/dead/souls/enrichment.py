@@ -0,0 +1,367 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from souls.default import Producer, redact
+from souls.ratelimit import TokenBucket
+from souls.result_cache import get_result_cache
+from os import getenv
+import datetime
+import logging
+import requests
+import requests.adapters
+import threading
+import time
+
+# Connections kept open per provider, and lookups in flight at once
+ENRICHMENT_POOL_SIZE = int(getenv("ENRICHMENT_POOL_SIZE", 16))
+ENRICHMENT_TIMEOUT = float(getenv("ENRICHMENT_TIMEOUT", 15))
+
+
+class QuotaExceeded(Exception):
+    """
+    A provider's daily quota is spent
+    """
+
+
+class Provider(ABC):
+    """
+    Enrichment Provider
+
+    Adapter for one third party lookup API, the client does the pooling,
+    limiting, caching and coalescing around it
+
+    Subclasses set the class attributes and implement request and updates,
+    and parse when the API doesn't answer unknowns with a 404
+    """
+
+    # Name responses and quota are kept under, and the environment variable holding the key
+    name = None # type: str
+    key_env = None # type: str
+
+    # Requests a second, requests a UTC day, seconds to keep answers and unknowns for
+    rate = 1.0
+    daily_quota = 1000
+    cache_ttl = 86400.0
+    negative_ttl = 3600.0
+
+    # Entity kinds it can look up (ipv4, ipv6, website)
+    kinds = ["ipv4", "ipv6"]
+
+    @abstractmethod
+    def request(self, indicator: str, key: str) -> dict:
+        """
+        Build the request for an indicator
+
+        Inputs:
+            indicator: str to look up
+            key: str of the API key
+
+        Returns:
+            dict: keyword arguments for requests.Session.request (method, url, ...)
+        """
+
+    def parse(self, res: requests.Response) -> dict:
+        """
+        Read a response
+
+        Inputs:
+            res: requests.Response of the request
+
+        Returns:
+            dict: the answer, None if the provider doesn't know the indicator
+
+        Raises:
+            requests.HTTPError: if the lookup failed, failures aren't cached
+        """
+        if res.status_code == 404:
+            return None
+
+        res.raise_for_status()
+
+        return res.json()
+
+    @abstractmethod
+    def updates(self, answer: dict) -> dict[str, str]:
+        """
+        Metrics of an answer
+
+        Inputs:
+            answer: dict from parse, None if unknown
+
+        Returns:
+            dict[str, str]: metric name to value
+        """
+
+
+class EnrichmentClient():
+    """
+    Enrichment Client
+
+    Looks indicators up with one provider over a pooled session, within its
+    rate and daily quota. Answers, including unknowns, are cached with a TTL
+    in the soul's result cache, and concurrent lookups of the same indicator
+    share one request
+    """
+
+    def __init__(self, provider: Provider, key: str) -> None:
+        """
+        Create an Enrichment Client
+
+        Inputs:
+            provider: Provider to look indicators up with
+            key: str of the provider's API key
+        """
+        self.provider = provider
+        self._key = key
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=ENRICHMENT_POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._bucket = TokenBucket(provider.rate)
+
+        self._lock = threading.Lock()
+        self._inflight = dict() # type: dict[str, Future]
+
+        # Used without a result cache, so answers and quota only last the process
+        self._answers = dict() # type: dict[str, tuple[float, dict]]
+        self._spent = dict() # type: dict[str, int]
+
+    def lookup(self, indicator: str) -> dict:
+        """
+        Look an indicator up, from the cache when possible
+
+        Inputs:
+            indicator: str to look up
+
+        Returns:
+            dict: the answer, None if the provider doesn't know the indicator
+
+        Raises:
+            QuotaExceeded: if the daily quota is spent
+            requests.RequestException: if the lookup failed
+        """
+        found, answer = self._cached(indicator)
+        if found:
+            return answer
+
+        with self._lock:
+            future = self._inflight.get(indicator)
+            leader = future is None
+
+            if leader:
+                future = self._inflight[indicator] = Future()
+
+        # Someone else is already asking
+        if not leader:
+            return future.result()
+
+        try:
+            answer = self._fetch(indicator)
+            future.set_result(answer)
+
+        except BaseException as e:
+            future.set_exception(e)
+
+        finally:
+            with self._lock:
+                del self._inflight[indicator]
+
+        return future.result()
+
+    def lookup_many(self, indicators: list[str]) -> dict[str, dict]:
+        """
+        Look many indicators up, ENRICHMENT_POOL_SIZE at a time
+
+        Inputs:
+            indicators: list[str] to look up
+
+        Returns:
+            dict[str, dict]: answers of the indicators that were looked up, None for unknown
+        """
+        answers = dict()
+        indicators = list(dict.fromkeys(indicators))
+
+        with ThreadPoolExecutor(max_workers=ENRICHMENT_POOL_SIZE) as pool:
+            futures = {s: pool.submit(self.lookup, s) for s in indicators}
+
+        skipped = 0
+        for indicator, future in futures.items():
+            try:
+                answers[indicator] = future.result()
+
+            except QuotaExceeded:
+                skipped += 1
+
+            except Exception as e:
+                logging.warning(f'Failed to look up {indicator} on {self.provider.name}: {redact(e, self._key)}')
+
+        if skipped:
+            logging.warning(f'{self.provider.name} daily quota spent, {skipped} lookups left for the next sweep')
+
+        return answers
+
+    def _cached(self, indicator: str) -> tuple[bool, dict]:
+        cache = get_result_cache()
+
+        if cache is not None:
+            return cache.get_response(self.provider.name, indicator)
+
+        expires, answer = self._answers.get(indicator, (0, None))
+
+        return expires > time.time(), answer
+
+    def _fetch(self, indicator: str) -> dict:
+        """
+        Ask the provider, spending quota and caching the answer
+        """
+        # Another lookup may have finished between the cache check and taking the lead
+        found, answer = self._cached(indicator)
+        if found:
+            return answer
+
+        if not self._spend():
+            raise QuotaExceeded(f'{self.provider.name} daily quota of {self.provider.daily_quota} spent')
+
+        self._bucket.acquire()
+
+        res = self._session.request(timeout=ENRICHMENT_TIMEOUT, **self.provider.request(indicator, self._key))
+        answer = self.provider.parse(res)
+
+        ttl = self.provider.cache_ttl if answer is not None else self.provider.negative_ttl
+        cache = get_result_cache()
+
+        if cache is not None:
+            cache.put_response(self.provider.name, indicator, answer, ttl)
+        else:
+            self._answers[indicator] = (time.time() + ttl, answer)
+
+        return answer
+
+    def _spend(self) -> bool:
+        """
+        Spend one request of today's quota
+
+        Returns:
+            bool: whether there was quota left
+        """
+        day = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        cache = get_result_cache()
+
+        if cache is not None:
+            return cache.spend(self.provider.name, day, self.provider.daily_quota)
+
+        with self._lock:
+            if self._spent.get(day, 0) >= self.provider.daily_quota:
+                return False
+
+            self._spent = {day: self._spent.get(day, 0) + 1}
+
+        return True
+
+
+_CLIENTS = dict() # type: dict[tuple[str, str], EnrichmentClient]
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(provider: type[Provider], key: str) -> EnrichmentClient:
+    """
+    Get the process wide client of a provider, creating it on first use
+    """
+    with _CLIENTS_LOCK:
+        if (provider.name, key) not in _CLIENTS:
+            _CLIENTS[(provider.name, key)] = EnrichmentClient(provider(), key)
+
+        return _CLIENTS[(provider.name, key)]
+
+
+class EnrichmentProducer(Producer):
+    """
+    Enrichment Producer
+
+    Producer of one provider's answers, subclasses only set provider
+    """
+
+    provider = None # type: type[Provider]
+
+    # Every lookup goes through the shared client, which runs them concurrently
+    pool = "thread"
+    concurrency = 1
+    timeout = 3600
+    batch = True
+
+    @classmethod
+    def settings(cls) -> dict:
+        """
+        API key from the provider's key_env
+        """
+        return {
+            "api_key": getenv(cls.provider.key_env)
+        }
+
+    def __init__(self, type: str, entity: str, api_key: str) -> None:
+        """
+        Create an Enrichment Producer, nothing is looked up until run
+
+        Input:
+            entity: str to look up
+            type: str type of entity
+            api_key: str of the provider's key
+
+        Raises:
+            ValueError: if the provider can't look up the entity or the key is missing
+        """
+        super().__init__(entity, type, self.provider.name)
+
+        if self._kind not in self.provider.kinds:
+            raise ValueError(f'{self.provider.name} does not support {self._kind}')
+
+        if not api_key:
+            raise ValueError(f'Invalid {self.provider.name} API Key')
+
+        self._api_key = api_key
+
+    def run(self) -> list[dict]:
+        """
+        Look up the entity
+
+        Returns:
+            list[dict]: updates of the answer
+        """
+        client = get_client(self.provider, self._api_key)
+        self.add_updates(client.provider.updates(client.lookup(self._entity)))
+
+        return self.get_updates()
+
+    @classmethod
+    def run_many(cls, type: str, entities: list[str], api_key: str) -> list[dict]:
+        """
+        Look up every entity through the shared client
+
+        Returns:
+            list[dict]: updates of every entity that was looked up
+        """
+        producers = dict() # type: dict[str, EnrichmentProducer]
+        for entity in entities:
+            try:
+                producer = cls(type, entity, api_key)
+                producers[producer.get_entity()] = producer
+
+            except Exception as e:
+                logging.debug(f'Skipping {entity} for {cls.provider.name}: {e}')
+
+        if not producers:
+            return list()
+
+        client = get_client(cls.provider, api_key)
+        answers = client.lookup_many(list(producers))
+
+        updates = list()
+        for entity, answer in answers.items():
+            producer = producers[entity]
+            producer.add_updates(client.provider.updates(answer))
+            updates.extend(producer.get_updates() or list())
+
+        logging.info(f'Finished {cls.provider.name} lookups of {len(answers)} of {len(entities)} entities')
+
+        return updates
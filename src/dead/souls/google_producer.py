@@ -1 +1,66 @@
-# TODO: google keyword search
\ No newline at end of file
+from souls.enrichment import EnrichmentProducer, Provider
+from os import getenv
+import requests
+
+GOOGLE_SAFE_BROWSING_URL = getenv("GOOGLE_SAFE_BROWSING_URL", "https://safebrowsing.googleapis.com/")
+GOOGLE_DAILY_QUOTA = int(getenv("GOOGLE_DAILY_QUOTA", 10000))
+
+# Threats every website is checked for
+GOOGLE_THREAT_TYPES = ["MALWARE", "SOCIAL_ENGINEERING", "UNWANTED_SOFTWARE", "POTENTIALLY_HARMFUL_APPLICATION"]
+
+
+class GoogleProvider(Provider):
+    """
+    Google Safe Browsing Lookup API, whether a website is on a threat list
+    """
+
+    name = "Google"
+    key_env = "GOOGLE_API_KEY"
+
+    rate = 10.0
+    daily_quota = GOOGLE_DAILY_QUOTA
+
+    kinds = ["website"]
+
+    def request(self, indicator: str, key: str) -> dict:
+        return {
+            "method": "POST",
+            "url": f'{GOOGLE_SAFE_BROWSING_URL}v4/threatMatches:find',
+            "params": {"key": key},
+            "json": {
+                "client": {"clientId": "paranoia", "clientVersion": "1.0"},
+                "threatInfo": {
+                    "threatTypes": GOOGLE_THREAT_TYPES,
+                    "platformTypes": ["ANY_PLATFORM"],
+                    "threatEntryTypes": ["URL"],
+                    "threatEntries": [{"url": f'http://{indicator}/'}, {"url": f'https://{indicator}/'}]
+                }
+            }
+        }
+
+    def parse(self, res: requests.Response) -> dict:
+        res.raise_for_status()
+
+        # An empty answer means no matches, that is still an answer
+        return {"matches": (res.json() or dict()).get("matches") or list()}
+
+    def updates(self, answer: dict) -> dict[str, str]:
+        threats = sorted({s.get("threatType") for s in (answer or dict()).get("matches") or list() if s.get("threatType")})
+
+        return {
+            "safe browsing": ", ".join(s.lower() for s in threats) or "safe"
+        }
+
+
+class Google(EnrichmentProducer):
+    """
+    Google Producer class
+
+    Takes in websites and checks them against Google Safe Browsing
+
+    Returns the metric:
+        - Safe Browsing (safe or the threats it is listed for)
+    """
+
+    provider = GoogleProvider
+    source = GoogleProvider.name
@@ -1 +1,55 @@
-# TODO: greynoise ip/host lookup
\ No newline at end of file
+from souls.enrichment import EnrichmentProducer, Provider
+from os import getenv
+
+GREYNOISE_API_URL = getenv("GREYNOISE_API_URL", "https://api.greynoise.io/")
+GREYNOISE_DAILY_QUOTA = int(getenv("GREYNOISE_DAILY_QUOTA", 50))
+
+
+class GreyNoiseProvider(Provider):
+    """
+    GreyNoise Community API, whether an ip is internet background noise
+    """
+
+    name = "GreyNoise"
+    key_env = "GREYNOISE_API_KEY"
+
+    rate = 1.0
+    daily_quota = GREYNOISE_DAILY_QUOTA
+
+    def request(self, indicator: str, key: str) -> dict:
+        return {
+            "method": "GET",
+            "url": f'{GREYNOISE_API_URL}v3/community/{indicator}',
+            "headers": {"key": key}
+        }
+
+    def updates(self, answer: dict) -> dict[str, str]:
+        # Not seen scanning the internet
+        if answer is None:
+            return {"classification": "unobserved"}
+
+        return {
+            "classification": answer.get("classification"),
+            "noise": str(bool(answer.get("noise"))).lower(),
+            "riot": str(bool(answer.get("riot"))).lower(),
+            "name": answer.get("name"),
+            "last seen": answer.get("last_seen")
+        }
+
+
+class GreyNoise(EnrichmentProducer):
+    """
+    GreyNoise Producer class
+
+    Takes in ips and checks them against GreyNoise
+
+    Returns the metrics:
+        - Classification
+        - Noise
+        - Riot
+        - Name
+        - Last Seen
+    """
+
+    provider = GreyNoiseProvider
+    source = GreyNoiseProvider.name
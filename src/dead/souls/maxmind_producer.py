@@ -1 +1,220 @@
-# TODO: Get geo data from maxmind
\ No newline at end of file
+from souls.default import Producer
+from os import getenv
+import logging
+import maxminddb
+import os
+import threading
+import time
+
+# Local GeoLite2 (or GeoIP2) databases, an empty path skips that database
+MAXMIND_CITY_DB = getenv("MAXMIND_CITY_DB", "GeoLite2-City.mmdb")
+MAXMIND_ASN_DB = getenv("MAXMIND_ASN_DB", "GeoLite2-ASN.mmdb")
+
+
+class GeoDatabase():
+    """
+    Geo Database
+
+    A MaxMind database opened once per process, reopened when the file
+    on disk is replaced (ie. by geoipupdate)
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Create a Geo Database, nothing is opened until reader
+
+        Inputs:
+            path: str of the .mmdb file
+        """
+        self._path = path
+        self._reader = None # type: maxminddb.Reader
+        self._stat = None # type: tuple[int, int, int]
+        self._lock = threading.Lock()
+
+    def reader(self) -> maxminddb.Reader:
+        """
+        Get the reader, reopening the database if the file changed
+
+        Returns:
+            maxminddb.Reader: of the current file
+
+        Raises:
+            OSError: if the file can't be read
+            maxminddb.InvalidDatabaseError: if the file isn't a MaxMind database
+        """
+        stat = os.stat(self._path)
+        stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if stat != self._stat:
+                start = time.perf_counter()
+                # The C extension's reader when it is installed, the pure Python one otherwise
+                reader = maxminddb.open_database(self._path, maxminddb.MODE_AUTO)
+
+                # Lookups in flight keep the old mapping until they are done with it
+                self._reader, self._stat = reader, stat
+
+                metadata = reader.metadata()
+                logging.info(f'Opened {metadata.database_type} from {self._path} built {time.strftime("%Y-%m-%d", time.gmtime(metadata.build_epoch))} in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+            return self._reader
+
+
+_DATABASES = dict() # type: dict[str, GeoDatabase]
+_DATABASES_LOCK = threading.Lock()
+
+
+def get_database(path: str) -> GeoDatabase:
+    """
+    Get the process wide Geo Database of a file, creating it on first use
+    """
+    with _DATABASES_LOCK:
+        if path not in _DATABASES:
+            _DATABASES[path] = GeoDatabase(path)
+
+        return _DATABASES[path]
+
+
+class MaxMind(Producer):
+    """
+    MaxMind Producer class
+
+    Takes in ips and looks them up in local MaxMind databases, no requests
+    leave the soul
+
+    Returns the metrics:
+        - Country
+        - City
+        - Location
+        - ASN
+        - AS Org
+    """
+
+    # Lookups are memory reads, one batch job does the whole fleet
+    pool = "thread"
+    concurrency = 1
+    timeout = 120
+    batch = True
+
+    source = "MaxMind"
+
+    @classmethod
+    def settings(cls) -> dict:
+        """
+        Databases from MAXMIND_CITY_DB and MAXMIND_ASN_DB
+        """
+        return {
+            "city_db": MAXMIND_CITY_DB,
+            "asn_db": MAXMIND_ASN_DB
+        }
+
+    def __init__(self, type: str, entity: str, city_db: str = MAXMIND_CITY_DB, asn_db: str = MAXMIND_ASN_DB) -> None:
+        """
+        Create a MaxMind Producer, nothing is looked up until run
+
+        Input:
+            entity: str to look up
+            type: str type of entity
+            city_db: str path of the city database
+            asn_db: str path of the ASN database
+
+        Raises:
+            ValueError: if the entity isn't an ip
+        """
+        super().__init__(entity, type, self.source)
+
+        if not self.is_ip():
+            raise ValueError(f'MaxMind Producer only supports ips')
+
+        self._city_db = city_db
+        self._asn_db = asn_db
+
+    def run(self) -> list[dict]:
+        """
+        Look up the entity on its own
+
+        Returns:
+            list[dict]: geo updates, or None if the databases have nothing on it
+        """
+        readers = self.readers(self._city_db, self._asn_db)
+        self.add_geo(*[s.get(self._entity) if s else None for s in readers])
+
+        return self.get_updates()
+
+    @classmethod
+    def run_many(cls, type: str, entities: list[str], city_db: str = MAXMIND_CITY_DB, asn_db: str = MAXMIND_ASN_DB) -> list[dict]:
+        """
+        Look up every entity against one snapshot of each database
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to look up
+            city_db: str path of the city database
+            asn_db: str path of the ASN database
+
+        Returns:
+            list[dict]: geo updates of every entity found
+        """
+        city, asn = cls.readers(city_db, asn_db)
+        start = time.perf_counter()
+
+        updates = list()
+        for entity in entities:
+            try:
+                producer = cls(type, entity, city_db, asn_db)
+
+            except Exception as e:
+                logging.debug(f'Skipping {entity} for MaxMind: {e}')
+                continue
+
+            ip = producer.get_entity()
+            producer.add_geo(city.get(ip) if city else None, asn.get(ip) if asn else None)
+            updates.extend(producer.get_updates() or list())
+
+        logging.info(f'Finished MaxMind lookups of {len(entities)} entities in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+        return updates
+
+    @staticmethod
+    def readers(city_db: str, asn_db: str) -> list[maxminddb.Reader]:
+        """
+        Current readers of the databases, None for a database that is off or unreadable
+
+        Raises:
+            ValueError: if neither database can be read
+        """
+        readers = list()
+
+        for path in [city_db, asn_db]:
+            try:
+                readers.append(get_database(path).reader() if path else None)
+
+            except Exception as e:
+                logging.warning(f'Could not open MaxMind database {path}: {e}')
+                readers.append(None)
+
+        if not any(readers):
+            raise ValueError("No MaxMind database could be opened")
+
+        return readers
+
+    def add_geo(self, city: dict, asn: dict) -> None:
+        """
+        Add updates from database records
+
+        Inputs:
+            city: dict of the city (or country) record, or None
+            asn: dict of the ASN record, or None
+        """
+        city = city or dict()
+        asn = asn or dict()
+
+        location = city.get("location") or dict()
+
+        self.add_updates({
+            "country": (city.get("country") or dict()).get("iso_code"),
+            "city": ((city.get("city") or dict()).get("names") or dict()).get("en"),
+            "location": f'{location.get("latitude")}, {location.get("longitude")}' if "latitude" in location else None,
+            "asn": f'AS{asn.get("autonomous_system_number")}' if asn.get("autonomous_system_number") else None,
+            "as org": asn.get("autonomous_system_organization")
+        })
@@ -1,14 +1,43 @@
 from souls.default import Producer
-import nmap 
-import logging 
-
-class NMAP(Producer): 
+from souls.ports import PortSet
+from typing import IO, Iterator
+from os import getenv
+import xml.etree.ElementTree as ET
+import json
+import os
+import time
+import subprocess
+import tempfile
+import threading
+import shlex
+import nmap
+import logging
+
+# Batched scans hand nmap every target at once and let it parallelize hosts
+NMAP_PORTS = getenv("NMAP_PORTS", "1-60000")
+NMAP_ARGUMENTS = getenv("NMAP_ARGUMENTS", "-sV -T4 --min-hostgroup 64 --max-retries 2 --host-timeout 180s")
+NMAP_BATCH_TIMEOUT = float(getenv("NMAP_BATCH_TIMEOUT", 3600))
+
+# Seconds a host's scan results that were never posted are kept to post after a restart
+NMAP_CACHE_TTL = float(getenv("NMAP_CACHE_TTL", 21600))
+
+# Tiered scans, a fast pass every cycle and a deep scan only for hosts that changed or are due
+NMAP_FAST_ARGUMENTS = getenv("NMAP_FAST_ARGUMENTS", "-T4 --top-ports 100 --max-retries 1 --host-timeout 30s")
+NMAP_DEEP_PORTS = getenv("NMAP_DEEP_PORTS", NMAP_PORTS)
+NMAP_DEEP_ARGUMENTS = getenv("NMAP_DEEP_ARGUMENTS", NMAP_ARGUMENTS)
+NMAP_DEEP_INTERVAL = float(getenv("NMAP_DEEP_INTERVAL", 86400))
+NMAP_STATE_PATH = getenv("NMAP_STATE_PATH", "nmap_state.json")
+
+# A fast pass only sees some ports, so it only reports what it can see fully
+NMAP_FAST_METRICS = ["state", "hostname"]
+
+class NMAP(Producer):
     """
-    NMAP Producer class 
-    
+    NMAP Producer class
+
     Takes in an entity and scans it for open ports
-    
-    Returns the metrics: 
+
+    Returns the metrics:
         - State
         - Hostname
         - Time Elapsed
@@ -18,188 +47,514 @@ class NMAP(Producer):
         - OS
         - Open Port Count
         - Open Ports
+
+    Updates from scan_tiered carry the tier that produced them as metadata
     """
-    
+
+    # Each scan is an nmap subprocess, keep them off the GIL. Batched, the
+    # one job is a fast pass then a deep scan over every target
+    pool = "process"
+    concurrency = 4
+    timeout = 2 * NMAP_BATCH_TIMEOUT
+    batch = True
+
+    source = "NMAP"
+    cache_ttl = NMAP_CACHE_TTL
+
+    # Every sweep runs the fast pass, a posted scan doesn't stand in for it
+    reuse_posted = False
+
+    @classmethod
+    def cache_params(cls, kwargs: dict) -> dict:
+        """
+        Results are only reused for the same ports and arguments
+        """
+        return {
+            **kwargs,
+            "ports": NMAP_PORTS,
+            "arguments": NMAP_ARGUMENTS,
+            "fast_arguments": NMAP_FAST_ARGUMENTS,
+            "deep_ports": NMAP_DEEP_PORTS,
+            "deep_arguments": NMAP_DEEP_ARGUMENTS
+        }
+
     def __init__(self, type: str, entity: str) -> None:
         """
         Initialize an NMAP Producer
-        
-        Inputs: 
-            entity: str to check     
-        """
-        super().__init__(entity, type, "NMAP")        
-        logging.info(f'Starting NMAP producer for {entity}')
-
-        self._nm = nmap.PortScanner()
-
-        try: 
-            self._nm.scan(entity, ports='1-60000', timeout=180)
-            logging.info(f'Scanned entity {entity}')
-            
-            self._nm_entity = self._nm.all_hosts()[0]
-
-            if not self._nm['nmap']['scaninfo']['error']: 
-                raise nmap.PortScannerError("It said to check this key")
-
-        except: 
-            logging.exception("Could not create NMAP scanner") 
-            return None
-        
-        # To keep track of values more easily
-        update_dict = {
-            "state": self.get_state(),
-            "hostname": self.get_hostname(),
-            "time elapsed": self.get_time(),
-            "device": self.get_device(),
-            "brand": self.get_brand(), 
-            "type": self.get_type(),
-            "os": self.get_os(),
-            "open port count": self.get_port_count(),
-            "open ports": self.get_ports_all()
+
+        Inputs:
+            entity: str to check
+        """
+        super().__init__(entity, type, self.source)
+
+        self._tier = None
+        self._host = None # type: dict
+        self._ports = None # type: PortSet
+
+    def run(self) -> list[dict]:
+        """
+        Scan the entity on its own
+
+        Returns:
+            list[dict]: updates of the host
+
+        Raises:
+            nmap.PortScannerError: if nmap failed or did not report the host
+        """
+        logging.info(f'Starting NMAP producer for {self._entity}')
+
+        nm = nmap.PortScanner()
+        nm.scan(self._entity, ports=NMAP_PORTS, timeout=180)
+
+        if nm.scaninfo().get("error"):
+            raise nmap.PortScannerError(nm.scaninfo().get("error"))
+
+        if not nm.all_hosts():
+            raise nmap.PortScannerError(f'No results for {self._entity}')
+
+        self._host = dict(nm[nm.all_hosts()[0]])
+        self._host["scanstats"] = {"elapsed": nm.scanstats().get("elapsed")}
+
+        self._add_host_updates()
+
+        return self.get_updates()
+
+    @classmethod
+    def run_many(cls, type: str, entities: list[str]) -> list[dict]:
+        """
+        Scan every entity in tiers, see scan_tiered
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to scan
+
+        Returns:
+            list[dict]: updates of every host nmap reported
+        """
+        return [update for producer in cls.scan_tiered(type, entities) for update in producer.get_updates() or list()]
+
+    @classmethod
+    def from_host(cls, type: str, entity: str, host: dict, tier: str = None) -> "NMAP":
+        """
+        Create an NMAP Producer from an already scanned host
+
+        Inputs:
+            type: str type of entity
+            entity: str that was scanned
+            host: dict of the host, shaped like python-nmap's host results
+            tier: str of the scan tier (fast or deep), None for an untiered scan
+
+        Returns:
+            NMAP: producer holding the host's updates
+        """
+        producer = cls(type, entity)
+
+        producer._host = host
+        producer._tier = tier
+        producer._add_host_updates()
+
+        return producer
+
+    @classmethod
+    def scan_many(cls, type: str, entities: list[str], ports: str = NMAP_PORTS, arguments: str = NMAP_ARGUMENTS, timeout: float = NMAP_BATCH_TIMEOUT, tier: str = None) -> Iterator["NMAP"]:
+        """
+        Scan every entity with one nmap invocation
+
+        Targets (addresses, hostnames or CIDR blocks) are passed to nmap in a
+        temporary target file and its XML output is parsed as it streams, so
+        each producer is yielded as soon as nmap finishes that host
+
+        A scan that fails or is killed part way only loses the hosts nmap had
+        not reported yet
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] of targets to scan
+            ports: str of ports to scan (ie. '1-60000'), None to let the arguments choose
+            arguments: str of extra nmap arguments for timing and parallelism
+            timeout: float of seconds before the whole scan is killed
+            tier: str of the scan tier recorded on the updates
+
+        Returns:
+            Iterator[NMAP]: one producer per host nmap reported
+        """
+        logging.info(f'Starting batched NMAP scan of {len(entities)} targets')
+
+        targets = set(entities)
+        count = 0
+        proc = None
+        timer = None
+        error = None
+
+        # nmap reads the whole file before it writes anything, so nothing waits on a full pipe.
+        # Its errors go to a file too, so a chatty scan can't fill a stderr pipe
+        with tempfile.NamedTemporaryFile("w", prefix="nmap_targets_", suffix=".txt") as f, tempfile.TemporaryFile() as stderr:
+            f.write("\n".join(entities))
+            f.flush()
+
+            command = ["nmap", "-oX", "-", *(["-p", ports] if ports else list()), *shlex.split(arguments), "-iL", f.name]
+
+            try:
+                proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+
+                # Don't let one scan hold the sweep forever
+                timer = threading.Timer(timeout, proc.kill)
+                timer.start()
+
+                for host in parse_hosts(proc.stdout):
+                    # Report under the name the target was given as when there is one
+                    names = [host.get("addresses", dict()).get(s) for s in ["ipv4", "ipv6"]]
+                    names += [s.get("name") for s in host.get("hostnames", list()) if s.get("type") == "user"]
+                    entity = next((s for s in names if s in targets), next((s for s in names if s), None))
+
+                    if entity is None:
+                        continue
+
+                    try:
+                        yield cls.from_host(type, entity, host, tier)
+                        count += 1
+
+                    except Exception as e:
+                        logging.warning(f'Could not create NMAP producer for {entity}: {e}')
+
+                # Output is done, let nmap exit on its own so its exit code is real
+                proc.wait()
+
+            # A killed scan leaves its XML cut off
+            except (OSError, ET.ParseError) as e:
+                error = str(e)
+
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+                if proc is not None:
+                    proc.kill()
+                    proc.wait()
+
+            if proc is not None and proc.returncode:
+                stderr.seek(0)
+                message = stderr.read().decode(errors="replace").strip()[-1000:]
+
+                error = f'killed after {timeout:.0f}s' if proc.returncode < 0 else f'nmap exited with {proc.returncode}: {message or error}'
+
+        if error is not None:
+            logging.warning(f'Batched NMAP scan failed after {count} hosts: {error}')
+
+            # Nothing to show for it, let the scheduler record the failure
+            if count == 0:
+                raise nmap.PortScannerError(error)
+
+        logging.info(f'Finished batched NMAP scan with {count} hosts')
+
+    @classmethod
+    def scan_tiered(cls, type: str, entities: list[str], state_path: str = NMAP_STATE_PATH, deep_interval: float = NMAP_DEEP_INTERVAL) -> list["NMAP"]:
+        """
+        Fast pass over every entity, then a deep scan of the ones that need it
+
+        A host is deep scanned when its fast pass differs from the last one,
+        or when its last deep scan is older than the deep interval
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] of targets to scan
+            state_path: str of the JSON file holding the last known state
+            deep_interval: float of seconds between deep scans of an unchanged host
+
+        Returns:
+            list[NMAP]: one producer per host, from its deepest scan this cycle
+        """
+        state = ScanState(state_path)
+        producers = dict() # type: dict[str, NMAP]
+        fingerprints = dict() # type: dict[str, str]
+        deep = list()
+
+        for producer in cls.scan_many(type, entities, ports=None, arguments=NMAP_FAST_ARGUMENTS, tier="fast"):
+            entity = producer.get_entity()
+            producers[entity] = producer
+            fingerprints[entity] = producer.fingerprint()
+
+            if state.changed(entity, fingerprints[entity]) or state.due(entity, deep_interval):
+                deep.append(entity)
+                continue
+
+            state.record_fast(entity, fingerprints[entity])
+
+        logging.info(f'{len(deep)} of {len(producers)} hosts need a deep NMAP scan')
+
+        # A failed deep scan still leaves the fast pass to report
+        try:
+            for producer in cls.scan_many(type, deep, ports=NMAP_DEEP_PORTS, arguments=NMAP_DEEP_ARGUMENTS, tier="deep") if deep else list():
+                entity = producer.get_entity()
+                producers[entity] = producer
+
+                opened, closed = producer.get_port_set().diff(state.ports(entity))
+                if opened or closed:
+                    logging.info(f'NMAP ports changed for {entity}, opened: {opened}, closed: {closed}')
+
+                # Only remember the fast pass once the deep scan behind it succeeded
+                state.record_fast(entity, fingerprints.get(entity))
+                state.record_deep(entity, producer.get_port_set())
+
+        except nmap.PortScannerError as e:
+            logging.warning(f'Deep NMAP scan of {len(deep)} hosts failed, reporting their fast pass: {e}')
+
+        state.save()
+
+        return list(producers.values())
+
+    def fingerprint(self) -> str:
+        """
+        Summary of the host to compare fast passes with
+
+        Returns:
+            str: state and open ports of the host
+        """
+        ports = self.get_port_set().to_dict()
+
+        return f'{self.get_state()}|{",".join(f"{s}:{m}" for s, m in sorted(ports.items()))}'
+
+    def _add_host_updates(self) -> None:
+        """
+        Add an update for every metric of the scanned host
+        """
+        # Getters are called one at a time so one missing value doesn't lose the rest
+        metrics = {
+            "state": self.get_state,
+            "hostname": self.get_hostname,
+            "time elapsed": self.get_time,
+            "device": self.get_device,
+            "brand": self.get_brand,
+            "type": self.get_device_type,
+            "os": self.get_os,
+            "open port count": self.get_port_count,
+            "open ports": self.get_ports_all
         }
 
-        for met, val in update_dict.items(): 
-            # Final validation to try and catch None values
-            if val == None: 
-                logging.warning(f'Unable to get metric {met} for {entity}')
+        values = dict()
+
+        for met, getter in metrics.items():
+            if self._tier == "fast" and met not in NMAP_FAST_METRICS:
                 continue
-            
+
             # Add with handler just in case
-            try: 
-                self.add_update(met, val)
+            try:
+                values[met] = getter()
+
+            except:
+                logging.exception(f'Failed to add metric {met} for {self._entity}')
 
-            except: 
-                logging.exception(f'Failed to add metric {met} for {entity}')
+        self.add_updates(values, {"tier": self._tier} if self._tier else None)
 
-        logging.info(f'Finished NMAP producer for {entity}')
+        logging.debug(f'Finished NMAP producer for {self._entity}')
 
     def get_state(self) -> str:
         """
         Get the state of the entity with NMAP
         """
-        return self._nm[self._nm_entity].state()
-
-    def get_hostname(self) -> str: 
-        return self._nm[self._nm_entity].hostname()
-
-    def get_time(self) -> str: 
-        return self._nm[self._nm_entity].get("scanstats").get("elapsed")
-    
-    def get_device(self) -> str: 
-        return self._nm[self._nm_entity].get("osmatch").get("name")
-    
-    def get_brand(self) -> str: 
-        return self._nm[self._nm_entity].get("osmatch").get("osclass").get("vendor")
-    
-    def get_type(self) -> str: 
-        return self._nm[self._nm_entity].get("osmatch").get("osclass").get("type")
-    
-    def get_os(self) -> str: 
-        return self._nm[self._nm_entity].get("osmatch").get("osclass").get("osfamily")
-
-    def get_port_count(self) -> str:
-        count = 0 
-
-        count += len(self.get_ports_ip(True))
-        count += len(self.get_ports_sctp(True))
-        count += len(self.get_ports_tcp(True))
-        count += len(self.get_ports_udp(True))
-
-        return count
-    
-    def _split_format_count(self, port_list: dict[int, dict]) -> list[str, int]: 
-        """
-        Private method to split a list of ports into a human readable string and count
-        
-        Inputs: 
-            port_list: dict[int, dict] of ports
-            
-        Returns: 
-            list[str, int]: [0] - Human readable port list, [1] - Number of ports
-        """
-        count = len(port_list)
-
-        if port_list is None or count < 1: 
-            return ["No open ports", 0]
-
-        open_ports = list() 
-        for port, port_info in port_list.items(): 
-            state = port_info.get("state")
-
-            # Only target open ports
-            if state != "open": 
-                continue
+        return self._host.get("status", dict()).get("state")
 
-            # Don't add duplicates
-            if port in open_ports: 
-                continue
+    def get_hostname(self) -> str:
+        hostnames = self._host.get("hostnames") or [dict()]
+        return hostnames[0].get("name") or None
 
-            # Then add to list
-            open_ports.append(port)
+    def get_time(self) -> str:
+        return self._host.get("scanstats", dict()).get("elapsed")
 
-        hum_ports = ", ".join(sorted(open_ports))
-        return [hum_ports, count]
+    def _osmatch(self) -> dict:
+        """
+        Best OS match of the host
+        """
+        matches = self._host.get("osmatch") or [dict()]
+        return matches[0]
 
-    def get_ports_ip(self, count: bool = False) -> str: 
-        ports = self._nm[self._nm_entity].get("ip")
+    def _osclass(self) -> dict:
+        """
+        Best OS class of the best OS match
+        """
+        classes = self._osmatch().get("osclass") or [dict()]
+        return classes[0]
 
-        [hum_ports, count_ports] = self._split_format_count(ports)
+    def get_device(self) -> str:
+        return self._osmatch().get("name")
 
-        if count: 
-            return count_ports
-        
-        return hum_ports
-    
-    def get_ports_sctp(self, count: bool = False) -> str:
-        ports = self._nm[self._nm_entity].get("sctp")
+    def get_brand(self) -> str:
+        return self._osclass().get("vendor")
 
-        [hum_ports, count_ports] = self._split_format_count(ports)
+    def get_device_type(self) -> str:
+        return self._osclass().get("type")
 
-        if count: 
-            return count_ports
-        
-        return hum_ports
-    
-    def get_ports_tcp(self, count: bool = False) -> str:
-        ports = self._nm[self._nm_entity].get("tcp")
+    def get_os(self) -> str:
+        return self._osclass().get("osfamily")
 
-        [hum_ports, count_ports] = self._split_format_count(ports)
+    def get_port_set(self) -> PortSet:
+        """
+        Open ports of the host, built once per producer
+        """
+        if self._ports is None:
+            self._ports = PortSet.from_host(self._host)
+
+        return self._ports
+
+    def get_port_count(self) -> int:
+        return len(self.get_port_set())
+
+    def get_ports_ip(self, count: bool = False) -> str:
+        return self._get_ports("ip", count)
+
+    def get_ports_sctp(self, count: bool = False) -> str:
+        return self._get_ports("sctp", count)
+
+    def get_ports_tcp(self, count: bool = False) -> str:
+        return self._get_ports("tcp", count)
 
-        if count: 
-            return count_ports
-        
-        return hum_ports
-    
     def get_ports_udp(self, count: bool = False) -> str:
-        ports = self._nm[self._nm_entity].get("udp")
+        return self._get_ports("udp", count)
 
-        [hum_ports, count_ports] = self._split_format_count(ports)
+    def _get_ports(self, protocol: str, count: bool) -> str:
+        """
+        Open ports of one protocol, rendered or counted
+        """
+        ports = self.get_port_set().protocol(protocol)
+
+        if count:
+            return len(ports)
+
+        return str(ports)
+
+    def get_ports_all(self, count: bool = False) -> str:
+        if count:
+            return self.get_port_count()
+
+        return str(self.get_port_set())
+
+
+class ScanState():
+    """
+    Scan State
 
-        if count: 
-            return count_ports
-        
-        return hum_ports
-    
-    def get_ports_all(self, count: bool = False) -> str: 
-        all_ports = list()
+    Last fast pass fingerprint, deep scan time and deep scan open ports of
+    every host, kept in a JSON file between sweeps
+    """
 
-        all_ports.append(self.get_ports_ip())
-        all_ports.append(self.get_ports_sctp())
-        all_ports.append(self.get_ports_tcp())
-        all_ports.append(self.get_ports_udp())
+    def __init__(self, path: str) -> None:
+        """
+        Load the Scan State, a missing or unreadable file starts empty
 
-        # This is so hack but sort by port number
-        j_ports = ", ".join(all_ports).split(",")
-        j_ports = [int(j) for j in j_ports]
+        Inputs:
+            path: str of the JSON state file
+        """
+        self._path = path
+        self._hosts = dict() # type: dict[str, dict]
 
-        ports = dict()
-        for port in j_ports: 
-            ports[port] = {"state": "open"}
+        try:
+            with open(path) as f:
+                self._hosts = json.load(f)
 
+        except FileNotFoundError:
+            pass
 
-        [hum_ports, count_ports] = self._split_format_count(ports)
+        except Exception as e:
+            logging.warning(f'Could not read NMAP state from {path}, starting fresh: {e}')
+
+    def changed(self, entity: str, fingerprint: str) -> bool:
+        """
+        Check if a fast pass differs from the last known one
+        """
+        return self._hosts.get(entity, dict()).get("fast") != fingerprint
+
+    def due(self, entity: str, interval: float) -> bool:
+        """
+        Check if a host's last deep scan is older than the interval
+        """
+        return time.time() - self._hosts.get(entity, dict()).get("deep", 0) > interval
+
+    def record_fast(self, entity: str, fingerprint: str) -> None:
+        self._hosts.setdefault(entity, dict())["fast"] = fingerprint
+
+    def ports(self, entity: str) -> PortSet:
+        """
+        Open ports of a host's last deep scan
+        """
+        return PortSet.from_dict(self._hosts.get(entity, dict()).get("ports"))
+
+    def record_deep(self, entity: str, ports: PortSet) -> None:
+        host = self._hosts.setdefault(entity, dict())
+        host["deep"] = time.time()
+        host["ports"] = ports.to_dict()
+
+    def save(self) -> None:
+        """
+        Write the state, replacing the file atomically
+        """
+        try:
+            with open(f'{self._path}.tmp', "w") as f:
+                json.dump(self._hosts, f)
+
+            os.replace(f'{self._path}.tmp', self._path)
+
+        except Exception as e:
+            logging.exception(f'Could not save NMAP state to {self._path}')
+
+
+def parse_hosts(stream: IO[bytes]) -> Iterator[dict]:
+    """
+    Parse nmap XML output incrementally, one host at a time
+
+    Inputs:
+        stream: IO[bytes] of nmap -oX output, read as it is written
+
+    Returns:
+        Iterator[dict]: hosts shaped like python-nmap's host results
+    """
+    for event, elem in ET.iterparse(stream, events=("end",)):
+        if elem.tag != "host":
+            continue
+
+        host = {
+            "hostnames": [{"name": s.get("name"), "type": s.get("type")} for s in elem.iterfind("hostnames/hostname")],
+            "addresses": {s.get("addrtype"): s.get("addr") for s in elem.iterfind("address")},
+            "status": {"state": None, "reason": None},
+            "osmatch": list()
+        }
 
-        if count: 
-            return count_ports
-        
-        return hum_ports
\ No newline at end of file
+        status = elem.find("status")
+        if status is not None:
+            host["status"] = {"state": status.get("state"), "reason": status.get("reason")}
+
+        # nmap stamps each host with when it started and finished
+        if elem.get("starttime") and elem.get("endtime"):
+            host["scanstats"] = {"elapsed": str(int(elem.get("endtime")) - int(elem.get("starttime")))}
+
+        for port in elem.iterfind("ports/port"):
+            state = port.find("state")
+            service = port.find("service")
+            service = service.attrib if service is not None else dict()
+
+            host.setdefault(port.get("protocol"), dict())[int(port.get("portid"))] = {
+                "state": state.get("state") if state is not None else None,
+                "reason": state.get("reason") if state is not None else None,
+                "name": service.get("name", ""),
+                "product": service.get("product", ""),
+                "version": service.get("version", ""),
+                "extrainfo": service.get("extrainfo", ""),
+                "conf": service.get("conf", "")
+            }
+
+        for match in elem.iterfind("os/osmatch"):
+            host["osmatch"].append({
+                "name": match.get("name"),
+                "accuracy": match.get("accuracy"),
+                "osclass": [{
+                    "type": s.get("type"),
+                    "vendor": s.get("vendor"),
+                    "osfamily": s.get("osfamily"),
+                    "osgen": s.get("osgen"),
+                    "accuracy": s.get("accuracy")
+                } for s in match.iterfind("osclass")]
+            })
+
+        yield host
+
+        # Finished hosts are not kept around
+        elem.clear()
@@ -1,3 +1,235 @@
-# TODO: Debate if I even want this or make this a different thing (this could replace inventory)
-# TODO: Hit hosts/websites for uptime with ping3/requests
-# TODO: speedtest hosts/websites with ping3/?
\ No newline at end of file
+from souls.default import Producer
+from os import getenv
+import asyncio
+import httpx
+import logging
+import math
+import time
+
+# Probes in flight at once across the fleet, and seconds each may take
+ONLINE_CONCURRENCY = int(getenv("ONLINE_CONCURRENCY", 512))
+ONLINE_TIMEOUT = float(getenv("ONLINE_TIMEOUT", 3))
+
+# Probes per target the round trip percentiles are taken over
+ONLINE_PROBES = int(getenv("ONLINE_PROBES", 3))
+
+# Ips are probed with a TCP connect to the first of these that answers, a refused connection still answers
+ONLINE_TCP_PORTS = [int(s) for s in getenv("ONLINE_TCP_PORTS", "443,80,22").split(",") if s.strip()]
+
+# Websites are probed over HTTP at this url, {entity} is the website's host
+ONLINE_HTTP_URL = getenv("ONLINE_HTTP_URL", "https://{entity}/")
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest rank percentile
+
+    Inputs:
+        values: list[float] sorted ascending
+        p: float between 0 and 1
+
+    Returns:
+        float: the percentile
+    """
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+class Online(Producer):
+    """
+    Online Producer class
+
+    Takes in entities and probes whether they are up, ips with TCP connects
+    and websites with HTTP requests over pooled keep-alive connections
+
+    Returns the metrics:
+        - Status (up or down)
+        - RTT p50 ms
+        - RTT p90 ms
+        - RTT max ms
+        - Probe Port (ips)
+        - HTTP Status (websites)
+    """
+
+    # Probes are cheap and all wait on the network, one event loop runs them all
+    pool = "thread"
+    concurrency = 1
+    timeout = 600
+    batch = True
+
+    source = "Online"
+
+    def __init__(self, type: str, entity: str) -> None:
+        """
+        Create an Online Producer, nothing is probed until run
+
+        Input:
+            entity: str to probe
+            type: str type of entity
+        """
+        super().__init__(entity, type, self.source)
+
+    async def arun(self, client: httpx.AsyncClient = None) -> list[dict]:
+        """
+        Probe the entity ONLINE_PROBES times
+
+        Inputs:
+            client: httpx.AsyncClient to probe websites with, one is created if not given
+
+        Returns:
+            list[dict]: status and, when up, round trip updates
+        """
+        if self.is_ip():
+            rtts, found = await self._probe_tcp()
+            extra = {"probe port": found}
+
+        elif client is None:
+            async with httpx.AsyncClient(timeout=ONLINE_TIMEOUT) as client:
+                rtts, found = await self._probe_http(client)
+
+            extra = {"http status": found}
+
+        else:
+            rtts, found = await self._probe_http(client)
+            extra = {"http status": found}
+
+        if not rtts:
+            self.add_update("status", "down")
+            return self.get_updates()
+
+        rtts = sorted(rtts)
+
+        self.add_updates({
+            "status": "up",
+            "rtt p50 ms": f'{percentile(rtts, 0.5):.1f}',
+            "rtt p90 ms": f'{percentile(rtts, 0.9):.1f}',
+            "rtt max ms": f'{rtts[-1]:.1f}',
+            **extra
+        })
+
+        return self.get_updates()
+
+    async def _connect(self, port: int) -> float:
+        """
+        Time one TCP connect
+
+        Returns:
+            float: milliseconds until the host answered, None if it didn't
+        """
+        start = time.perf_counter()
+
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self._entity, port), ONLINE_TIMEOUT)
+            writer.close()
+
+        # A reset still means the host is up
+        except ConnectionRefusedError:
+            pass
+
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+        return (time.perf_counter() - start) * 1000
+
+    async def _probe_tcp(self) -> tuple[list[float], int]:
+        """
+        Find a port that answers, then probe it again for the rest
+
+        Returns:
+            tuple[list[float], int]: round trips in milliseconds and the port
+        """
+        for port in ONLINE_TCP_PORTS:
+            rtt = await self._connect(port)
+
+            if rtt is None:
+                continue
+
+            rtts = [rtt] + [await self._connect(port) for _ in range(ONLINE_PROBES - 1)]
+
+            return [s for s in rtts if s is not None], port
+
+        return list(), None
+
+    async def _probe_http(self, client: httpx.AsyncClient) -> tuple[list[float], int]:
+        """
+        Time HEAD requests, falling back to GET where HEAD isn't allowed
+
+        Returns:
+            tuple[list[float], int]: round trips in milliseconds and the last status code
+        """
+        url = ONLINE_HTTP_URL.format(entity=self._entity)
+        rtts = list()
+        status = None
+        method = "HEAD"
+
+        for _ in range(ONLINE_PROBES):
+            start = time.perf_counter()
+
+            try:
+                res = await client.request(method, url)
+
+                if res.status_code == 405 and method == "HEAD":
+                    method = "GET"
+                    res = await client.request(method, url)
+
+            except httpx.HTTPError:
+                continue
+
+            rtts.append((time.perf_counter() - start) * 1000)
+            status = res.status_code
+
+        return rtts, status
+
+    @classmethod
+    def run_many(cls, type: str, entities: list[str]) -> list[dict]:
+        """
+        Probe every entity at once, see probe_many
+
+        Returns:
+            list[dict]: updates of every entity probed
+        """
+        producers = asyncio.run(cls.probe_many(type, entities))
+
+        return [update for producer in producers for update in producer.get_updates() or list()]
+
+    @classmethod
+    async def probe_many(cls, type: str, entities: list[str], concurrency: int = ONLINE_CONCURRENCY) -> list["Online"]:
+        """
+        Probe many entities concurrently, websites over one pooled client
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to probe
+            concurrency: int of targets probed at once
+
+        Returns:
+            list[Online]: producers holding their updates, failed probes are left out
+        """
+        producers = list()
+        for entity in entities:
+            try:
+                producers.append(cls(type, entity))
+
+            except Exception as e:
+                logging.warning(f'Skipping {entity} for Online: {e}')
+
+        start = time.perf_counter()
+
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def probe(client: httpx.AsyncClient, producer: Online) -> bool:
+            async with semaphore:
+                try:
+                    await producer.arun(client)
+                    return True
+
+                except Exception as e:
+                    logging.warning(f'Failed to probe {producer.get_entity()}: {e}')
+                    return False
+
+        async with httpx.AsyncClient(timeout=ONLINE_TIMEOUT, limits=limits) as client:
+            done = await asyncio.gather(*[probe(client, s) for s in producers])
+
+        logging.info(f'Probed {sum(done)} of {len(entities)} entities in {time.perf_counter() - start:.1f}s')
+
+        return [s for s, ok in zip(producers, done) if ok]
@@ -0,0 +1,137 @@
+from typing import Iterator
+
+# Protocols nmap reports ports for, in the order they are rendered
+PROTOCOLS = ["tcp", "udp", "sctp", "ip"]
+
+
+class PortSet():
+    """
+    Port Set
+
+    Ports per protocol held as one integer bitmask each, bit n set when port
+    n is in the set, so counting, merging and diffing whole scans are single
+    bitwise operations no matter how many ports there are
+
+    Only rendered to a string when it is reported
+    """
+
+    __slots__ = ["_masks"]
+
+    def __init__(self, masks: dict[str, int] = None) -> None:
+        """
+        Create a Port Set
+
+        Inputs:
+            masks: dict[str, int] of protocol to bitmask
+        """
+        self._masks = {s: m for s, m in (masks or dict()).items() if m} # type: dict[str, int]
+
+    @classmethod
+    def from_host(cls, host: dict, state: str = "open") -> "PortSet":
+        """
+        Create a Port Set from a scanned host
+
+        Inputs:
+            host: dict of the host, shaped like python-nmap's host results
+            state: str of the port state to keep
+
+        Returns:
+            PortSet: ports of the host in that state
+        """
+        masks = dict()
+
+        for protocol in PROTOCOLS:
+            mask = 0
+
+            for port, info in (host.get(protocol) or dict()).items():
+                if info.get("state") == state:
+                    mask |= 1 << int(port)
+
+            masks[protocol] = mask
+
+        return cls(masks)
+
+    @classmethod
+    def from_dict(cls, ports: dict[str, str]) -> "PortSet":
+        """
+        Create a Port Set from to_dict's output
+        """
+        return cls({s: int(m, 16) for s, m in (ports or dict()).items()})
+
+    def to_dict(self) -> dict[str, str]:
+        """
+        Port Set as JSON serializable hex bitmasks
+
+        Returns:
+            dict[str, str]: protocol to hex bitmask
+        """
+        return {s: format(m, "x") for s, m in self._masks.items()}
+
+    def add(self, protocol: str, port: int) -> None:
+        self._masks[protocol] = self._masks.get(protocol, 0) | 1 << port
+
+    def protocol(self, protocol: str) -> "PortSet":
+        """
+        Ports of only one protocol
+        """
+        return PortSet({protocol: self._masks.get(protocol, 0)})
+
+    def ports(self, protocol: str) -> Iterator[int]:
+        """
+        Ports of a protocol in ascending order
+        """
+        mask = self._masks.get(protocol, 0)
+
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def diff(self, previous: "PortSet") -> tuple["PortSet", "PortSet"]:
+        """
+        Compare against an earlier Port Set
+
+        Inputs:
+            previous: PortSet of the earlier scan
+
+        Returns:
+            tuple[PortSet, PortSet]: opened and closed since the earlier scan
+        """
+        return self - previous, previous - self
+
+    def __or__(self, other: "PortSet") -> "PortSet":
+        return PortSet({s: self._masks.get(s, 0) | other._masks.get(s, 0) for s in self._masks.keys() | other._masks.keys()})
+
+    def __sub__(self, other: "PortSet") -> "PortSet":
+        return PortSet({s: m & ~other._masks.get(s, 0) for s, m in self._masks.items()})
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, PortSet) and self._masks == other._masks
+
+    def __len__(self) -> int:
+        return sum(m.bit_count() for m in self._masks.values())
+
+    def __str__(self) -> str:
+        """
+        Human readable ports with consecutive ports collapsed into ranges,
+        prefixed by protocol when more than one has ports
+        """
+        protocols = [s for s in PROTOCOLS if self._masks.get(s)]
+
+        if not protocols:
+            return "No open ports"
+
+        rendered = list()
+        for protocol in protocols:
+            ranges = list()
+
+            for port in self.ports(protocol):
+                if ranges and ranges[-1][1] == port - 1:
+                    ranges[-1][1] = port
+                else:
+                    ranges.append([port, port])
+
+            ports = ", ".join(str(s) if s == e else f'{s}-{e}' for s, e in ranges)
+            rendered.append(f'{protocol} {ports}' if len(protocols) > 1 else ports)
+
+        return "; ".join(rendered)
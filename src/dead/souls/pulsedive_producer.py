@@ -1 +1,57 @@
-# TODO: pulsedive thing https://pulsedive.com/api/
\ No newline at end of file
+from souls.enrichment import EnrichmentProducer, Provider
+from os import getenv
+
+PULSEDIVE_API_URL = getenv("PULSEDIVE_API_URL", "https://pulsedive.com/api/")
+PULSEDIVE_DAILY_QUOTA = int(getenv("PULSEDIVE_DAILY_QUOTA", 500))
+
+
+class PulsediveProvider(Provider):
+    """
+    Pulsedive indicator info, risk and the threats and feeds an indicator is on
+    """
+
+    name = "Pulsedive"
+    key_env = "PULSEDIVE_API_KEY"
+
+    rate = 0.5
+    daily_quota = PULSEDIVE_DAILY_QUOTA
+
+    kinds = ["ipv4", "ipv6", "website"]
+
+    def request(self, indicator: str, key: str) -> dict:
+        return {
+            "method": "GET",
+            "url": f'{PULSEDIVE_API_URL}info.php',
+            "params": {"indicator": indicator, "key": key}
+        }
+
+    def updates(self, answer: dict) -> dict[str, str]:
+        if answer is None:
+            return {"risk": "unknown"}
+
+        threats = sorted(s.get("name") for s in answer.get("threats") or list() if s.get("name"))
+        feeds = sorted(s.get("name") for s in answer.get("feeds") or list() if s.get("name"))
+
+        return {
+            "risk": answer.get("risk"),
+            "threats": ", ".join(threats) or "None",
+            "feeds": ", ".join(feeds) or "None",
+            "last seen": answer.get("stamp_seen")
+        }
+
+
+class Pulsedive(EnrichmentProducer):
+    """
+    Pulsedive Producer class
+
+    Takes in ips and websites and checks them against Pulsedive
+
+    Returns the metrics:
+        - Risk
+        - Threats
+        - Feeds
+        - Last Seen
+    """
+
+    provider = PulsediveProvider
+    source = PulsediveProvider.name
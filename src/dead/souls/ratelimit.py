@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket():
+    """
+    Token Bucket
+
+    Refills at rate tokens a second up to capacity, every call takes tokens
+    and waits for them when the bucket is empty. Safe to share between
+    threads, and between coroutines through aacquire
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        """
+        Create a Token Bucket, starting full
+
+        Inputs:
+            rate: float of tokens added a second
+            capacity: float of most tokens held at once, rate if not given
+        """
+        if rate <= 0:
+            raise ValueError("Rate should be more than 0")
+
+        self._rate = rate
+        self._capacity = max(capacity or rate, 1)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float) -> float:
+        """
+        Take tokens if there are enough
+
+        Returns:
+            float: 0 if taken, otherwise seconds until there will be enough
+        """
+        if tokens > self._capacity:
+            raise ValueError(f'Cannot take {tokens} tokens from a bucket of {self._capacity}')
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+
+            return (tokens - self._tokens) / self._rate
+
+    def acquire(self, tokens: float = 1, timeout: float = None) -> bool:
+        """
+        Take tokens, waiting until there are enough
+
+        Inputs:
+            tokens: float to take, at most the capacity
+            timeout: float of seconds to wait at most, forever if not given
+
+        Returns:
+            bool: whether the tokens were taken
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while (wait := self._take(tokens)) > 0:
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+
+            time.sleep(wait)
+
+        return True
+
+    async def aacquire(self, tokens: float = 1, timeout: float = None) -> bool:
+        """
+        Take tokens without blocking the event loop, see acquire
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while (wait := self._take(tokens)) > 0:
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+
+            await asyncio.sleep(wait)
+
+        return True
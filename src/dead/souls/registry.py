@@ -0,0 +1,123 @@
+from souls.default import Producer
+from os import getenv
+import importlib
+import logging
+import os
+import time
+import tracemalloc
+
+# Every producer a soul can run, imported only once it is enabled and scheduled
+MANIFEST = {
+    "nmap": "souls.nmap_producer:NMAP",
+    "crowdsec": "souls.crowdsec_producer:Crowdsec",
+    "shodan": "souls.shodan_producer:Shodan",
+    "online": "souls.online_producer:Online",
+    "maxmind": "souls.maxmind_producer:MaxMind",
+    "greynoise": "souls.greynoise_producer:GreyNoise",
+    "pulsedive": "souls.pulsedive_producer:Pulsedive",
+    "google": "souls.google_producer:Google"
+}
+
+# Comma separated producers this soul runs, paid APIs and ones needing local data (maxmind) are opt in (ie. 'nmap,crowdsec,online,shodan')
+SOUL_PRODUCERS = getenv("SOUL_PRODUCERS", "nmap,crowdsec,online")
+
+_LOADED = dict() # type: dict[str, type[Producer]]
+_STATS = dict() # type: dict[str, dict]
+
+
+def enabled() -> list[str]:
+    """
+    Producers enabled by SOUL_PRODUCERS, unknown names are skipped
+
+    Returns:
+        list[str]: names of enabled producers
+    """
+    names = list()
+
+    for name in SOUL_PRODUCERS.split(","):
+        name = name.strip().lower()
+
+        if not name:
+            continue
+
+        if name not in MANIFEST:
+            logging.warning(f'Unknown producer {name}, expected one of {list(MANIFEST)}')
+            continue
+
+        names.append(name)
+
+    return names
+
+
+def resident_bytes() -> int:
+    """
+    Resident memory of this process
+
+    Returns:
+        int: bytes resident, or None where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def load(name: str) -> type[Producer]:
+    """
+    Import a producer on first use, recording how long it took, how much
+    memory its import allocated and how much resident memory it added
+
+    Inputs:
+        name: str of the producer in the manifest
+
+    Returns:
+        type[Producer]: the producer class
+
+    Raises:
+        KeyError: if the producer isn't in the manifest
+        ImportError: if its module or dependencies are missing
+    """
+    if name in _LOADED:
+        return _LOADED[name]
+
+    module, attribute = MANIFEST[name].split(":")
+
+    # Only trace when nothing else is, so the numbers are this import's alone
+    tracing = not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+
+    # Native extensions don't allocate through Python, resident memory catches them
+    resident = resident_bytes()
+    start = time.perf_counter()
+
+    try:
+        producer = getattr(importlib.import_module(module), attribute)
+
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracing else None
+
+        if tracing:
+            tracemalloc.stop()
+
+    rss = resident_bytes() - resident if resident is not None else None
+
+    _LOADED[name] = producer
+    _STATS[name] = {"import_seconds": elapsed, "import_bytes": peak, "import_rss_bytes": rss}
+
+    logging.info(f'Loaded producer {name} in {elapsed * 1000:.1f}ms' + (f', {peak / 1024 / 1024:.1f}MiB allocated' if peak is not None else '') + (f', {rss / 1024 / 1024:.1f}MiB resident' if rss is not None else ''))
+
+    return producer
+
+
+def stats() -> dict[str, dict]:
+    """
+    Import time and memory of every producer loaded so far
+
+    Returns:
+        dict[str, dict]: name to import_seconds, import_bytes and import_rss_bytes
+    """
+    return {s: dict(v) for s, v in _STATS.items()}
@@ -0,0 +1,284 @@
+from os import getenv
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+# Where souls keep producer results between runs, empty to disable
+RESULT_CACHE_PATH = getenv("RESULT_CACHE_PATH", "soul_results.db")
+
+# Entities read per query, SQLite binds at most 999 variables on older builds
+RESULT_CACHE_CHUNK = 900
+
+
+class ResultCache():
+    """
+    Result Cache
+
+    Last get_updates() payload of every (entity, source, parameters) kept in
+    SQLite, so a restarted soul reuses fresh results instead of scanning again
+    and results that never reached Necromancer can be posted again
+
+    Third party enrichment responses and daily quota spend are kept
+    alongside, see souls/enrichment.py
+
+    A connection is opened per call, so the cache can be shared by threads and
+    processes of the same soul
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Create a Result Cache, creating the database if needed
+
+        Inputs:
+            path: str of the SQLite file
+        """
+        self._path = path
+
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "entity TEXT NOT NULL, source TEXT NOT NULL, params TEXT NOT NULL, "
+                "updates TEXT NOT NULL, created REAL NOT NULL, posted INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (entity, source, params))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS results_posted ON results (posted)")
+
+            # Third party responses and daily quota spend, see souls/enrichment.py
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "provider TEXT NOT NULL, indicator TEXT NOT NULL, response TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (provider, indicator))"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS quotas ("
+                "provider TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, "
+                "PRIMARY KEY (provider, day))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=30)
+
+    @staticmethod
+    def key(entity: str, source: str, params: dict) -> tuple[str, str, str]:
+        """
+        Cache key of a producer run
+
+        Inputs:
+            entity: str as Necromancer stores it
+            source: str of the producer
+            params: dict of scan parameters, hashed so secrets aren't stored
+
+        Returns:
+            tuple[str, str, str]: entity, source and parameters hash
+        """
+        params = json.dumps(params or dict(), sort_keys=True)
+
+        return entity.strip(), source, hashlib.sha256(params.encode()).hexdigest()
+
+    def get(self, entity: str, source: str, params: dict, ttl: float) -> tuple[list[dict], bool]:
+        """
+        Get the cached updates of a run if younger than the TTL, see get_many
+        """
+        return self.get_many([entity], source, params, ttl).get(entity)
+
+    def get_many(self, entities: list[str], source: str, params: dict, ttl: float) -> dict[str, tuple[list[dict], bool]]:
+        """
+        Get the cached updates of many runs younger than the TTL over one connection
+
+        Inputs:
+            entities: list[str] the producer ran over
+            source: str of the producer
+            params: dict of scan parameters
+            ttl: float of seconds a result stays fresh
+
+        Returns:
+            dict[str, tuple[list[dict], bool]]: entity to its cached updates and whether they were posted, entities without a fresh result are left out
+        """
+        digest = self.key("", source, params)[2]
+        keys = {s.strip(): s for s in entities}
+        found = dict()
+
+        try:
+            with self._connect() as db:
+                # Under SQLite's limit of bound variables
+                names = list(keys)
+                for i in range(0, len(names), RESULT_CACHE_CHUNK):
+                    chunk = names[i:i + RESULT_CACHE_CHUNK]
+
+                    rows = db.execute(
+                        f'SELECT entity, updates, posted FROM results WHERE source = ? AND params = ? AND created > ? AND entity IN ({",".join("?" * len(chunk))})',
+                        (source, digest, time.time() - ttl, *chunk)
+                    ).fetchall()
+
+                    for entity, updates, posted in rows:
+                        found[keys[entity]] = (json.loads(updates), bool(posted))
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not read {source} results from the result cache: {e}')
+            return dict()
+
+        return found
+
+    def put(self, entity: str, source: str, params: dict, updates: list[dict]) -> None:
+        """
+        Store the updates of a run, replacing the last one, as not yet posted, see put_many
+        """
+        self.put_many(source, params, {entity: updates})
+
+    def put_many(self, source: str, params: dict, results: dict[str, list[dict]]) -> None:
+        """
+        Store the updates of many runs in one transaction, replacing the last
+        ones, as not yet posted
+
+        Inputs:
+            source: str of the producer
+            params: dict of scan parameters
+            results: dict[str, list[dict]] of entity to its updates from get_updates()
+        """
+        if not results:
+            return
+
+        digest = self.key("", source, params)[2]
+        created = time.time()
+
+        try:
+            with self._connect() as db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO results (entity, source, params, updates, created, posted) VALUES (?, ?, ?, ?, ?, 0)",
+                    [(s.strip(), source, digest, json.dumps(u or list()), created) for s, u in results.items()]
+                )
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not write {len(results)} {source} results to the result cache: {e}')
+
+    def mark_posted(self, updates: list[dict]) -> None:
+        """
+        Mark the runs that produced these updates as posted to Necromancer
+
+        Inputs:
+            updates: list[dict] that were accepted
+        """
+        pairs = {(s.get("entity").strip(), s.get("source")) for s in updates}
+
+        try:
+            with self._connect() as db:
+                db.executemany("UPDATE results SET posted = 1 WHERE entity = ? AND source = ? AND posted = 0", pairs)
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not mark results as posted: {e}')
+
+    def unposted(self) -> list[dict]:
+        """
+        Updates of every run that was not posted to Necromancer
+
+        Returns:
+            list[dict]: updates to post again
+        """
+        try:
+            with self._connect() as db:
+                rows = db.execute("SELECT updates FROM results WHERE posted = 0").fetchall()
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not read unposted results: {e}')
+            return list()
+
+        return [update for row in rows for update in json.loads(row[0])]
+
+
+    def get_response(self, provider: str, indicator: str) -> tuple[bool, dict]:
+        """
+        Get a provider's unexpired response for an indicator
+
+        Inputs:
+            provider: str name of the provider
+            indicator: str looked up
+
+        Returns:
+            tuple[bool, dict]: whether there was one, and the response (None for unknown)
+        """
+        try:
+            with self._connect() as db:
+                row = db.execute(
+                    "SELECT response FROM responses WHERE provider = ? AND indicator = ? AND expires > ?",
+                    (provider, indicator, time.time())
+                ).fetchone()
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not read {provider} response for {indicator}: {e}')
+            return False, None
+
+        if row is None:
+            return False, None
+
+        return True, json.loads(row[0])
+
+    def put_response(self, provider: str, indicator: str, response: dict, ttl: float) -> None:
+        """
+        Store a provider's response for an indicator
+
+        Inputs:
+            provider: str name of the provider
+            indicator: str looked up
+            response: dict of the response, None for unknown
+            ttl: float of seconds to keep it
+        """
+        try:
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (provider, indicator, response, expires) VALUES (?, ?, ?, ?)",
+                    (provider, indicator, json.dumps(response), time.time() + ttl)
+                )
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not write {provider} response for {indicator}: {e}')
+
+    def spend(self, provider: str, day: str, quota: int) -> bool:
+        """
+        Spend one request of a provider's daily quota, atomically across processes
+
+        Inputs:
+            provider: str name of the provider
+            day: str of the quota day (ie. '2024-01-31')
+            quota: int of requests a day
+
+        Returns:
+            bool: whether there was quota left to spend, False when it can't be
+            counted so a paid quota is never overrun
+        """
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR IGNORE INTO quotas (provider, day, used) VALUES (?, ?, 0)", (provider, day))
+
+                return db.execute(
+                    "UPDATE quotas SET used = used + 1 WHERE provider = ? AND day = ? AND used < ?",
+                    (provider, day, quota)
+                ).rowcount == 1
+
+        except sqlite3.Error as e:
+            logging.warning(f'Could not spend {provider} quota, not looking up: {e}')
+            return False
+
+
+_RESULT_CACHE = None # type: ResultCache
+
+
+def get_result_cache() -> ResultCache:
+    """
+    Get the soul's Result Cache, created on first use
+
+    Returns:
+        ResultCache: or None when RESULT_CACHE_PATH is empty or unusable
+    """
+    global _RESULT_CACHE
+
+    if _RESULT_CACHE is None and RESULT_CACHE_PATH:
+        try:
+            _RESULT_CACHE = ResultCache(RESULT_CACHE_PATH)
+
+        except sqlite3.Error as e:
+            logging.warning(f'Result cache disabled, could not open {RESULT_CACHE_PATH}: {e}')
+
+    return _RESULT_CACHE
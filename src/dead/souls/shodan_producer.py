@@ -1,45 +1,290 @@
-# TODO: Implement shodan producer (kinda started)
-from util.json import get_env_variable
+from souls.default import Producer, classify_entity, redact
+from souls.ports import PortSet
+from souls.ratelimit import TokenBucket
+from os import getenv
+import logging
+import requests
 import time
 
+SHODAN_API_URL = getenv("SHODAN_API_URL", "https://api.shodan.io/")
+SHODAN_TIMEOUT = float(getenv("SHODAN_TIMEOUT", 30))
 
-def main():
-    print("Gathering ENVs")
-    shodan_api_key = get_env_variable("SHODAN_API_KEY")
-    shodan_query = get_env_variable("SHODAN_QUERY")
-    kafka_connection = get_env_variable("KAFKA_CONNECTION")
+# Addresses per host lookup, they all go in the url
+SHODAN_BATCH_SIZE = int(getenv("SHODAN_BATCH_SIZE", 100))
 
-    # Start delay
-    delay = int(get_env_variable("DELAY"))
-    time.sleep(delay)
+# Requests a second across the soul, and query credits each lookup costs (0 to not track credits)
+SHODAN_RATE = float(getenv("SHODAN_RATE", 1))
+SHODAN_LOOKUP_CREDITS = int(getenv("SHODAN_LOOKUP_CREDITS", 1))
+SHODAN_RETRIES = int(getenv("SHODAN_RETRIES", 3))
 
-    print("Connecting to Shodan.io")
-    api = shodanAPI(shodan_api_key)
+# Seconds a host's results are reused for instead of looking it up again
+SHODAN_CACHE_TTL = float(getenv("SHODAN_CACHE_TTL", 86400))
 
-    print("Connecting to Kafka")
-    producer = KafkaConnection(kafka_connection, "shodan-producer")
+# Most characters of a value Necromancer takes
+SHODAN_VALUE_LENGTH = 1000
 
-    print("Starting send loop")
-    while True:
-        print("Sending")
+_BUCKET = TokenBucket(SHODAN_RATE)
 
+
+class Shodan(Producer):
+    """
+    Shodan Producer class
+
+    Takes in ips and looks them up on Shodan, many at a time, within the
+    request rate and query credits of the plan
+
+    Returns the metrics:
+        - Open Ports
+        - Open Port Count
+        - Vulns
+        - Vuln Count
+        - Banners
+        - Org
+        - OS
+        - Hostnames
+    """
+
+    # One lookup covers a whole batch, the bucket spaces them out
+    pool = "thread"
+    concurrency = 1
+    timeout = 3600
+    batch = True
+
+    source = "Shodan"
+    cache_ttl = SHODAN_CACHE_TTL
+
+    # Vulns and banners keep their case
+    capitalize_values = False
+
+    @classmethod
+    def settings(cls) -> dict:
+        """
+        Shodan key from SHODAN_API_KEY
+        """
+        return {
+            "shodan_api_key": getenv("SHODAN_API_KEY")
+        }
+
+    def __init__(self, type: str, entity: str, shodan_api_key: str) -> None:
+        """
+        Create a Shodan Producer, nothing is looked up until run
+
+        Input:
+            entity: str to look up
+            type: str type of entity
+            shodan_api_key: str of Shodan Key
+
+        Raises:
+            ValueError: if the entity isn't an ip or the key is missing
+        """
+        super().__init__(entity, type, self.source)
+
+        if not self.is_ip():
+            raise ValueError(f'Shodan Producer only supports ips')
+
+        if not shodan_api_key:
+            raise ValueError(f'Invalid Shodan API Key')
+
+        self._shodan_api_key = shodan_api_key
+
+    def run(self) -> list[dict]:
+        """
+        Look up the entity on its own
+
+        Returns:
+            list[dict]: updates of the host, or None if Shodan has nothing on it
+        """
+        with requests.Session() as session:
+            session.params = {"key": self._shodan_api_key}
+
+            for host in self.lookup(session, [self._entity]):
+                self.add_host(host)
+
+        return self.get_updates()
+
+    @classmethod
+    def run_many(cls, type: str, entities: list[str], shodan_api_key: str) -> list[dict]:
+        """
+        Look up every entity in batches of SHODAN_BATCH_SIZE
+
+        Stops early, leaving the rest for the next sweep, once the plan's query
+        credits would run out
+
+        Inputs:
+            type: str type of the entities
+            entities: list[str] to look up
+            shodan_api_key: str of Shodan Key
+
+        Returns:
+            list[dict]: updates of every host Shodan had results for
+        """
+        producers = dict() # type: dict[str, Shodan]
+        for entity in entities:
+            try:
+                producer = cls(type, entity, shodan_api_key)
+                producers[producer.get_entity()] = producer
+
+            except Exception as e:
+                logging.warning(f'Skipping {entity} for Shodan: {e}')
+
+        if not producers:
+            return list()
+
+        targets = list(producers)
+        looked_up = 0
+
+        with requests.Session() as session:
+            session.params = {"key": shodan_api_key}
+
+            credits = cls.credits(session) if SHODAN_LOOKUP_CREDITS else None
+
+            for i in range(0, len(targets), SHODAN_BATCH_SIZE):
+                if credits is not None and credits < SHODAN_LOOKUP_CREDITS:
+                    logging.warning(f'Out of Shodan query credits, {len(targets) - i} hosts left for the next sweep')
+                    break
+
+                batch = targets[i:i + SHODAN_BATCH_SIZE]
+
+                try:
+                    hosts = cls.lookup(session, batch)
+
+                except Exception as e:
+                    logging.warning(f'Failed to look up {len(batch)} hosts on Shodan: {redact(e, shodan_api_key)}')
+                    continue
+
+                if credits is not None:
+                    credits -= SHODAN_LOOKUP_CREDITS
+
+                for host in hosts:
+                    try:
+                        producer = producers.get(classify_entity(str(host.get("ip_str")))[1])
+
+                    except ValueError:
+                        continue
+
+                    if producer is not None:
+                        producer.add_host(host)
+                        looked_up += 1
+
+        logging.info(f'Finished Shodan lookups with results for {looked_up} of {len(entities)} entities')
+
+        return [update for producer in producers.values() for update in producer.get_updates() or list()]
+
+    @staticmethod
+    def credits(session: requests.Session) -> int:
+        """
+        Query credits left on the plan
+
+        Inputs:
+            session: requests.Session carrying the key
+
+        Returns:
+            int: query credits left, or None if they couldn't be read
+        """
         try:
-            result = api.raw_query(shodan_query)
+            _BUCKET.acquire()
+            res = session.get(f'{SHODAN_API_URL}api-info', timeout=SHODAN_TIMEOUT)
+            res.raise_for_status()
+
+            info = res.json()
+            logging.info(f'Shodan plan {info.get("plan")} has {info.get("query_credits")} query and {info.get("scan_credits")} scan credits left')
+
+            return info.get("query_credits")
+
+        except Exception as e:
+            logging.warning(f'Could not read Shodan credits, not tracking them: {redact(e, *session.params.values())}')
+            return None
+
+    @staticmethod
+    def lookup(session: requests.Session, ips: list[str]) -> list[dict]:
+        """
+        Look up many hosts with one request
+
+        Inputs:
+            session: requests.Session carrying the key
+            ips: list[str] of addresses
+
+        Returns:
+            list[dict]: Shodan host results, hosts it has nothing on are left out
+
+        Raises:
+            requests.HTTPError: if Shodan kept refusing the request
+        """
+        for attempt in range(SHODAN_RETRIES + 1):
+            _BUCKET.acquire()
+            res = session.get(f'{SHODAN_API_URL}shodan/host/{",".join(ips)}', timeout=SHODAN_TIMEOUT)
+
+            # Over the rate, back off and let the bucket refill
+            if res.status_code == 429 and attempt < SHODAN_RETRIES:
+                time.sleep(2 ** attempt)
+                continue
+
+            break
+
+        # No information on any of them
+        if res.status_code == 404:
+            return list()
+
+        res.raise_for_status()
+
+        hosts = res.json()
+
+        return hosts if isinstance(hosts, list) else [hosts]
+
+    def add_host(self, host: dict) -> None:
+        """
+        Add an update for every metric of a Shodan host result
+
+        Inputs:
+            host: dict of the host from Shodan
+        """
+        services = host.get("data") or list()
+
+        ports = PortSet()
+        for service in services:
+            ports.add(service.get("transport") or "tcp", int(service.get("port")))
+
+        # Results without service data still list their ports
+        for port in host.get("ports") or list():
+            if not services:
+                ports.add("tcp", int(port))
+
+        vulns = sorted(host.get("vulns") or list())
+        banners = [self._banner(s) for s in sorted(services, key=lambda s: (s.get("port"), s.get("transport")))]
+
+        self.add_updates({
+            "open ports": str(ports),
+            "open port count": len(ports),
+            "vulns": self._fit(vulns) if vulns else "No known vulns",
+            "vuln count": len(vulns),
+            "banners": self._fit([s for s in banners if s]) if services else None,
+            "org": host.get("org"),
+            "os": host.get("os"),
+            "hostnames": self._fit(host.get("hostnames") or list()) or None
+        })
+
+    @staticmethod
+    def _banner(service: dict) -> str:
+        """
+        Short banner of a service, product and version or the first line it sent
+        """
+        name = " ".join(str(service.get(s)) for s in ["product", "version"] if service.get(s))
 
-            for res in result:
-                producer.send(value=res, key="generic")
-                time.sleep(5)
+        if not name:
+            name = (service.get("data") or "").strip().split("\n")[0][:80]
 
-            print("Sent")
+        name = "".join(s for s in name if s.isprintable())
 
-        except ValueError:
-            print(
-                "Failed to send: ran into an error querying the Shodan API.. Continuing"
-            )
+        return f'{service.get("port")}/{service.get("transport") or "tcp"} {name}'.strip()
 
-        time.sleep(delay)
+    @staticmethod
+    def _fit(values: list[str]) -> str:
+        """
+        Join values, cutting them off to fit in one update
+        """
+        joined = ", ".join(values)
 
+        if len(joined) > SHODAN_VALUE_LENGTH:
+            joined = joined[:SHODAN_VALUE_LENGTH - 5].rsplit(", ", 1)[0] + ", ..."
 
-# Only run in main
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+        return joined
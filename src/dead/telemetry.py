@@ -0,0 +1,75 @@
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from typing import Iterator
+from entity_cache import EntityCache
+from ingest import IngestQueue
+
+# Buckets from 1ms to 10s, ingest requests should sit at the low end
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    "necromancer_request_seconds",
+    "Latency of Necromancer requests by route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS
+)
+
+MONGO_LATENCY = Histogram(
+    "necromancer_mongo_seconds",
+    "Latency of MongoDB operations by call site",
+    ["site"],
+    buckets=LATENCY_BUCKETS
+)
+
+UPDATES = Counter(
+    "necromancer_updates_total",
+    "Updates by result (validated, rejected, changed)",
+    ["result"]
+)
+
+INGEST_QUEUE_DEPTH = Gauge(
+    "necromancer_ingest_queue_depth",
+    "Updates waiting in the ingest queue"
+)
+
+class EntityCacheCollector():
+    """
+    Entity Cache Collector
+
+    Reads the entity cache's stats at scrape time, its size as a gauge and
+    its hits, misses and evictions as the counters they are so rate() works
+    """
+
+    def __init__(self, cache: EntityCache) -> None:
+        self._cache = cache
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        stats = self._cache.stats()
+
+        yield GaugeMetricFamily("necromancer_entity_cache_size", "Entities held in the entity cache", value=stats.get("size"))
+
+        for stat in ["hits", "misses", "evictions"]:
+            yield CounterMetricFamily(f'necromancer_entity_cache_{stat}', f'Entity cache {stat}', value=stats.get(stat))
+
+
+def register_gauges(queue: IngestQueue, cache: EntityCache) -> None:
+    """
+    Read the ingest queue and entity cache metrics at scrape time
+
+    Inputs:
+        queue: IngestQueue or None when write-behind is disabled
+        cache: EntityCache of Necromancer
+    """
+    INGEST_QUEUE_DEPTH.set_function(lambda: queue.depth() if queue else 0)
+
+    REGISTRY.register(EntityCacheCollector(cache))
+
+
+def render() -> tuple[bytes, str]:
+    """
+    Render every metric in the Prometheus text format
+
+    Returns:
+        tuple[bytes, str]: body and content type
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
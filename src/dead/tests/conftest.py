@@ -0,0 +1,10 @@
+from os import environ
+import os
+import sys
+
+# Modules are imported the way necromancer and soul import each other
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Necromancer creates its Mongo client on import, nothing connects until it is used
+environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+environ.setdefault("MONGO_DB", "paranoia_test")
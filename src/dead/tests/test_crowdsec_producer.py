@@ -0,0 +1,133 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from souls import crowdsec_producer
+from souls.crowdsec_producer import Crowdsec
+from urllib.parse import parse_qs, urlparse
+import asyncio
+import json
+import pytest
+import threading
+
+KEY = "lapi-key"
+
+DECISIONS = [
+    {"id": 1, "scope": "Ip", "value": "192.0.2.10"},
+    {"id": 2, "scope": "Range", "value": "198.51.100.0/24"},
+    {"id": 3, "scope": "Ip", "value": "2001:db8::1"},
+    {"id": 4, "scope": "Country", "value": "AQ"}
+]
+
+
+class LAPI(BaseHTTPRequestHandler):
+    """
+    Stub Crowdsec LAPI, answering /v1/decisions from DECISIONS and failing
+    the first request for each ip in the server's flaky set
+    """
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        self.server.requests.append((url.path, params))
+
+        if self.headers.get("X-Api-Key") != KEY:
+            return self.reply(403, {"message": "access forbidden"})
+
+        if url.path == "/v1/decisions/stream":
+            new = DECISIONS if params.get("startup") == ["true"] else list()
+            return self.reply(200, {"new": new, "deleted": None})
+
+        if url.path == "/v1/decisions":
+            ip = params["ip"][0]
+
+            if ip in self.server.flaky:
+                self.server.flaky.discard(ip)
+                return self.reply(503, {"message": "busy"})
+
+            banned = [s for s in DECISIONS if s["value"] == ip]
+            return self.reply(200, banned or None)
+
+        self.reply(404, {"message": "not found"})
+
+    def reply(self, status: int, body) -> None:
+        content = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def lapi():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LAPI)
+    server.requests = list()
+    server.flaky = set()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def url(server) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def statuses(producers: list[Crowdsec]) -> dict[str, str]:
+    return {s.get_entity(): s.get_updates()[0]["value"] for s in producers}
+
+
+def test_mirror(lapi, monkeypatch):
+    monkeypatch.setattr(crowdsec_producer, "CROWDSEC_MIRROR", True)
+    entities = ["192.0.2.10", "198.51.100.7", "203.0.113.1", "2001:db8::1", "example.com"]
+
+    producers = asyncio.run(Crowdsec.query_many("ip", entities, url(lapi), KEY))
+
+    assert statuses(producers) == {
+        "192.0.2.10": "Banned",
+        "198.51.100.7": "Banned",
+        "203.0.113.1": "Not banned",
+        "2001:db8::1": "Banned"
+    }
+
+    # A second lookup within the refresh interval is answered from memory
+    assert Crowdsec("ip", "198.51.100.200", url(lapi), KEY).query() == "Banned"
+    assert [s[0] for s in lapi.requests] == ["/v1/decisions/stream"]
+
+
+def test_query_many(lapi, monkeypatch):
+    monkeypatch.setattr(crowdsec_producer, "CROWDSEC_MIRROR", False)
+    monkeypatch.setattr(crowdsec_producer, "CROWDSEC_BACKOFF", 0)
+    lapi.flaky.add("192.0.2.10")
+
+    producers = asyncio.run(Crowdsec.query_many("ip", ["192.0.2.10", "203.0.113.1"], url(lapi), KEY, concurrency=2))
+
+    assert statuses(producers) == {"192.0.2.10": "Banned", "203.0.113.1": "Not banned"}
+
+    # The busy answer was retried
+    assert [s[1]["ip"][0] for s in lapi.requests].count("192.0.2.10") == 2
+
+
+def test_query_many_failures(lapi, monkeypatch):
+    monkeypatch.setattr(crowdsec_producer, "CROWDSEC_MIRROR", False)
+    monkeypatch.setattr(crowdsec_producer, "CROWDSEC_BACKOFF", 0)
+    lapi.flaky.add("192.0.2.10")
+
+    producers = asyncio.run(Crowdsec.query_many("ip", ["192.0.2.10", "203.0.113.1"], url(lapi), KEY, retries=0))
+    assert statuses(producers) == {"203.0.113.1": "Not banned"}
+
+    assert asyncio.run(Crowdsec.query_many("ip", ["203.0.113.1"], url(lapi), "wrong-key")) == list()
+
+
+def test_query(lapi, monkeypatch):
+    monkeypatch.setattr(crowdsec_producer, "CROWDSEC_MIRROR", False)
+
+    assert Crowdsec("ip", "2001:db8::1", url(lapi), KEY).query() == "Banned"
+    assert Crowdsec("ip", "203.0.113.1", url(lapi), KEY).run()[0]["value"] == "Not banned"
+
+    with pytest.raises(Exception):
+        Crowdsec("ip", "203.0.113.1", url(lapi), "wrong-key").query()
@@ -0,0 +1,72 @@
+from souls.default import Producer, classify_entity, redact
+import pytest
+
+
+class Probe(Producer):
+    source = "Test"
+
+    def __init__(self, type: str, entity: str) -> None:
+        super().__init__(entity, type, self.source)
+
+    def run(self) -> list[dict]:
+        return None
+
+
+@pytest.mark.parametrize("entity, expected", [
+    ("10.0.0.1", ("ipv4", "10.0.0.1")),
+    (" 10.0.0.1\n", ("ipv4", "10.0.0.1")),
+    ("2001:0DB8:0000::0001", ("ipv6", "2001:db8::1")),
+    ("[2001:db8::1]", ("ipv6", "2001:db8::1")),
+    ("https://[2001:db8::1]:8443/login", ("ipv6", "2001:db8::1")),
+    ("http://10.0.0.1/", ("ipv4", "10.0.0.1")),
+    ("Example.COM.", ("website", "example.com")),
+    ("https://User@WWW.Example.com:8080/a?b=c", ("website", "www.example.com")),
+    ("example.com:443/path", ("website", "example.com")),
+    ("bücher.example", ("website", "xn--bcher-kva.example"))
+])
+def test_classify_entity(entity, expected):
+    assert classify_entity(entity) == expected
+
+
+@pytest.mark.parametrize("entity", [
+    "",
+    "   ",
+    "localhost",
+    "10.0.0",
+    "10.0.0.256",
+    "-bad.example.com",
+    "bad_label.example.com",
+    "https://",
+    "a" * 64 + ".example.com",
+    "example.com\x00"
+])
+def test_classify_entity_invalid(entity):
+    with pytest.raises(ValueError):
+        classify_entity(entity)
+
+
+def test_classify_entity_memo():
+    classify_entity.cache_clear()
+
+    for _ in range(3):
+        classify_entity("2001:db8::2")
+
+    assert classify_entity.cache_info().hits == 2
+
+
+def test_producer_kind():
+    assert Probe("IP", " 10.0.0.1").get_entity() == "10.0.0.1"
+    assert Probe("ip", "10.0.0.1").get_type() == "ip"
+    assert Probe("ip", "2001:db8::1").is_ipv6()
+    assert Probe("website", "https://Example.com/").is_website()
+
+    with pytest.raises(ValueError):
+        Probe("website", "not a host")
+
+
+
+def test_redact():
+    error = Exception("Failed for url: https://api.example.com/?key=a%2Fb%2Bc&ip=10.0.0.1")
+
+    assert redact(error, "a/b+c") == "Failed for url: https://api.example.com/?key=<redacted>&ip=10.0.0.1"
+    assert redact(error, None) == str(error)
@@ -0,0 +1,152 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from souls import result_cache
+from souls.enrichment import EnrichmentClient, Provider, QuotaExceeded
+from souls.result_cache import ResultCache
+import json
+import logging
+import pytest
+import requests
+import threading
+import time
+
+KEY = "enrichment-secret-key"
+
+
+class API(BaseHTTPRequestHandler):
+    """
+    Fake lookup API, slow enough for lookups to overlap. It knows 10.x
+    addresses, fails 192.0.2.66 and knows nothing else
+    """
+
+    def do_GET(self) -> None:
+        indicator = self.path.split("?")[0].split("/")[-1]
+        self.server.requests.append(indicator)
+        time.sleep(self.server.delay)
+
+        if indicator == "192.0.2.66":
+            return self.reply(500, {"error": self.path})
+
+        if not indicator.startswith("10."):
+            return self.reply(404, {"error": "not found"})
+
+        self.reply(200, {"ip": indicator, "seen": True})
+
+    def reply(self, status: int, body) -> None:
+        content = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class FakeProvider(Provider):
+    name = "Fake"
+    key_env = "FAKE_API_KEY"
+
+    rate = 1000.0
+    daily_quota = 100
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def request(self, indicator: str, key: str) -> dict:
+        return {"method": "GET", "url": f'{self.url}lookup/{indicator}', "params": {"key": key}}
+
+    def updates(self, answer: dict) -> dict[str, str]:
+        return {"seen": "no" if answer is None else "yes"}
+
+
+@pytest.fixture
+def api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), API)
+    server.requests = list()
+    server.delay = 0
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+# Answers and quota kept in the process, and in the soul's result cache
+@pytest.fixture(params=["memory", "result cache"])
+def client(request, api, tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "results.db")) if request.param == "result cache" else None
+
+    monkeypatch.setattr(result_cache, "_RESULT_CACHE", cache)
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_PATH", "")
+
+    return EnrichmentClient(FakeProvider(f'http://127.0.0.1:{api.server_address[1]}/'), KEY)
+
+
+def test_coalesces(api, client):
+    api.delay = 0.2
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        answers = list(pool.map(client.lookup, ["10.0.0.1"] * 8))
+
+    # Every concurrent lookup shared the one request
+    assert answers == [{"ip": "10.0.0.1", "seen": True}] * 8
+    assert api.requests == ["10.0.0.1"]
+
+    assert client.lookup("10.0.0.1") == answers[0]
+    assert api.requests == ["10.0.0.1"]
+
+
+def test_negative_cache(api, client):
+    assert client.lookup("192.0.2.1") is None
+    assert client.lookup("192.0.2.1") is None
+    assert api.requests == ["192.0.2.1"]
+
+    # Unknowns expire on their own TTL
+    client.provider.negative_ttl = 0
+
+    assert client.lookup("192.0.2.2") is None
+    assert client.lookup("192.0.2.2") is None
+    assert api.requests == ["192.0.2.1", "192.0.2.2", "192.0.2.2"]
+
+
+def test_failures_not_cached(api, client):
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            client.lookup("192.0.2.66")
+
+    assert api.requests == ["192.0.2.66", "192.0.2.66"]
+
+
+def test_quota(api, client):
+    client.provider.daily_quota = 2
+
+    assert client.lookup("10.0.0.1") and client.lookup("10.0.0.2")
+
+    # Cached answers don't spend quota
+    assert client.lookup("10.0.0.1")
+
+    with pytest.raises(QuotaExceeded):
+        client.lookup("10.0.0.3")
+
+    assert api.requests == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_lookup_many(api, client, caplog):
+    caplog.set_level(logging.WARNING)
+
+    answers = client.lookup_many(["10.0.0.1", "192.0.2.1", "10.0.0.1", "192.0.2.66"])
+
+    # The failed lookup is left out, the repeated one asked once
+    assert answers == {"10.0.0.1": {"ip": "10.0.0.1", "seen": True}, "192.0.2.1": None}
+    assert sorted(api.requests) == ["10.0.0.1", "192.0.2.1", "192.0.2.66"]
+    assert "Failed to look up 192.0.2.66 on Fake" in caplog.text
+    assert KEY not in caplog.text
+
+    client.provider.daily_quota = 3
+
+    assert client.lookup_many(["10.0.0.2", "10.0.0.3"]) == dict()
+    assert "2 lookups left for the next sweep" in caplog.text
@@ -0,0 +1,44 @@
+from ingest import IngestQueue
+import asyncio
+
+
+def drain(flush, retries: int) -> None:
+    async def run() -> None:
+        queue = IngestQueue(flush, 100, 10, 0.01, retries, backoff=0.01)
+        queue.start()
+
+        for update in range(5):
+            assert await queue.put(update)
+
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_flush_retries_failed_updates():
+    calls = list()
+
+    async def flush(batch: list) -> list:
+        calls.append(list(batch))
+
+        # Mongo is away for the first flush, then one update fails once more
+        if len(calls) == 1:
+            raise ConnectionError("Mongo is away")
+
+        return [s for s in batch if s == 3] if len(calls) == 2 else list()
+
+    drain(flush, retries=3)
+
+    assert calls == [[0, 1, 2, 3, 4], [0, 1, 2, 3, 4], [3]]
+
+
+def test_flush_gives_up_after_retries():
+    calls = list()
+
+    async def flush(batch: list) -> list:
+        calls.append(list(batch))
+        return batch
+
+    drain(flush, retries=2)
+
+    assert len(calls) == 3
@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+import asyncio
+import necromancer
+import pytest
+
+
+class FakeUpdates():
+    """
+    Just enough of an async Mongo collection for compact_mongo_updates
+    """
+
+    def __init__(self, rows: list[dict]) -> None:
+        self.rows = rows
+        self.writes = list()
+        self.deleted = list()
+        self.dropped = list()
+
+    def find(self, query: dict, **kwargs):
+        async def rows():
+            for row in self.rows:
+                yield row
+
+        return rows()
+
+    async def bulk_write(self, ops: list, ordered: bool = True) -> None:
+        self.writes.append(ops)
+
+    async def delete_many(self, query: dict) -> None:
+        self.deleted.extend(query["_id"]["$in"])
+
+    async def index_information(self) -> dict:
+        return {"_id_": dict(), "timestamp_ttl": dict(), "entity_type_start": dict()}
+
+    async def drop_index(self, name: str) -> None:
+        self.dropped.append(name)
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    def install(rows: list[dict]) -> FakeUpdates:
+        collection = FakeUpdates(rows)
+        monkeypatch.setattr(necromancer, "MONGO_CLIENT", {"updates": collection})
+        monkeypatch.setattr(necromancer, "UpdateOne", lambda filter, update, upsert: (filter, update, upsert))
+
+        return collection
+
+    return install
+
+
+def row(id: int, metric: str, value: str, timestamp: datetime, entity: str = "10.0.0.1") -> dict:
+    return {"_id": id, "entity": entity, "type": "host", "source": "NMAP", "metric": metric, "value": value, "timestamp": timestamp}
+
+
+def test_bucket_start(monkeypatch):
+    monkeypatch.setattr(necromancer, "UPDATES_BUCKET_SECONDS", 86400)
+
+    assert necromancer._bucket_start(datetime(2024, 1, 31, 23, 59, 59)) == datetime(2024, 1, 31)
+    assert necromancer._bucket_start(datetime(2024, 2, 1)) == datetime(2024, 2, 1)
+
+
+def test_history_op(monkeypatch):
+    monkeypatch.setattr(necromancer, "UPDATES_BUCKET_SECONDS", 3600)
+
+    changes = [
+        necromancer._history_change({"source": "NMAP", "metric": "State", "value": "up", "timestamp": datetime(2024, 1, 31, 10, 30), "metadata": {"tier": "fast"}}),
+        necromancer._history_change({"source": "NMAP", "metric": "State", "value": "down", "timestamp": datetime(2024, 1, 31, 10, 5)})
+    ]
+
+    filter, update = necromancer._history_op("10.0.0.1", "host", changes)
+
+    assert filter == {"entity": "10.0.0.1", "type": "host", "start": datetime(2024, 1, 31, 10)}
+    assert update["$push"]["changes"]["$each"] == changes
+    assert update["$push"]["changes"]["$sort"] == {"timestamp": necromancer.ASCENDING}
+    assert update["$inc"] == {"count": 2}
+    assert update["$setOnInsert"] == {"end": datetime(2024, 1, 31, 11)}
+
+    assert changes[0]["metadata"] == {"tier": "fast"}
+    assert "metadata" not in changes[1]
+
+
+def test_compact_drops_repeats(updates, monkeypatch):
+    monkeypatch.setattr(necromancer, "UPDATES_BUCKET_SECONDS", 86400)
+
+    day = datetime(2024, 1, 31)
+    collection = updates([
+        row(1, "Ports", "22", day),
+        row(2, "Ports", "22", day + timedelta(hours=1)),
+        row(3, "Ports", "22, 80", day + timedelta(hours=2)),
+        row(4, "Ports", "22, 80", day + timedelta(days=1)),
+        row(5, "State", "up", day),
+        row(6, "State", "up", day, entity="10.0.0.2")
+    ])
+
+    counts = asyncio.run(necromancer.compact_mongo_updates(batch_size=1000))
+
+    assert counts == {"rows": 6, "changes": 4, "dropped": 2}
+    assert collection.deleted == [1, 2, 3, 4, 5, 6]
+    assert collection.dropped == ["timestamp_ttl"]
+
+    ops = {(f["entity"], f["start"]): u for f, u, upsert in collection.writes[0]}
+
+    assert all(upsert for _, _, upsert in collection.writes[0])
+    assert [(s["metric"], s["value"]) for s in ops[("10.0.0.1", day)]["$push"]["changes"]["$each"]] == [("Ports", "22"), ("Ports", "22, 80"), ("State", "up")]
+    assert ("10.0.0.1", day + timedelta(days=1)) not in ops
+    assert ops[("10.0.0.2", day)]["$inc"] == {"count": 1}
+
+
+def test_compact_in_batches(updates):
+    day = datetime(2024, 1, 31)
+    collection = updates([row(s, "Ports", str(s), day + timedelta(minutes=s)) for s in range(5)])
+
+    counts = asyncio.run(necromancer.compact_mongo_updates(batch_size=2))
+
+    assert counts == {"rows": 5, "changes": 5, "dropped": 0}
+    assert [len(s) for s in collection.writes] == [1, 1, 1]
+    assert sum(s[1]["$inc"]["count"] for ops in collection.writes for s in ops) == 5
+    assert collection.deleted == [0, 1, 2, 3, 4]
+
+
+def fake_entities(count: int, fail: bool = False):
+    async def iterate(type: str = None, after: tuple[str, str] = None, limit: int = None):
+        for i in range(count if limit is None else min(count, limit)):
+            yield {"entity": f'10.0.0.{i}', "type": "host"}
+
+        if fail:
+            raise ConnectionError("Mongo went away")
+
+    return iterate
+
+
+def test_stream_entities_marks_cut_off(monkeypatch):
+    monkeypatch.setattr(necromancer, "iter_mongo_entities", fake_entities(2, fail=True))
+
+    async def collect() -> list[bytes]:
+        return [s async for s in necromancer._stream_entities("host")]
+
+    lines = [necromancer.orjson.loads(s) for s in asyncio.run(collect())]
+
+    assert lines == [{"entity": "10.0.0.0", "type": "host"}, {"entity": "10.0.0.1", "type": "host"}, {"error": "Failed to query entities from Mongo"}]
+
+
+def test_get_entities_pages(monkeypatch):
+    monkeypatch.setattr(necromancer, "iter_mongo_entities", fake_entities(3))
+
+    first = asyncio.run(necromancer.get_entities(type="host", limit=2))
+
+    assert necromancer.orjson.loads(first.body) == ["10.0.0.0", "10.0.0.1"]
+    assert necromancer._decode_cursor(first.headers["X-Next-Cursor"]) == ("10.0.0.1", "host")
+
+    last = asyncio.run(necromancer.get_entities(type="host", limit=5))
+
+    assert necromancer.orjson.loads(last.body) == ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
+    assert "X-Next-Cursor" not in last.headers
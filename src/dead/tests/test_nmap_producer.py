@@ -0,0 +1,134 @@
+from souls.nmap_producer import NMAP, parse_hosts
+import io
+import nmap
+import os
+import pytest
+import sys
+
+SCAN = b"""<?xml version="1.0" encoding="UTF-8"?>
+<nmaprun scanner="nmap">
+<host starttime="100" endtime="112">
+<status state="up" reason="syn-ack"/>
+<address addr="10.0.0.1" addrtype="ipv4"/>
+<hostnames><hostname name="router.example.com" type="PTR"/></hostnames>
+<ports>
+<port protocol="tcp" portid="22"><state state="open" reason="syn-ack"/><service name="ssh" product="OpenSSH" version="9.6" conf="10"/></port>
+<port protocol="tcp" portid="80"><state state="open" reason="syn-ack"/><service name="http"/></port>
+<port protocol="tcp" portid="81"><state state="open" reason="syn-ack"/></port>
+<port protocol="udp" portid="53"><state state="open|filtered" reason="no-response"/></port>
+</ports>
+<os><osmatch name="Linux 5.X" accuracy="96"><osclass type="general purpose" vendor="Linux" osfamily="Linux" osgen="5.X" accuracy="96"/></osmatch></os>
+</host>
+<host starttime="100" endtime="101">
+<status state="down" reason="no-response"/>
+<address addr="2001:db8::1" addrtype="ipv6"/>
+<hostnames/>
+</host>
+</nmaprun>
+"""
+
+
+def test_parse_hosts():
+    hosts = list(parse_hosts(io.BytesIO(SCAN)))
+
+    assert len(hosts) == 2
+
+    host = hosts[0]
+    assert host["addresses"] == {"ipv4": "10.0.0.1"}
+    assert host["hostnames"] == [{"name": "router.example.com", "type": "PTR"}]
+    assert host["status"] == {"state": "up", "reason": "syn-ack"}
+    assert host["scanstats"] == {"elapsed": "12"}
+    assert host["tcp"][22]["product"] == "OpenSSH"
+    assert host["tcp"][81]["name"] == ""
+    assert host["udp"][53]["state"] == "open|filtered"
+    assert host["osmatch"][0]["osclass"][0]["vendor"] == "Linux"
+
+    assert hosts[1]["addresses"] == {"ipv6": "2001:db8::1"}
+    assert hosts[1]["status"]["state"] == "down"
+    assert "tcp" not in hosts[1]
+
+
+def test_parse_hosts_cut_off():
+    stream = io.BytesIO(SCAN[:SCAN.index(b"<host starttime=\"100\" endtime=\"101\">")])
+
+    hosts = parse_hosts(stream)
+
+    assert next(hosts)["addresses"] == {"ipv4": "10.0.0.1"}
+
+    try:
+        next(hosts)
+        assert False, "cut off output should not parse"
+
+    except Exception as e:
+        assert type(e).__name__ == "ParseError"
+
+
+def test_from_host_updates():
+    host = next(parse_hosts(io.BytesIO(SCAN)))
+
+    updates = {s["metric"]: s["value"] for s in NMAP.from_host("host", "10.0.0.1", host).get_updates()}
+
+    assert updates["State"] == "Up"
+    assert updates["Hostname"] == "Router.example.com"
+    assert updates["Open ports"] == "22, 80-81"
+    assert updates["Open port count"] == "3"
+    assert updates["Os"] == "Linux"
+
+
+def test_from_host_fast_tier():
+    host = next(parse_hosts(io.BytesIO(SCAN)))
+
+    updates = NMAP.from_host("host", "10.0.0.1", host, tier="fast").get_updates()
+
+    assert {s["metric"] for s in updates} == {"State", "Hostname"}
+    assert all(s["metadata"] == {"tier": "fast"} for s in updates)
+
+
+FAKE_NMAP = """#!{python}
+import sys
+
+targets = open(sys.argv[sys.argv.index("-iL") + 1]).read().split()
+
+if "--bad" in sys.argv:
+    sys.stderr.write("Unrecognized option --bad\\n")
+    sys.exit(255)
+
+sys.stdout.write('<?xml version="1.0"?>\\n<nmaprun>\\n')
+for target in targets:
+    sys.stdout.write(f'<host><status state="up" reason="syn-ack"/><address addr="{{target}}" addrtype="ipv4"/><hostnames/></host>\\n')
+sys.stdout.flush()
+
+if "--crash" in sys.argv:
+    sys.stderr.write("Segmentation fault\\n")
+    sys.exit(139)
+
+sys.stdout.write('</nmaprun>\\n')
+"""
+
+
+@pytest.fixture
+def fake_nmap(tmp_path, monkeypatch):
+    path = tmp_path / "nmap"
+    path.write_text(FAKE_NMAP.format(python=sys.executable))
+    path.chmod(0o755)
+
+    monkeypatch.setenv("PATH", f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+
+
+def test_scan_many(fake_nmap):
+    targets = [f'10.0.{s // 256}.{s % 256}' for s in range(5000)]
+
+    producers = list(NMAP.scan_many("host", targets, ports=None, arguments="-T4", timeout=60))
+
+    assert [s.get_entity() for s in producers] == targets
+
+
+def test_scan_many_bad_arguments(fake_nmap):
+    with pytest.raises(nmap.PortScannerError, match="Unrecognized option"):
+        list(NMAP.scan_many("host", ["10.0.0.1"], ports=None, arguments="--bad", timeout=60))
+
+
+def test_scan_many_crash_keeps_reported_hosts(fake_nmap):
+    producers = list(NMAP.scan_many("host", ["10.0.0.1", "10.0.0.2"], ports=None, arguments="--crash", timeout=60))
+
+    assert [s.get_entity() for s in producers] == ["10.0.0.1", "10.0.0.2"]
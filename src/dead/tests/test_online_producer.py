@@ -0,0 +1,104 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from souls import online_producer
+from souls.online_producer import Online, percentile
+import pytest
+import socket
+import threading
+
+
+class Site(BaseHTTPRequestHandler):
+    """
+    Website that doesn't allow HEAD, like many behind a framework's router
+    """
+
+    def do_HEAD(self) -> None:
+        self.server.methods.append("HEAD")
+        self.reply(405)
+
+    def do_GET(self) -> None:
+        self.server.methods.append("GET")
+        self.reply(200)
+
+    def reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def listener():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+
+    yield server.getsockname()[1]
+
+    server.close()
+
+
+@pytest.fixture
+def closed():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    server.close()
+
+    return port
+
+
+@pytest.fixture
+def site(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Site)
+    server.methods = list()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Every website resolves to the local one
+    monkeypatch.setattr(online_producer, "ONLINE_HTTP_URL", f'http://127.0.0.1:{server.server_address[1]}/')
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def by_metric(updates: list[dict], entity: str) -> dict[str, str]:
+    return {s["metric"]: s["value"] for s in updates if s["entity"] == entity}
+
+
+def test_percentile():
+    assert percentile([1.0], 0.9) == 1.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 0.5) == 2.0
+    assert percentile([float(s) for s in range(1, 11)], 0.9) == 9.0
+
+
+def test_tcp(monkeypatch, listener, closed):
+    monkeypatch.setattr(online_producer, "ONLINE_TCP_PORTS", [listener])
+
+    updates = by_metric(Online.run_many("ip", ["127.0.0.1"]), "127.0.0.1")
+
+    assert updates["Status"] == "Up"
+    assert updates["Probe port"] == str(listener)
+    assert float(updates["Rtt p50 ms"]) <= float(updates["Rtt p90 ms"]) <= float(updates["Rtt max ms"])
+
+    # Refusing the connection still answers
+    monkeypatch.setattr(online_producer, "ONLINE_TCP_PORTS", [closed])
+    assert by_metric(Online.run_many("ip", ["127.0.0.1"]), "127.0.0.1")["Probe port"] == str(closed)
+
+
+def test_http(site):
+    updates = by_metric(Online.run_many("website", ["example.com"]), "example.com")
+
+    assert updates["Status"] == "Up"
+    assert updates["Http status"] == "200"
+
+    # HEAD is given up on after the first refusal
+    assert site.methods == ["HEAD", "GET", "GET", "GET"]
+
+
+def test_http_down(monkeypatch, closed):
+    monkeypatch.setattr(online_producer, "ONLINE_HTTP_URL", f'http://127.0.0.1:{closed}/')
+
+    assert by_metric(Online.run_many("website", ["example.com"]), "example.com") == {"Status": "Down"}
@@ -0,0 +1,58 @@
+from souls.ports import PortSet
+
+
+def test_from_host_keeps_open_ports():
+    host = {
+        "tcp": {22: {"state": "open"}, 80: {"state": "open"}, 443: {"state": "closed"}},
+        "udp": {53: {"state": "open"}}
+    }
+
+    ports = PortSet.from_host(host)
+
+    assert list(ports.ports("tcp")) == [22, 80]
+    assert list(ports.ports("udp")) == [53]
+    assert len(ports) == 3
+
+
+def test_str_collapses_ranges():
+    ports = PortSet()
+    for port in [22, 80, 81, 82, 443]:
+        ports.add("tcp", port)
+
+    assert str(ports) == "22, 80-82, 443"
+
+    ports.add("udp", 53)
+
+    assert str(ports) == "tcp 22, 80-82, 443; udp 53"
+
+
+def test_str_empty():
+    assert str(PortSet()) == "No open ports"
+    assert len(PortSet()) == 0
+
+
+def test_dict_round_trip():
+    ports = PortSet()
+    ports.add("tcp", 65535)
+    ports.add("sctp", 1)
+
+    assert PortSet.from_dict(ports.to_dict()) == ports
+    assert PortSet.from_dict(None) == PortSet()
+
+
+def test_diff():
+    before = PortSet({"tcp": 1 << 22 | 1 << 80})
+    after = PortSet({"tcp": 1 << 22 | 1 << 443, "udp": 1 << 53})
+
+    opened, closed = after.diff(before)
+
+    assert opened == PortSet({"tcp": 1 << 443, "udp": 1 << 53})
+    assert closed == PortSet({"tcp": 1 << 80})
+    assert after.diff(after) == (PortSet(), PortSet())
+
+
+def test_union_and_protocol():
+    ports = PortSet({"tcp": 1 << 22}) | PortSet({"tcp": 1 << 80, "udp": 1 << 53})
+
+    assert ports == PortSet({"tcp": 1 << 22 | 1 << 80, "udp": 1 << 53})
+    assert ports.protocol("udp") == PortSet({"udp": 1 << 53})
@@ -0,0 +1,46 @@
+from souls.ratelimit import TokenBucket
+import asyncio
+import pytest
+import time
+
+
+def test_acquire():
+    bucket = TokenBucket(50, capacity=2)
+
+    start = time.monotonic()
+    assert bucket.acquire() and bucket.acquire()
+    assert time.monotonic() - start < 0.01
+
+    # Empty, the next token is 20ms away
+    assert bucket.acquire()
+    assert time.monotonic() - start >= 0.015
+
+
+def test_timeout():
+    bucket = TokenBucket(1)
+    assert bucket.acquire()
+
+    start = time.monotonic()
+    assert not bucket.acquire(timeout=0.1)
+    assert time.monotonic() - start < 0.05
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+    with pytest.raises(ValueError):
+        TokenBucket(1, capacity=2).acquire(3)
+
+
+def test_aacquire():
+    bucket = TokenBucket(50, capacity=1)
+
+    async def take(count: int) -> float:
+        start = time.monotonic()
+        await asyncio.gather(*[bucket.aacquire() for _ in range(count)])
+        return time.monotonic() - start
+
+    # Spaced out by the rate across coroutines
+    assert asyncio.run(take(4)) >= 0.055
+    assert not asyncio.run(bucket.aacquire(timeout=0))
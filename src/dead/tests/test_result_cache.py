@@ -0,0 +1,37 @@
+from souls import result_cache
+from souls.result_cache import ResultCache
+import time
+
+
+def test_put_many_get_many(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_CHUNK", 3)
+    cache = ResultCache(str(tmp_path / "results.db"))
+
+    results = {f'10.0.0.{s}': [{"entity": f'10.0.0.{s}', "source": "Test", "metric": "State", "value": "up"}] for s in range(10)}
+    cache.put_many("Test", {"ports": "1-100"}, results)
+
+    found = cache.get_many(list(results) + ["10.0.0.99"], "Test", {"ports": "1-100"}, 60)
+
+    assert found == {s: (u, False) for s, u in results.items()}
+    assert cache.get_many(list(results), "Test", {"ports": "1-200"}, 60) == dict()
+    assert cache.get_many(list(results), "Other", {"ports": "1-100"}, 60) == dict()
+
+
+def test_get_many_ttl(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "results.db"))
+    cache.put("10.0.0.1", "Test", dict(), [])
+
+    monkeypatch.setattr(time, "time", lambda: 2e10)
+
+    assert cache.get("10.0.0.1", "Test", dict(), 60) is None
+
+
+def test_mark_posted(tmp_path):
+    cache = ResultCache(str(tmp_path / "results.db"))
+    updates = [{"entity": s, "source": "Test", "metric": "State", "value": "up"} for s in ["a.example.com", "b.example.com"]]
+
+    cache.put_many("Test", dict(), {s["entity"]: [s] for s in updates})
+    cache.mark_posted(updates[:1])
+
+    assert cache.get("a.example.com", "Test", dict(), 60) == ([updates[0]], True)
+    assert cache.unposted() == updates[1:]
@@ -0,0 +1,115 @@
+from scheduler import Scheduler
+from souls.default import Producer
+import os
+import subprocess
+import time
+
+# Slow targets hang until their job times out
+SLOW = "10.0.0.1"
+
+
+class Sleeper(Producer):
+    source = "Sleeper"
+    timeout = 1
+    concurrency = 1
+
+    def __init__(self, type: str, entity: str, pidfile: str = None) -> None:
+        super().__init__(entity, type, self.source)
+
+        self._pidfile = pidfile
+
+    def run(self) -> list[dict]:
+        if self._entity == SLOW:
+            time.sleep(600)
+
+        self.add_update("state", "up")
+
+        return self.get_updates()
+
+
+class ProcessSleeper(Sleeper):
+    source = "ProcessSleeper"
+    pool = "process"
+    concurrency = 2
+
+    def run(self) -> list[dict]:
+        # Like nmap, the work happens in a child of the worker
+        if self._entity == SLOW:
+            child = subprocess.Popen(["sleep", "600"])
+
+            with open(self._pidfile, "w") as f:
+                f.write(str(child.pid))
+
+            child.wait()
+
+        return super().run()
+
+
+class Failing(Sleeper):
+    source = "Failing"
+
+    def run(self) -> list[dict]:
+        raise RuntimeError("boom")
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    # Reaped by now or a zombie waiting on its parent
+    with open(f'/proc/{pid}/stat') as f:
+        return f.read().split()[2] != "Z"
+
+
+def test_timeouts_free_slots_and_kill_workers(tmp_path):
+    pidfile = str(tmp_path / "child.pid")
+
+    scheduler = Scheduler(poll_interval=0.05)
+    scheduler.add(Sleeper)
+    scheduler.add(ProcessSleeper, {"pidfile": pidfile})
+    scheduler.add(Failing)
+
+    start = time.monotonic()
+    updates = scheduler.run("host", [SLOW, "10.0.0.2", "10.0.0.3"])
+
+    # The hung thread gave up its only slot, so the other targets still ran
+    assert sorted((s["source"], s["entity"]) for s in updates) == [
+        ("ProcessSleeper", "10.0.0.2"), ("ProcessSleeper", "10.0.0.3"),
+        ("Sleeper", "10.0.0.2"), ("Sleeper", "10.0.0.3")
+    ]
+    assert time.monotonic() - start < 10
+
+    # The worker's own child went down with it
+    with open(pidfile) as f:
+        pid = int(f.read())
+
+    deadline = time.monotonic() + 5
+    while alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert not alive(pid)
+
+
+def test_concurrency_is_bounded():
+    class Counting(Sleeper):
+        source = "Counting"
+        concurrency = 2
+        running = 0
+        most = 0
+
+        def run(self) -> list[dict]:
+            Counting.running += 1
+            Counting.most = max(Counting.most, Counting.running)
+            time.sleep(0.05)
+            Counting.running -= 1
+
+            return super().run()
+
+    scheduler = Scheduler(poll_interval=0.05)
+    scheduler.add(Counting)
+
+    assert len(scheduler.run("host", [f'10.0.1.{s}' for s in range(8)])) == 8
+    assert Counting.most == 2
@@ -0,0 +1,143 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from souls import shodan_producer
+from souls.ratelimit import TokenBucket
+from souls.shodan_producer import Shodan
+from urllib.parse import parse_qs, urlparse
+import json
+import logging
+import pytest
+import threading
+
+KEY = "shodan-secret-key"
+
+HOSTS = {
+    "192.0.2.10": {
+        "ip_str": "192.0.2.10",
+        "org": "Example Org",
+        "os": None,
+        "hostnames": ["gw.example.com"],
+        "ports": [22, 443],
+        "vulns": ["CVE-2023-48795", "CVE-2021-3449"],
+        "data": [
+            {"port": 443, "transport": "tcp", "product": "nginx", "version": "1.18.0"},
+            {"port": 22, "transport": "tcp", "data": "SSH-2.0-OpenSSH_8.9p1\r\nKey type: ssh-rsa"}
+        ]
+    },
+    "192.0.2.11": {
+        "ip_str": "192.0.2.11",
+        "org": "Example Org",
+        "ports": [53],
+        "data": [{"port": 53, "transport": "udp", "product": "dnsmasq"}]
+    }
+}
+
+
+class API(BaseHTTPRequestHandler):
+    """
+    Fake Shodan API, answering /api-info and /shodan/host from HOSTS. A
+    request for 192.0.2.66 fails with the url, key included, in its body
+    """
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        self.server.requests.append(url.path)
+
+        if parse_qs(url.query).get("key") != [KEY]:
+            return self.reply(401, {"error": "Invalid API key"})
+
+        if url.path == "/api-info":
+            return self.reply(200, {"plan": "dev", "query_credits": self.server.credits, "scan_credits": 0})
+
+        if url.path.startswith("/shodan/host/"):
+            ips = url.path.split("/")[-1].split(",")
+
+            if "192.0.2.66" in ips:
+                return self.reply(500, {"error": self.path})
+
+            hosts = [HOSTS[s] for s in ips if s in HOSTS]
+
+            if not hosts:
+                return self.reply(404, {"error": "No information available for that IP."})
+
+            return self.reply(200, hosts if len(ips) > 1 else hosts[0])
+
+        self.reply(404, {"error": "not found"})
+
+    def reply(self, status: int, body) -> None:
+        content = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), API)
+    server.requests = list()
+    server.credits = 100
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(shodan_producer, "SHODAN_API_URL", f'http://127.0.0.1:{server.server_address[1]}/')
+    monkeypatch.setattr(shodan_producer, "SHODAN_BATCH_SIZE", 2)
+    monkeypatch.setattr(shodan_producer, "_BUCKET", TokenBucket(1000))
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def by_metric(updates: list[dict], entity: str) -> dict[str, str]:
+    return {s["metric"]: s["value"] for s in updates if s["entity"] == entity}
+
+
+def test_run_many(api):
+    updates = Shodan.run_many("ip", ["192.0.2.10", "192.0.2.11", "192.0.2.12", "example.com"], KEY)
+
+    # One credit check then a lookup per batch of two
+    assert api.requests == ["/api-info", "/shodan/host/192.0.2.10,192.0.2.11", "/shodan/host/192.0.2.12"]
+
+    host = by_metric(updates, "192.0.2.10")
+    assert host["Open ports"] == "22, 443"
+    assert host["Open port count"] == "2"
+    assert host["Vulns"] == "CVE-2021-3449, CVE-2023-48795"
+    assert host["Banners"] == "22/tcp SSH-2.0-OpenSSH_8.9p1, 443/tcp nginx 1.18.0"
+    assert host["Hostnames"] == "gw.example.com"
+    assert "Os" not in host
+
+    assert by_metric(updates, "192.0.2.11")["Open ports"] == "53"
+    assert by_metric(updates, "192.0.2.11")["Vulns"] == "No known vulns"
+    assert by_metric(updates, "192.0.2.12") == dict()
+
+
+def test_run(api):
+    assert by_metric(Shodan("ip", "192.0.2.11", KEY).run(), "192.0.2.11")["Org"] == "Example Org"
+    assert Shodan("ip", "192.0.2.12", KEY).run() is None
+
+
+def test_credits(api):
+    api.credits = 1
+
+    updates = Shodan.run_many("ip", ["192.0.2.12", "192.0.2.13", "192.0.2.10", "192.0.2.11"], KEY)
+
+    # The rest are left for the next sweep
+    assert api.requests == ["/api-info", "/shodan/host/192.0.2.12,192.0.2.13"]
+    assert updates == list()
+
+
+def test_redacts_key(api, caplog):
+    caplog.set_level(logging.WARNING)
+
+    updates = Shodan.run_many("ip", ["192.0.2.66", "192.0.2.67", "192.0.2.11"], KEY)
+
+    assert by_metric(updates, "192.0.2.11")["Open ports"] == "53"
+    assert "Failed to look up 2 hosts on Shodan" in caplog.text
+    assert KEY not in caplog.text
+
+    assert Shodan.run_many("ip", ["192.0.2.11"], "wrong-key") == list()
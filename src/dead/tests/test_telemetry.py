@@ -0,0 +1,17 @@
+from entity_cache import EntityCache
+from prometheus_client import CollectorRegistry, generate_latest
+from telemetry import EntityCacheCollector
+
+
+def test_entity_cache_counters():
+    cache = EntityCache(1, 60)
+    registry = CollectorRegistry()
+    registry.register(EntityCacheCollector(cache))
+
+    cache.get(("10.0.0.1", "host"))
+
+    text = generate_latest(registry).decode()
+
+    assert "# TYPE necromancer_entity_cache_misses_total counter" in text
+    assert "necromancer_entity_cache_misses_total 1.0" in text
+    assert "# TYPE necromancer_entity_cache_size gauge" in text